@@ -0,0 +1,85 @@
+'''Compare the object graph walk with reachability bitmaps on a deep history.
+
+usage: python benchmarks/bitmap_traversal.py [--commits N] [--files N]
+'''
+import io
+import os
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ugit import base, bitmap, data, remote  # noqa: E402
+
+
+def make_history(commits, files, seed=0):
+    '''A linear history where every commit edits a few files.'''
+    rng = random.Random(seed)
+    with data.get_index() as index:
+        for i in range(files):
+            index[f'd{i % 31:02}/f{i}.txt'] = data.hash_object(
+                f'file {i}\n'.encode())
+    base.commit('initial')
+    for i in range(commits - 1):
+        with data.get_index() as index:
+            for _ in range(3):
+                f = rng.randrange(files)
+                index[f'd{f % 31:02}/f{f}.txt'] = data.hash_object(
+                    f'file {f} version {i}\n'.encode())
+        base.commit(f'commit {i}')
+    return data.get_ref('HEAD').value
+
+
+def timed(name, func, unit='objects'):
+    start = time.perf_counter()
+    count = len(func())
+    elapsed = time.perf_counter() - start
+    print(f'{name:<24} {elapsed:8.3f}s {count:8} {unit}')
+
+
+def upload_pack(wants, haves):
+    f = io.BytesIO()
+    remote.upload_pack(f, wants, haves)
+    return f.getvalue()
+
+
+def time_enumeration(kind, head, old):
+    timed(f'{kind} all', lambda: set(base.iter_objects_between({head}, ())))
+    timed(f'{kind} between',
+          lambda: set(base.iter_objects_between({head}, {old})))
+    timed(f'{kind} upload_pack',
+          lambda: upload_pack({head}, {old}), 'bytes')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commits', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=500)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='ugit-bench-')
+    try:
+        os.chdir(workdir)
+        with data.change_git_dir('.'):
+            base.init()
+            head = make_history(args.commits, args.files)
+            old = list(base.iter_commits_and_parents({head}))[
+                args.commits // 2]
+
+            # both read the same pack, only the enumeration differs
+            pack_path, _ = base.repack()
+            time_enumeration('bitmaps', head, old)
+            os.remove(bitmap.bitmap_path(pack_path))
+            time_enumeration('walk', head, old)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+'''Compare serial and parallel checkout of a synthetic tree.
+
+usage: python benchmarks/checkout_parallel.py [--files N] [--jobs N]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ugit import base, data  # noqa: E402
+
+
+def make_tree(count):
+    '''Write count small blobs spread over nested directories as a tree.'''
+    with data.get_index() as index:
+        for i in range(count):
+            path = f'd{i % 97:02}/s{i % 13:02}/f{i}.txt'
+            index[path] = data.hash_object(f'file {i}\n'.encode() * 8)
+    return base.write_tree()
+
+
+def clean_checkout(tree, jobs):
+    # empty the working tree and index so every file is written again
+    for name in os.listdir('.'):
+        if name != '.ugit':
+            shutil.rmtree(name)
+    with data.get_index() as index:
+        index.clear()
+
+    start = time.perf_counter()
+    base.read_tree(tree, update_working=True, jobs=jobs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='ugit-bench-')
+    try:
+        os.chdir(workdir)
+        with data.change_git_dir('.'):
+            base.init()
+            tree = make_tree(args.files)
+            for jobs in sorted({1, args.jobs}):
+                elapsed = clean_checkout(tree, jobs)
+                print(f'jobs={jobs:<3} {elapsed:7.2f}s '
+                      f'{args.files / elapsed:9.0f} files/s')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
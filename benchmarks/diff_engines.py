@@ -0,0 +1,63 @@
+'''Compare difflib with the built-in myers and histogram diff engines.
+
+usage: python benchmarks/diff_engines.py [--lines N] [--changes N]
+'''
+import os
+import sys
+import time
+import random
+import difflib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ugit import linediff  # noqa: E402
+
+
+def make_corpus(lines, changes, seed=0):
+    '''Two versions of a source-like file, with some lines edited.'''
+    rng = random.Random(seed)
+    # blank lines and braces repeat a lot, like in real code
+    common = ['', '}', '    return result', '    }']
+    a = [rng.choice(common) if rng.random() < 0.2 else
+         f'    value_{rng.randrange(lines)} = compute({i})'
+         for i in range(lines)]
+    b = list(a)
+    for _ in range(changes):
+        i = rng.randrange(len(b))
+        action = rng.random()
+        if action < 0.4:
+            b[i] = f'    changed_{rng.randrange(lines)} = 0'
+        elif action < 0.7:
+            b.insert(i, f'    added_{rng.randrange(lines)} = 1')
+        else:
+            del b[i]
+    return a, b
+
+
+def run(name, func, a, b):
+    start = time.perf_counter()
+    output = list(func(a, b))
+    elapsed = time.perf_counter() - start
+    changed = sum(1 for line in output
+                  if line[:1] in '+-' and line[:3] not in ('+++', '---'))
+    print(f'{name:<10} {elapsed:8.3f}s {changed:7} changed lines')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--changes', type=int, default=200)
+    args = parser.parse_args()
+
+    a, b = make_corpus(args.lines, args.changes)
+    run('difflib', lambda a, b: difflib.unified_diff(a, b, lineterm=''),
+        a, b)
+    for algorithm in sorted(linediff.ALGORITHMS):
+        run(algorithm,
+            lambda a, b: linediff.unified_diff(a, b, algorithm=algorithm),
+            a, b)
+
+
+if __name__ == '__main__':
+    main()
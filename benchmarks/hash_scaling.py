@@ -0,0 +1,60 @@
+'''Measure how `ugit add` throughput scales with the number of hash workers.
+
+usage: python benchmarks/hash_scaling.py [--files N] [--size BYTES]
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ugit import base, data  # noqa: E402
+
+
+def make_files(count, size):
+    for i in range(count):
+        dirname = os.path.join('src', f'd{i % 100:02}')
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, f'f{i}.txt'), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def run(jobs):
+    # start from an empty repository so every file is hashed and written
+    shutil.rmtree(data.GIT_DIR, ignore_errors=True)
+    base.init()
+    start = time.perf_counter()
+    base.add(['src'], jobs=jobs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=4096)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='ugit-bench-')
+    try:
+        os.chdir(workdir)
+        with data.change_git_dir('.'):
+            make_files(args.files, args.size)
+            total_mb = args.files * args.size / 2 ** 20
+            jobs = 1
+            while jobs <= (os.cpu_count() or 1):
+                elapsed = run(jobs)
+                print(f'jobs={jobs:<3} {elapsed:7.2f}s '
+                      f'{args.files / elapsed:9.0f} files/s '
+                      f'{total_mb / elapsed:7.1f} MiB/s')
+                jobs *= 2
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+'''Time ugit operations on a synthetic repository and write the results
+as JSON, to compare versions of ugit.
+
+usage: python benchmarks/suite.py [--files N] [--commits N] [--repeat N]
+                                  [--scenarios add,status,...] [--output F]
+
+Every run of a scenario is a fresh process on a fresh copy of the
+repository, so caches start cold like for a real command. Time is
+measured without tracemalloc, one more run measures the peak of Python
+allocations with it.
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import synthetic  # noqa: E402
+from ugit import base, data, diff, remote  # noqa: E402
+
+# files edited by the scenarios that need local changes
+CHANGED_FILES = 0.01
+
+
+def _modify_files(seed=1):
+    '''Edit some text files of the working tree, return their paths.'''
+    rng = random.Random(seed)
+    paths = sorted(base.get_index_tree())
+    count = max(1, int(len(paths) * CHANGED_FILES))
+    changed = []
+    for path in rng.sample(paths, count):
+        with open(path, 'rb') as f:
+            content = f.read()
+        with open(path, 'wb') as f:
+            f.write(synthetic.edit_content(rng, content))
+        changed.append(path)
+    return changed
+
+
+def _target_repo():
+    '''Path of an empty repository next to the current one.'''
+    path = os.path.abspath('../target')
+    os.makedirs(path)
+    with data.change_git_dir(path):
+        base.init()
+    return path
+
+
+# A scenario is a setup function, run before the clock starts, whose
+# result is passed to the timed function.
+
+def _setup_modified():
+    _modify_files()
+
+
+def _run_add(_):
+    base.add(['.'])
+
+
+def _setup_commit():
+    base.add(_modify_files())
+
+
+def _run_commit(_):
+    base.commit('benchmark commit')
+
+
+def _run_status(_):
+    # what ugit status compares, without printing
+    HEAD_tree = base.get_commit(base.get_oid('@')).tree
+    list(diff.iter_changed_files(HEAD_tree, base.write_tree()))
+    list(diff.iter_changed_files(base.get_index_tree(),
+                                 base.get_working_tree()))
+
+
+def _run_diff(_):
+    diff.diff_trees(base.get_index_tree(), base.get_working_tree())
+
+
+def _run_log(_):
+    for oid in base.iter_commits_and_parents({base.get_oid('@')}):
+        base.get_commit(oid)
+
+
+def _setup_topics():
+    return sorted(base.iter_branch_names())
+
+
+def _run_checkout(topics):
+    # the oldest topic, far from master
+    base.checkout(topics[0])
+
+
+def _run_merge(topics):
+    base.merge(base.get_oid(topics[-1]))
+
+
+def _run_merge_base(topics):
+    master = base.get_oid('master')
+    for topic in topics:
+        base.get_merge_base(master, base.get_oid(topic))
+
+
+def _setup_fetch():
+    return os.path.abspath('.'), _target_repo()
+
+
+def _run_fetch(paths):
+    source, target = paths
+    os.chdir(target)
+    with data.change_git_dir('.'):
+        remote.fetch(source)
+
+
+def _setup_push():
+    # the remote has everything but the new commits
+    target = os.path.abspath('../target')
+    shutil.copytree(data.GIT_DIR, os.path.join(target, data.GIT_DIR))
+    for i in range(5):
+        base.add(_modify_files(seed=i))
+        base.commit(f'to push {i}')
+    return target
+
+
+def _run_push(target):
+    remote.push(target, 'refs/heads/master')
+
+
+def _no_setup():
+    return None
+
+
+SCENARIOS = {
+    'add': (_setup_modified, _run_add),
+    'commit': (_setup_commit, _run_commit),
+    'status': (_setup_modified, _run_status),
+    'diff': (_setup_modified, _run_diff),
+    'log': (_no_setup, _run_log),
+    'checkout': (_setup_topics, _run_checkout),
+    'merge': (_setup_topics, _run_merge),
+    'merge_base': (_setup_topics, _run_merge_base),
+    'fetch': (_setup_fetch, _run_fetch),
+    'push': (_setup_push, _run_push),
+}
+
+
+def run_scenario(name, repo, trace_memory):
+    '''Run a scenario in repo, in this process. Return its result.'''
+    setup, run = SCENARIOS[name]
+    os.chdir(repo)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), \
+            data.change_git_dir('.'):
+        # the copy has new inodes, refresh the stat data of the index
+        base.get_working_tree()
+        state = setup()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        run(state)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        tracemalloc.stop()
+    return {'seconds': elapsed, 'peak_memory': peak}
+
+
+def _run_in_process(name, template, workdir, trace_memory):
+    repo = os.path.join(workdir, 'run', 'repo')
+    shutil.rmtree(os.path.dirname(repo), ignore_errors=True)
+    shutil.copytree(template, repo)
+    command = [sys.executable, __file__, '--run', name, repo]
+    if trace_memory:
+        command.append('--trace-memory')
+    output = subprocess.run(command, check=True, capture_output=True,
+                            text=True).stdout
+    return json.loads(output)
+
+
+def run_suite(spec, names, repeat, workdir):
+    template = os.path.join(workdir, 'template')
+    os.makedirs(template)
+    cwd = os.getcwd()
+    os.chdir(template)
+    try:
+        with data.change_git_dir('.'):
+            start = time.perf_counter()
+            synthetic.generate(spec)
+            generate_seconds = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+    results = {}
+    for name in names:
+        seconds = [_run_in_process(name, template, workdir, False)['seconds']
+                   for _ in range(repeat)]
+        memory = _run_in_process(name, template, workdir, True)
+        results[name] = {
+            'seconds': seconds,
+            'min_seconds': min(seconds),
+            'median_seconds': statistics.median(seconds),
+            'peak_memory': memory['peak_memory'],
+        }
+        print(f'{name:<12} {min(seconds):8.3f}s '
+              f'{statistics.median(seconds):8.3f}s median '
+              f'{memory["peak_memory"] / 2**20:8.1f} MiB peak')
+
+    return {
+        'spec': spec._asdict(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'generate_seconds': generate_seconds,
+        'scenarios': results,
+    }
+
+
+def main():
+    defaults = synthetic.RepoSpec()
+    parser = argparse.ArgumentParser()
+    for field in defaults._fields:
+        parser.add_argument(f'--{field.replace("_", "-")}',
+                            type=type(getattr(defaults, field)),
+                            default=getattr(defaults, field))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--run', nargs=2, metavar=('SCENARIO', 'REPO'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_scenario(*args.run, args.trace_memory)))
+        return
+
+    names = args.scenarios.split(',')
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario {name}')
+    spec = synthetic.RepoSpec(*(getattr(args, field)
+                                for field in defaults._fields))
+
+    workdir = tempfile.mkdtemp(prefix='ugit-bench-')
+    try:
+        results = run_suite(spec, names, args.repeat, workdir)
+    finally:
+        shutil.rmtree(workdir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
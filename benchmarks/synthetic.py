@@ -0,0 +1,158 @@
+'''Deterministic synthetic repositories for the benchmarks.
+
+The same spec always gives the same files, commits and oids, so results
+of different ugit versions can be compared.
+'''
+import os
+import sys
+import random
+from collections import namedtuple
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ugit import base, data  # noqa: E402
+
+RepoSpec = namedtuple('RepoSpec', [
+    'files',         # number of files in the first commit
+    'depth',         # maximum directory depth
+    'file_size',     # average file size in bytes
+    'commits',       # number of commits, including those on topic branches
+    'branches',      # number of topic branches forked from master
+    'binary_ratio',  # share of binary files
+    'seed',
+], defaults=[1000, 3, 2048, 100, 4, 0.1, 0])
+
+# directories per level, and files changed by a commit
+DIR_FANOUT = 8
+CHANGED_PER_COMMIT = 0.01
+
+WORDS = ('return', 'value', 'self', 'result', 'index', 'import', 'def',
+         'for', 'in', 'if', 'else', 'None', 'path', 'name', 'data', '=',
+         '+', '(', ')', ':', 'count', 'items', 'tree', 'oid')
+
+
+def _make_path(rng, i, depth):
+    parts = [f'd{rng.randrange(DIR_FANOUT)}'
+             for _ in range(rng.randrange(depth + 1))]
+    return os.path.join(*parts, f'f{i}.txt')
+
+
+def _make_line(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 10)))
+
+
+def make_content(rng, size, binary):
+    if binary:
+        # a NUL byte early on makes it binary for diff
+        return b'\0' + rng.randbytes(max(size - 1, 0))
+    lines = []
+    length = 0
+    while length < size:
+        line = _make_line(rng)
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines).encode() + b'\n'
+
+
+def edit_content(rng, content):
+    '''Change, insert or delete a few lines of a text file, or rewrite
+    part of a binary one.'''
+    if content[:1] == b'\0':
+        # keep the leading NUL byte
+        start = rng.randrange(1, max(len(content), 2))
+        end = min(start + 64, len(content))
+        return content[:start] + rng.randbytes(end - start) + content[end:]
+    lines = content.decode().splitlines()
+    for _ in range(rng.randint(1, 3)):
+        i = rng.randrange(len(lines) + 1)
+        action = rng.random()
+        if action < 0.5 and i < len(lines):
+            lines[i] = _make_line(rng)
+        elif action < 0.8 or not lines:
+            lines.insert(i, _make_line(rng))
+        elif i < len(lines):
+            del lines[i]
+    return '\n'.join(lines).encode() + b'\n'
+
+
+def _write(path, content):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _commit_changes(rng, paths, message):
+    count = max(1, int(len(paths) * CHANGED_PER_COMMIT))
+    changed = rng.sample(paths, min(count, len(paths)))
+    for path in changed:
+        _write(path, edit_content(rng, _read(path)))
+    base.add(changed, jobs=1)
+    return base.commit(message)
+
+
+def generate(spec=RepoSpec()):
+    '''Create the repository of spec in the current directory. Topic
+    branches are forked from master at regular intervals, all but the last
+    one are merged back. Return the names of the topic branches.'''
+    rng = random.Random(spec.seed)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        return _generate(rng, spec)
+
+
+def _generate(rng, spec):
+    base.init()
+    paths = []
+    for i in range(spec.files):
+        path = _make_path(rng, i, spec.depth)
+        size = max(1, int(rng.expovariate(1 / spec.file_size)))
+        _write(path, make_content(rng, size, rng.random() < spec.binary_ratio))
+        paths.append(os.path.normpath(path))
+    base.add(paths, jobs=1)
+    base.commit('initial commit')
+    base.create_branch('master', data.get_ref('HEAD').value)
+    data.update_ref('HEAD', data.RefValue(True, 'refs/heads/master'),
+                    deref=False)
+
+    topics = []
+    topic_commits = max(1, (spec.commits - 1) // (4 * (spec.branches + 1)))
+    # the commits on topics, and the merge commits of all but the last
+    master_commits = (spec.commits - 1 - spec.branches * topic_commits -
+                      max(spec.branches - 1, 0))
+    fork_every = max(1, master_commits // (spec.branches + 1))
+    n = 0
+    for i in range(max(master_commits, 0)):
+        n += 1
+        _commit_changes(rng, paths, f'commit {n}')
+        if (i + 1) % fork_every or len(topics) == spec.branches:
+            continue
+
+        topic = f'topic{len(topics)}'
+        topics.append(topic)
+        base.create_branch(topic, data.get_ref('HEAD').value)
+        base.checkout(topic, jobs=1)
+        for _ in range(topic_commits):
+            n += 1
+            _commit_changes(rng, paths, f'commit {n} on {topic}')
+        base.checkout('master', jobs=1)
+
+        # the topic before this one is done now
+        if len(topics) > 1:
+            _merge(topics[-2])
+
+    # the last topic stays unmerged, for the merge benchmark
+    return topics
+
+
+def _merge(topic):
+    base.merge(data.get_ref(f'refs/heads/{topic}').value, jobs=1)
+    # conflicts are committed with their markers
+    base.add(['.'], jobs=1)
+    base.commit(f'Merge {topic}')
@@ -5,5 +5,5 @@ setup(name='ugit',
       version='1.0',
       packages=['ugit'],
       entry_points={
-          'console_scripts': ['ugit=ugit.cli:main']
+          'console_scripts': ['ugit=ugit.client:main']
       })
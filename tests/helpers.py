@@ -0,0 +1,35 @@
+'''Helpers shared by the tests, to run ugit in a repository.'''
+import io
+import os
+from contextlib import contextmanager, redirect_stdout
+
+from ugit import base, data
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@contextmanager
+def in_repo(path):
+    '''Run ugit in the repository at path, quietly.'''
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with data.change_git_dir('.'), redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        os.chdir(cwd)
+
+
+def write_files(files):
+    for path, content in files.items():
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def commit_files(files, message):
+    write_files(files)
+    base.add(list(files), jobs=1)
+    return base.commit(message)
@@ -0,0 +1,79 @@
+'''Checkout only touches the files that differ, and keeps local changes.'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from ugit import base, data
+
+from helpers import in_repo, write_files, commit_files
+
+
+class CheckoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ugit-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        with in_repo(self.root):
+            base.init()
+            self.first = commit_files(
+                {'same.txt': 'same\n', 'changed.txt': 'one\n',
+                 'removed.txt': 'removed\n'}, 'first')
+            base.create_branch('first', self.first)
+            os.remove('removed.txt')
+            with data.get_index() as index:
+                del index['removed.txt']
+            self.second = commit_files({'changed.txt': 'two\n'}, 'second')
+
+    def read(self, path):
+        with open(os.path.join(self.root, path)) as f:
+            return f.read()
+
+    def test_checkout(self):
+        with in_repo(self.root):
+            base.checkout('first', jobs=1)
+            self.assertEqual(self.read('changed.txt'), 'one\n')
+            self.assertEqual(self.read('removed.txt'), 'removed\n')
+            base.checkout(self.second, jobs=1)
+            self.assertEqual(self.read('changed.txt'), 'two\n')
+            self.assertFalse(os.path.exists('removed.txt'))
+
+    def test_local_changes_are_kept(self):
+        with in_repo(self.root):
+            write_files({'changed.txt': 'local\n'})
+            with self.assertRaisesRegex(Exception, 'changed.txt'):
+                base.checkout('first', jobs=1)
+            self.assertEqual(self.read('changed.txt'), 'local\n')
+            self.assertEqual(data.get_ref('HEAD').value, self.second)
+
+            # a local change of a path that doesn't differ is carried over
+            write_files({'changed.txt': 'two\n', 'same.txt': 'local\n'})
+            base.checkout('first', jobs=1)
+            self.assertEqual(self.read('same.txt'), 'local\n')
+
+            write_files({'removed.txt': 'local\n'})
+            with self.assertRaisesRegex(Exception, 'removed.txt'):
+                base.checkout(self.second, jobs=1)
+            self.assertEqual(self.read('removed.txt'), 'local\n')
+
+    def test_untracked_file_is_kept(self):
+        with in_repo(self.root):
+            write_files({'removed.txt': 'untracked\n'})
+            with self.assertRaisesRegex(Exception, 'removed.txt'):
+                base.checkout('first', jobs=1)
+            self.assertEqual(self.read('removed.txt'), 'untracked\n')
+
+    def test_matching_file_is_not_rewritten(self):
+        with in_repo(self.root):
+            write_files({'changed.txt': 'one\n'})
+            st = os.stat('changed.txt')
+            base.checkout('first', jobs=1)
+            self.assertEqual(os.stat('changed.txt').st_ino, st.st_ino)
+            self.assertEqual(os.stat('changed.txt').st_mtime_ns,
+                             st.st_mtime_ns)
+            self.assertEqual(base.get_working_tree(jobs=1),
+                             base.get_index_tree())
+
+
+if __name__ == '__main__':
+    unittest.main()
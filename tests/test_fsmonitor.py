@@ -0,0 +1,148 @@
+'''Tokens, overflows and directory changes of the fsmonitor, with the
+PollingMonitor, and the working tree base sees through it.'''
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ugit import base, fsmonitor
+
+from helpers import in_repo, write_files, commit_files
+
+
+class PollingMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, '.ugit'))
+        self.write({'a': 'a', 'dir/b': 'b'})
+        self.monitor = fsmonitor.start('poll', self.root)
+        self.token, _ = self.monitor.query(None)
+
+    def tearDown(self):
+        self.monitor.close()
+        shutil.rmtree(self.root)
+
+    def write(self, files):
+        for path, content in files.items():
+            path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def query(self, token=None):
+        new_token, paths = self.monitor.query(token or self.token)
+        self.token = new_token
+        return paths
+
+    def test_first_query_needs_a_full_scan(self):
+        monitor = fsmonitor.start('poll', self.root)
+        _, paths = monitor.query(None)
+        self.assertIsNone(paths)
+
+    def test_changes_since_token(self):
+        self.assertEqual(self.query(), set())
+        self.write({'a': 'changed', 'c': 'new'})
+        self.assertEqual(self.query(), {'a', 'c'})
+        self.assertEqual(self.query(), set())
+
+    def test_old_token_sees_all_later_changes(self):
+        old = self.token
+        self.write({'a': 'changed'})
+        self.query()
+        os.remove(os.path.join(self.root, 'dir/b'))
+        self.query()
+        self.assertEqual(self.query(old), {'a', os.path.join('dir', 'b')})
+
+    def test_token_of_another_monitor(self):
+        monitor = fsmonitor.start('poll', self.root)
+        token, _ = monitor.query(None)
+        self.assertIsNone(self.query(token))
+        self.assertIsNone(self.query('garbage'))
+
+    def test_overflow_invalidates_tokens(self):
+        old = self.token
+        self.query()
+        self.monitor._overflow()  # pylint: disable=protected-access
+        self.assertIsNone(self.query(old))
+        # tokens given out after the overflow are good again
+        self.write({'a': 'changed'})
+        self.assertEqual(self.query(), {'a'})
+
+    def test_expired_token(self):
+        old = self.token
+        with mock.patch.object(fsmonitor, 'MAX_QUERIES', 2):
+            for _ in range(3):
+                self.query()
+        self.assertIsNone(self.query(old))
+
+    def test_git_dir_is_ignored(self):
+        self.write({'.ugit/HEAD': 'ref: refs/heads/master'})
+        self.assertEqual(self.query(), set())
+
+    def test_directory_changes(self):
+        self.write({'new/x': 'x', 'new/deeper/y': 'y'})
+        self.assertEqual(self.query(), {os.path.join('new', 'x'),
+                                        os.path.join('new', 'deeper', 'y')})
+        os.rename(os.path.join(self.root, 'dir'),
+                  os.path.join(self.root, 'moved'))
+        self.assertEqual(self.query(), {os.path.join('dir', 'b'),
+                                        os.path.join('moved', 'b')})
+        shutil.rmtree(os.path.join(self.root, 'new'))
+        self.assertEqual(self.query(), {os.path.join('new', 'x'),
+                                        os.path.join('new', 'deeper', 'y')})
+
+    def test_unknown_kind(self):
+        with self.assertRaises(Exception):
+            fsmonitor.start('magic', self.root)
+
+
+class MonitoredWorkingTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        with in_repo(self.root):
+            base.init()
+            commit_files({'a': 'a', 'dir/b': 'b', 'dir/sub/c': 'c'}, 'one')
+            self.monitor = fsmonitor.start('poll')
+        base.set_monitor(self.monitor)
+
+    def tearDown(self):
+        base.set_monitor(None)
+        self.monitor.close()
+        shutil.rmtree(self.root)
+
+    def assert_working_tree(self):
+        '''The working tree seen through the monitor is the one a full
+        scan finds.'''
+        got = base.get_working_tree(jobs=1)
+        base.set_monitor(None)
+        try:
+            self.assertEqual(got, base.get_working_tree(jobs=1))
+        finally:
+            base.set_monitor(self.monitor)
+
+    def test_working_tree(self):
+        with in_repo(self.root):
+            self.assert_working_tree()
+            write_files({'a': 'changed', 'dir/sub/d': 'd'})
+            self.assert_working_tree()
+            os.rename('dir', 'moved')
+            self.assert_working_tree()
+            shutil.rmtree('moved/sub')
+            self.assert_working_tree()
+
+    def test_add(self):
+        with in_repo(self.root):
+            write_files({'a': 'changed', 'dir/sub/d': 'd', 'e': 'e'})
+            base.add(['a', 'dir'], jobs=1)
+            worktree = base.get_working_tree(jobs=1)
+            index = base.get_index_tree()
+            self.assertEqual(index['a'], worktree['a'])
+            self.assertEqual(index['dir/sub/d'], worktree['dir/sub/d'])
+            self.assertNotIn('e', index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+'''Repacking moves all objects into one pack.'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from ugit import base, data
+
+from helpers import in_repo, commit_files
+
+
+class RepackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ugit-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_repack_removes_loose_objects(self):
+        with in_repo(self.root):
+            base.init()
+            commit_files({'a': 'a', 'dir/b': 'b'}, 'first')
+            tip = commit_files({'a': 'changed'}, 'second')
+            objects = set(base.iter_objects_in_commits({tip}))
+            base.repack()
+            self.assertEqual(list(data.iter_loose_objects()), [])
+            # the empty fan-out directories are gone too
+            objects_dir = os.path.join(data.GIT_DIR, 'objects')
+            self.assertEqual(
+                [name for name in os.listdir(objects_dir) if len(name) == 2],
+                [])
+            for oid in objects:
+                self.assertTrue(data.object_exists(oid))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+'''Comparing the index with HEAD, without writing the index as trees.'''
+import io
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from ugit import base, cli, data, diff
+
+from helpers import in_repo, commit_files
+
+
+class StatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ugit-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        with in_repo(self.root):
+            base.init()
+            commit_files({'a': 'a', 'dir/b': 'b', 'dir/sub/c': 'c',
+                          'other/d': 'd'}, 'first')
+            self.tree = base.get_commit(data.get_ref('HEAD').value).tree
+
+    def changes(self):
+        return sorted(diff.iter_index_changes(self.tree,
+                                              base.get_index_tree()))
+
+    def test_clean_index(self):
+        with in_repo(self.root):
+            self.assertEqual(self.changes(), [])
+
+    def test_changes(self):
+        with in_repo(self.root):
+            new = data.hash_object(b'new')
+            with data.get_index() as index:
+                old_b = index['dir/b']
+                old_d = index['other/d']
+                index['dir/b'] = new
+                # a file replaces a directory and the other way around
+                del index['other/d']
+                index['other'] = new
+                del index['a']
+                index['a/e'] = new
+            self.assertEqual(self.changes(), [
+                ('a', data.hash_object(b'a'), None),
+                ('a/e', None, new),
+                ('dir/b', old_b, new),
+                ('other', None, new),
+                ('other/d', old_d, None),
+            ])
+
+    def test_status_writes_no_objects(self):
+        with in_repo(self.root):
+            with data.get_index() as index:
+                index['dir/sub/new'] = data.hash_object(b'new')
+            before = set(data.iter_loose_objects())
+            with redirect_stdout(io.StringIO()) as out:
+                cli.run(['status'])
+                cli.run(['diff', '--cached'])
+            self.assertIn('new file: dir/sub/new', out.getvalue())
+            self.assertEqual(set(data.iter_loose_objects()), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+'''Fetch, blobless clone and push over ugit:// against a ugit serve on
+localhost.'''
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from ugit import base, data, pack, protocol, remote, server
+
+from helpers import ROOT, in_repo, commit_files
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ugit-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.origin = os.path.join(self.root, 'origin')
+        os.makedirs(self.origin)
+        with in_repo(self.origin):
+            base.init()
+            self.first = commit_files(
+                {'a.txt': 'one\n' * 100, 'dir/b.txt': 'two\n' * 100}, 'first')
+            self.tip = commit_files({'a.txt': 'three\n' * 100}, 'second')
+            base.create_branch('master', self.tip)
+        self.url = self._serve()
+
+    def _serve(self):
+        server = subprocess.Popen(
+            [sys.executable, '-c', 'from ugit import cli; cli.main()',
+             'serve', '--port', '0'],
+            cwd=self.origin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, env={**os.environ, 'PYTHONPATH': ROOT})
+        self.addCleanup(server.stderr.close)
+        self.addCleanup(server.stdout.close)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        # Serving ugit://127.0.0.1:port
+        return server.stdout.readline().split()[1]
+
+    def _new_repo(self, name):
+        path = os.path.join(self.root, name)
+        os.makedirs(path)
+        with in_repo(path):
+            base.init()
+        return path
+
+    def _origin_ref(self, refname):
+        with in_repo(self.origin):
+            return data.get_ref(refname).value
+
+    def test_fetch(self):
+        with in_repo(self._new_repo('fetched')):
+            remote.fetch(self.url)
+            self.assertEqual(data.get_ref('refs/remote/master').value,
+                             self.tip)
+            for oid in base.iter_objects_in_commits({self.tip}):
+                self.assertTrue(data.object_exists(oid))
+
+    def test_incremental_fetch(self):
+        with in_repo(self._new_repo('fetched')):
+            remote.fetch(self.url)
+        with in_repo(self.origin):
+            tip = commit_files({'dir/b.txt': 'two\n' * 99 + 'four\n'},
+                               'third')
+            base.create_branch('master', tip)
+        with in_repo(os.path.join(self.root, 'fetched')):
+            remote.fetch(self.url)
+            self.assertEqual(data.get_ref('refs/remote/master').value, tip)
+            self.assertEqual(
+                base.get_tree(base.get_commit(tip).tree)['dir/b.txt'],
+                data.hash_object(('two\n' * 99 + 'four\n').encode()))
+
+    def test_blobless_clone(self):
+        remote.clone(self.url, os.path.join(self.root, 'clone'),
+                     filter_spec='blob:none')
+        with in_repo(os.path.join(self.root, 'clone')):
+            self.assertEqual(data.get_promisor(), (self.url, 'blob:none'))
+            with open('a.txt') as f:
+                self.assertEqual(f.read(), 'three\n' * 100)
+            # the old version of a.txt was left out and is never needed
+            old_blob = base.get_tree(base.get_commit(self.first).tree)['a.txt']
+            self.assertFalse(data.object_exists(old_blob))
+            # until it is read, then it is fetched on demand
+            self.assertEqual(data.get_object(old_blob), b'one\n' * 100)
+            self.assertTrue(data.object_exists(old_blob))
+
+    def test_push(self):
+        local = self._new_repo('local')
+        with in_repo(local):
+            remote.fetch(self.url)
+            base.create_branch('master', self.tip)
+            base.checkout('master', jobs=1)
+            new = commit_files({'c.txt': 'pushed\n'}, 'pushed')
+            remote.push(self.url, 'refs/heads/master')
+        self.assertEqual(self._origin_ref('refs/heads/master'), new)
+        with in_repo(self.origin):
+            self.assertEqual(data.get_object(
+                base.get_tree(base.get_commit(new).tree)['c.txt']),
+                b'pushed\n')
+
+    def _push_raw(self, refname, old, new, content=None):
+        if content is None:
+            content = pack.encode_pack([])
+        with remote._open_remote(self.url) as connection:
+            connection.push_pack(refname, old, new, io.BytesIO(content))
+
+    def test_push_rejects_malicious_refnames(self):
+        outside = os.path.join(self.root, 'PWNED_BY_PUSH')
+        traversal = os.path.relpath(outside, os.path.join(self.origin,
+                                                          '.ugit'))
+        for refname in (traversal, 'refs/../../PWNED_BY_PUSH', outside,
+                        'refs//heads/x', 'HEAD', 'refs'):
+            with self.assertRaisesRegex(Exception, 'Invalid refname'):
+                self._push_raw(refname, None, self.tip)
+        self.assertFalse(os.path.exists(outside))
+        self.assertEqual(self._origin_ref('refs/heads/master'), self.tip)
+
+    def test_push_rejects_invalid_oids(self):
+        for old, new in ((None, 'hello-world'), (None, '../' * 13 + 'x'),
+                         ('z' * 40, self.tip)):
+            with self.assertRaisesRegex(Exception, 'Invalid object name'):
+                self._push_raw('refs/heads/topic', old, new)
+        self.assertIsNone(self._origin_ref('refs/heads/topic'))
+
+    def test_push_rejects_missing_objects(self):
+        local = self._new_repo('local')
+        with in_repo(local):
+            new = commit_files({'c.txt': 'never sent\n'}, 'not sent')
+        with self.assertRaisesRegex(Exception, 'incomplete'):
+            self._push_raw('refs/heads/topic', None, new)
+        with in_repo(local):
+            # the commit alone, without its tree and blob
+            f = io.BytesIO()
+            data.pack_objects(f, [new])
+            content = f.getvalue()
+        with self.assertRaisesRegex(Exception, 'incomplete'):
+            self._push_raw('refs/heads/topic', None, new, content)
+        self.assertIsNone(self._origin_ref('refs/heads/topic'))
+
+    def test_server_survives_rejected_push(self):
+        with remote._open_remote(self.url) as connection:
+            with self.assertRaisesRegex(Exception, 'Invalid refname'):
+                connection.push_pack('../escape', None, self.tip,
+                                     io.BytesIO(pack.encode_pack([])))
+            # the same connection still answers
+            self.assertEqual(connection.get_refs('refs/heads'),
+                             {'refs/heads/master': self.tip})
+
+    def test_fetch_rejects_invalid_wants(self):
+        with in_repo(self._new_repo('fetched')):
+            with remote._open_remote(self.url) as connection:
+                with self.assertRaisesRegex(Exception, 'Invalid object'):
+                    connection.fetch_pack({'../../../../etc/passwd'}, set())
+                with self.assertRaisesRegex(Exception, 'Invalid object'):
+                    connection.has_commits(['../../HEAD'])
+
+    def test_fetch_rejects_unknown_arguments(self):
+        with in_repo(self._new_repo('fetched')):
+            with remote._open_remote(self.url) as connection:
+                connection._send('fetch', f'foo {self.tip}', b'')
+                with self.assertRaisesRegex(Exception, 'Unknown fetch'):
+                    connection._receive_pack()
+                # the connection is still usable
+                self.assertEqual(connection.get_refs('refs/heads'),
+                                 {'refs/heads/master': self.tip})
+
+    def test_request_size_is_limited(self):
+        haves = [f'have {"0" * 40}'] * (server.MAX_REQUEST_SIZE // 45 + 1)
+        with remote._open_remote(self.url) as connection:
+            # the server hangs up, maybe before the client sent it all
+            with self.assertRaisesRegex(
+                    Exception, 'Connection closed|Connection reset|pipe'):
+                connection._send('negotiate', *haves, b'')
+                connection._read_messages()
+        # other clients are still served
+        with remote._open_remote(self.url) as connection:
+            self.assertEqual(connection.get_refs('refs/heads'),
+                             {'refs/heads/master': self.tip})
+
+    def test_null_oid_is_a_new_ref(self):
+        self.assertEqual(protocol.NULL_OID, '0' * 40)
+        with in_repo(self._new_repo('local')):
+            remote.fetch(self.url)
+            data.update_ref('refs/heads/topic',
+                            data.RefValue(False, self.first))
+            remote.push(self.url, 'refs/heads/topic')
+        self.assertEqual(self._origin_ref('refs/heads/topic'), self.first)
+
+
+if __name__ == '__main__':
+    unittest.main()
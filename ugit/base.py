@@ -1,13 +1,17 @@
 import os
+import heapq
+import bisect
 import itertools
 import operator
 import string
 
-from collections import namedtuple, deque
-from sys import gettrace
+from collections import namedtuple, deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 
+from . import bitmap  # pylint: disable=relative-beyond-top-level
 from . import data  # pylint: disable=relative-beyond-top-level
 from . import diff  # pylint: disable=relative-beyond-top-level
+from . import trace  # pylint: disable=relative-beyond-top-level
 
 
 def init():
@@ -16,48 +20,80 @@ def init():
         symbolic=True, value='refs/heads/master'))
 
 
+@trace.traced('tree.write')
 def write_tree():
-    index_as_tree = {}
+    '''Write the index as trees, directories whose tree oid is still cached
+    in the index aren't serialized again.'''
     with data.get_index() as index:
-        for path, oid in index.items():
-            path = path.split('/')
-            dirpath, filename = path[:-1], path[-1]
-
-            # convert flat index to tree-like index
-            current = index_as_tree
-            for dirname in dirpath:
-                current = current.setdefault(dirname, {})
-            current[filename] = oid
-
-    def write_tree_recursive(tree_dict: dict):
-        entries = []
-        for name, value in tree_dict.items():
-            if type(value) is dict:
-                type_ = 'tree'
-                oid = write_tree_recursive(value)
-            else:
-                type_ = 'blob'
-                oid = value
-            entries.append((name, oid, type_))
+        if '' in index.trees:
+            return index.trees['']
+        paths = sorted(index)
+        return _write_cached_tree(index, paths, '', 0, len(paths))
+
+
+def _write_cached_tree(index, paths, dirname, lo, hi):
+    '''Write the tree of dirname, paths[lo:hi] are the paths under it.'''
+    oid = index.trees.get(dirname)
+    if oid:
+        return oid
+
+    prefix = f'{dirname}/' if dirname else ''
+    entries = []
+    i = lo
+    while i < hi:
+        name, is_dir, _ = paths[i][len(prefix):].partition('/')
+        if not is_dir:
+            entries.append((name, index[paths[i]], 'blob'))
+            i += 1
+            continue
+        # paths of a directory are contiguous, '0' sorts right after '/'
+        subdir = prefix + name
+        end = bisect.bisect_left(paths, f'{subdir}0', i, hi)
+        entries.append(
+            (name, _write_cached_tree(index, paths, subdir, i, end), 'tree'))
+        i = end
+
+    tree = ''.join(f'{type_} {oid} {name}\n' for name,
+                   oid, type_ in sorted(entries))
+    oid = data.hash_object(tree.encode(), 'tree')
+    index.set_tree(dirname, oid)
+    return oid
+
 
-        tree = ''.join(f'{type_} {oid} {name}\n' for name,
-                       oid, type_ in sorted(entries))
-        return data.hash_object(tree.encode(), 'tree')
+# parsed commits and trees, the parsing is the expensive part once the
+# raw objects are in data.object_cache
+parsed_cache = data.ObjectCache(
+    int(os.environ.get('UGIT_PARSED_CACHE_SIZE', 32 * 2 ** 20)))
 
 
 def _iter_tree_entries(oid):
     '''Iterate hash object tree.'''
     if not oid:
         return
-    tree = data.get_object(oid, 'tree')
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split(' ', 2)
-        yield type_, oid, name
+    yield from _get_tree_entries(oid)
+
+
+def _get_tree_entries(oid):
+    key = ('tree', data.GIT_DIR, oid)
+    entries = parsed_cache.get(key)
+    if entries is None:
+        tree = data.get_object(oid, 'tree')
+        with trace.span('tree.parse') as span:
+            span.size = len(tree)
+            entries = tuple(tuple(entry.split(' ', 2))
+                            for entry in tree.decode().splitlines())
+        parsed_cache.put(key, entries, len(tree))
+    return entries
+
 
+def get_tree(oid, base_path='', trees=None):
+    '''Get tree from hash object oid.
 
-def get_tree(oid, base_path=''):
-    '''Get tree from hash object oid.'''
+    If trees is given, the oid of every directory is recorded in it.
+    '''
     result = {}
+    if trees is not None and oid:
+        trees[base_path.rstrip('/')] = oid
     for type_, oid, name in _iter_tree_entries(oid):
         assert '/' not in name
         assert name not in ('..', '.')
@@ -65,67 +101,243 @@ def get_tree(oid, base_path=''):
         if type_ == 'blob':
             result[path] = oid
         elif type_ == 'tree':
-            result.update(get_tree(oid, f'{path}/'))
+            result.update(get_tree(oid, f'{path}/', trees))
         else:
             raise Exception(f'Unknown tree entry {type_}')
     return result
 
 
-def get_working_tree():
-    result = {}
-    for root, _, filenames in os.walk('.'):
+def get_jobs(jobs=None):
+    '''Number of worker threads, from --jobs, UGIT_JOBS or the cpu count.'''
+    jobs = jobs or os.environ.get('UGIT_JOBS')
+    if jobs:
+        return max(1, int(jobs))
+    return os.cpu_count() or 1
+
+
+def _iter_files(dirname):
+    for root, _, filenames in os.walk(dirname):
         for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
+            path = os.path.relpath(os.path.join(root, filename))
             if is_ignored(path) or not os.path.isfile(path):
                 continue
-            with open(path, 'rb') as f:
-                result[path] = data.hash_object(f.read())
+            yield path
+
+
+def _hash_files(paths, index, jobs=None):
+    '''Hash files on a pool of threads, hashlib and file io release the GIL.
+
+    Only files whose stat data changed since they were indexed are hashed.
+    Yields (path, oid, stat) in the order of paths, so callers update the
+    index deterministically.
+    '''
+    def hash_path(path):
+        st = os.stat(path)
+        if index.is_clean(path, st):
+            return path, index[path], st
+        return path, data.hash_file(path), st
+
+    return _parallel_map(hash_path, paths, jobs)
+
+
+def _parallel_map(func, iterable, jobs=None):
+    '''map() on a pool of threads, results keep the order of iterable.'''
+    jobs = get_jobs(jobs)
+    if jobs == 1:
+        yield from map(func, iterable)
+        return
+    with ThreadPoolExecutor(jobs) as pool:
+        yield from pool.map(func, iterable)
+
+
+@trace.traced('worktree.scan')
+def get_working_tree(jobs=None):
+    with data.get_index() as index:
+        return _scan_working_tree(index, jobs)
+
+
+# the fsmonitor of this process, the daemon runs one
+_monitor = None
+
+
+def set_monitor(monitor):
+    '''Ask monitor which files changed from now on, or look at all files
+    again if monitor is None.'''
+    global _monitor
+    _monitor = monitor
+
+
+def _scan_working_tree(index, jobs=None, stats=None):
+    '''The working tree as path -> oid. With an fsmonitor only the files it
+    reports since the token in the index are looked at. The stat data of
+    the files looked at, taken before they were hashed, is put in stats.'''
+    monitor = _monitor
+    token, changed = None, None
+    if monitor:
+        token, changed = monitor.query(
+            index.fsmonitor and index.fsmonitor.token)
+
+    if changed is None:
+        result = {}
+        paths = _iter_files('.')
+    else:
+        result = index.get_worktree()
+        paths = _changed_paths(changed, result)
+
+    for path, oid, st in _hash_files(paths, index, jobs):
+        result[path] = oid
+        if stats is not None:
+            stats[path] = st
+        # refresh the stat data if the content is still the same
+        if index.get(path) == oid:
+            index.update_stat(path, oid, st)
+
+    # without changes the old token stays as good, the index isn't written
+    if monitor and changed != set():
+        index.set_fsmonitor(token, result)
     return result
 
 
+def _changed_paths(changed, result):
+    '''Files to look at for the paths an fsmonitor reported. Paths that
+    are gone are removed from result.'''
+    paths = []
+    dirs = []
+    for path in sorted(changed):
+        if is_ignored(path):
+            continue
+        if os.path.isfile(path):
+            paths.append(path)
+        elif os.path.isdir(path):
+            dirs.append(path)
+        elif result.pop(path, None) is None:
+            # a removed directory
+            dirs.append(path)
+
+    if dirs:
+        prefixes = tuple(f'{dirname}/' for dirname in dirs)
+        for path in [path for path in result if path.startswith(prefixes)]:
+            del result[path]
+        for dirname in dirs:
+            paths.extend(_iter_files(dirname))
+    return paths
+
+
 def get_index_tree():
     with data.get_index() as index:
         return index
 
 
-def _empty_current_directory():
-    for root, dirnames, filenames in os.walk('.', topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                pass
-
-
-def read_tree(tree_oid, update_working=False):
+def read_tree(tree_oid, update_working=False, jobs=None):
     with data.get_index() as index:
-        index.clear()
-        index.update(get_tree(tree_oid))
-        if update_working:
-            _checkout_index(index)
+        trees = {}
+        _update_index(index, get_tree(tree_oid, trees=trees),
+                      update_working, jobs)
+        for dirname, oid in trees.items():
+            index.set_tree(dirname, oid)
 
 
-def read_tree_merged(t_base, t_HEAD, t_other, update_workding=False):
+def read_tree_merged(t_base, t_HEAD, t_other, update_workding=False,
+                     jobs=None):
     with data.get_index() as index:
-        index.clear()
-        index.update(diff.merge_trees(
-            get_tree(t_base),
-            get_tree(t_HEAD),
-            get_tree(t_other)
-        ))
-        if update_workding:
-            _checkout_index(index)
-
-
-def _checkout_index(index: dict):
-    _empty_current_directory()
-    for path, oid in index.items():
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _update_index(index, diff.merge_trees(t_base, t_HEAD, t_other),
+                      update_workding, jobs)
+
+
+def _update_index(index, entries, update_working=False, jobs=None):
+    '''Make index match entries, a flat path -> oid mapping.
+
+    Entries whose oid didn't change keep their stat data and their files
+    aren't touched, so only the difference is checked out. Files of the
+    difference that have local changes are neither overwritten nor
+    removed, the update is refused. Files that already have their new
+    content are only recorded.
+    '''
+    removed = [path for path in index if path not in entries]
+    changed = [path for path, oid in entries.items()
+               if index.get(path) != oid]
+    if update_working:
+        current = _check_working_files(index, entries, changed + removed,
+                                        jobs)
+    for path in removed:
+        del index[path]
+    for path in changed:
+        index[path] = entries[path]
+
+    if update_working:
+        for path, st in current.items():
+            index.update_stat(path, entries[path], st)
+        changed = [path for path in changed if path not in current]
+        _checkout_index(index, changed, removed, jobs)
+
+
+def _check_working_files(index, entries, paths, jobs=None):
+    '''Raise if a file of paths has content that is neither in the index
+    nor in entries. Returns {path: stat} of the files that have their
+    content in entries already.'''
+    def check(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return path, None, None
+        if index.is_clean(path, st):
+            return path, st, index[path]
+        oid = None
+        if os.path.isfile(path):
+            oid = data.hash_file(path, write=False)
+        return path, st, oid
+
+    current = {}
+    dirty = []
+    for path, st, oid in _parallel_map(check, paths, jobs):
+        if st is None:
+            continue
+        if oid is not None and oid == entries.get(path):
+            current[path] = st
+        elif oid != index.get(path):
+            dirty.append(path)
+    if dirty:
+        raise Exception('Local changes would be overwritten: ' +
+                        ', '.join(dirty))
+    return current
+
+
+@trace.traced('worktree.checkout')
+def _checkout_index(index, changed, removed, jobs=None):
+    for path in removed:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        _prune_empty_dirs(os.path.dirname(path))
+
+    # create directories up front, parents sort before their children, so
+    # the writers never race on creating the same directory
+    for dirname in sorted({os.path.dirname(path) for path in changed}):
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def write_file(entry):
+        path, oid = entry
         with open(path, 'wb') as f:
-            f.write(data.get_object(oid, 'blob'))
+            for chunk in data.stream_object(oid, 'blob'):
+                f.write(chunk)
+        return path, oid, os.stat(path)
+
+    entries = [(path, index[path]) for path in changed]
+    # a partial clone gets all missing blobs in one request, not one by one
+    data.fetch_missing_objects(oid for _, oid in entries)
+    for path, oid, st in _parallel_map(write_file, entries, jobs):
+        index.update_stat(path, oid, st)
+
+
+def _prune_empty_dirs(dirname):
+    while dirname:
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            return
+        dirname = os.path.dirname(dirname)
 
 
 def commit(message):
@@ -138,19 +350,21 @@ def commit(message):
         f'\n{message}\n'
     ])
 
+    oid = data.hash_object(commit.encode(), 'commit')
+    # the commit-graph is updated first, HEAD isn't moved if it fails
+    write_commit_graph({oid})
+    data.update_ref('HEAD', data.RefValue(False, oid))
+
     # then delete merge head
     if MERGE_HEAD:
         data.delete_ref('MERGE_HEAD', deref=False)
-
-    oid = data.hash_object(commit.encode(), 'commit')
-    data.update_ref('HEAD', data.RefValue(False, oid))
     return oid
 
 
-def checkout(name):
+def checkout(name, jobs=None):
     oid = get_oid(name)
     commit = get_commit(oid)
-    read_tree(commit.tree, update_working=True)
+    read_tree(commit.tree, update_working=True, jobs=jobs)
 
     if is_branch(name):
         HEAD = data.RefValue(symbolic=True, value=f'refs/heads/{name}')
@@ -182,7 +396,7 @@ def reset(oid):
     data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid))
 
 
-def merge(other):
+def merge(other, jobs=None):
     HEAD = data.get_ref('HEAD').value
     assert HEAD
     merge_base = get_merge_base(other, HEAD)
@@ -190,7 +404,7 @@ def merge(other):
 
     # fast-forward merge
     if merge_base == HEAD:
-        read_tree(c_other.tree, update_working=True)
+        read_tree(c_other.tree, update_working=True, jobs=jobs)
         data.update_ref('HEAD', data.RefValue(symbolic=False, value=other))
         print('Fast-forward merge, no need to commit')
         return
@@ -200,20 +414,45 @@ def merge(other):
     c_HEAD = get_commit(HEAD)
 
     read_tree_merged(c_base.tree, c_HEAD.tree,
-                     c_other.tree, update_workding=True)
+                     c_other.tree, update_workding=True, jobs=jobs)
     print('Merged in working tree\nPlease commit to continue')
 
 
+@trace.traced('commit.merge_base')
 def get_merge_base(oid1, oid2):
-    parents1 = set(iter_commits_and_parents({oid1}))
-
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents1:
+    # walk both histories at once, always taking the commit with the highest
+    # generation next. All descendants of a commit are visited before it, so
+    # the first commit reached from both sides is a best common ancestor.
+    flags = {oid1: 1}
+    flags[oid2] = flags.get(oid2, 0) | 2
+    queue = [(-get_generation(oid1), oid1), (-get_generation(oid2), oid2)]
+    while queue:
+        _, oid = heapq.heappop(queue)
+        flag = flags[oid]
+        if flag == 3:
             return oid
+        for parent in get_parents(oid):
+            if flags.get(parent, 0) | flag != flags.get(parent, 0):
+                flags[parent] = flags.get(parent, 0) | flag
+                heapq.heappush(queue, (-get_generation(parent), parent))
 
 
 def is_ancestor_of(commit, maybe_ancester):
-    return maybe_ancester in iter_commits_and_parents({commit})
+    if not maybe_ancester or not data.object_exists(maybe_ancester):
+        return False
+    # commits with a lower generation can't have maybe_ancester as ancestor
+    min_generation = get_generation(maybe_ancester)
+    oids = [commit]
+    visited = set()
+    while oids:
+        oid = oids.pop()
+        if oid == maybe_ancester:
+            return True
+        if oid in visited or get_generation(oid) <= min_generation:
+            continue
+        visited.add(oid)
+        oids.extend(get_parents(oid))
+    return False
 
 
 def create_tag(name, oid):
@@ -228,20 +467,109 @@ Commit = namedtuple('Commit', ['tree', 'parents', 'message'])
 
 
 def get_commit(oid):
+    key = ('commit', data.GIT_DIR, oid)
+    commit = parsed_cache.get(key)
+    if commit is None:
+        raw = data.get_object(oid, 'commit')
+        with trace.span('commit.parse') as span:
+            span.size = len(raw)
+            commit = _parse_commit(raw.decode())
+        parsed_cache.put(key, commit, len(raw))
+    return commit
+
+
+def _commit_tree(value):
+    '''Tree oid of a commit, None for an empty tree. Commits written before
+    write_tree returned its oid record 'None', their tree is taken as empty
+    so old repositories keep working.'''
+    return None if value == 'None' else value
+
+
+def _parse_commit(commit):
     parents = []
 
-    commit = data.get_object(oid, 'commit').decode()
     lines = iter(commit.splitlines())
     for line in itertools.takewhile(operator.truth, lines):
         k, v = line.split(' ', 1)
         if k == 'tree':
-            tree = v
+            tree = _commit_tree(v)
         elif k == 'parent':
             parents.append(v)
         else:
             raise Exception(f'Unknown field {k}')
     message = '\n'.join(lines)
-    return Commit(tree=tree, parents=parents, message=message)
+    return Commit(tree=tree, parents=tuple(parents), message=message)
+
+
+# commits asked about at once when looking for common commits
+NEGOTIATION_BATCH = 32
+# commits of every this many generations get a reachability bitmap
+BITMAP_INTERVAL = 100
+
+# (git dir, oid) -> generation number
+_generations = {}
+
+
+def get_parents(oid):
+    '''Parents of a commit, from the commit-graph if it is there.'''
+    graph = data.get_commit_graph()
+    entry = graph and graph.get(oid)
+    if entry:
+        return entry[1]
+    return get_commit(oid).parents
+
+
+def get_generation(oid):
+    '''Generation number of a commit, computed for commits that aren't in
+    the commit-graph yet.'''
+    graph = data.get_commit_graph()
+    stack = [oid]
+    while stack:
+        current = stack[-1]
+        if (data.GIT_DIR, current) in _generations:
+            stack.pop()
+            continue
+        entry = graph and graph.get(current)
+        if entry:
+            _generations[data.GIT_DIR, current] = entry[2]
+            stack.pop()
+            continue
+        parents = get_commit(current).parents
+        missing = [p for p in parents if (data.GIT_DIR, p) not in _generations]
+        if missing:
+            stack.extend(missing)
+            continue
+        stack.pop()
+        _generations[data.GIT_DIR, current] = 1 + max(
+            (_generations[data.GIT_DIR, p] for p in parents), default=0)
+    return _generations[data.GIT_DIR, oid]
+
+
+@trace.traced('commit_graph.write')
+def write_commit_graph(tips=None, full=False):
+    '''Add the commits reachable from tips (all refs by default) to the
+    commit-graph. Commits already in the graph aren't parsed again, the new
+    ones are added as a layer on top of it. With full the whole graph is
+    written again as one file.'''
+    graph = data.get_commit_graph()
+    commits = {}
+    if full and graph:
+        commits = {oid: entry[:2] for oid, entry in graph.items()}
+    if tips is None:
+        tips = {ref.value for _, ref in data.iter_refs()}
+
+    oids = list(tips)
+    while oids:
+        oid = oids.pop()
+        if not oid or oid in commits or (graph and oid in graph):
+            continue
+        commit = get_commit(oid)
+        commits[oid] = (commit.tree, commit.parents)
+        oids.extend(commit.parents)
+    if full:
+        data.write_commit_graph(commits)
+    elif commits:
+        data.add_commit_graph_layer(commits)
 
 
 def iter_commits_and_parents(oids):
@@ -254,9 +582,9 @@ def iter_commits_and_parents(oids):
             continue
         visited.add(oid)
         yield oid
-        commit = get_commit(oid)
-        oids.extendleft(commit.parents[:1])
-        oids.extend(commit.parents[1:])
+        parents = get_parents(oid)
+        oids.extendleft(parents[:1])
+        oids.extend(parents[1:])
 
 
 def iter_objects_in_commits(oids):
@@ -277,10 +605,329 @@ def iter_objects_in_commits(oids):
     for oid in iter_commits_and_parents(oids):
         yield oid
         commit = get_commit(oid)
-        if commit.tree not in visited:
+        if commit.tree and commit.tree not in visited:
             yield from _iter_objects_in_tree(commit.tree)
 
 
+@trace.traced('remote.negotiate')
+def find_common(tips, has_commits):
+    '''Commits reachable from tips that the other side has.
+
+    has_commits(oids) returns the ones of a batch of commits the other side
+    has. The walk doesn't go past them, so it only visits the commits the
+    other side is missing and the boundary to the ones it has.
+    '''
+    common = set()
+    visited = set()
+    queue = [(-get_generation(oid), oid) for oid in set(tips) if oid]
+    heapq.heapify(queue)
+    while queue:
+        batch = []
+        while queue and len(batch) < NEGOTIATION_BATCH:
+            _, oid = heapq.heappop(queue)
+            if oid not in visited:
+                visited.add(oid)
+                batch.append(oid)
+        known = has_commits(batch) if batch else set()
+        common.update(known)
+        for oid in batch:
+            if oid in known:
+                continue
+            for parent in get_parents(oid):
+                heapq.heappush(queue, (-get_generation(parent), parent))
+    return common
+
+
+def iter_commits_between(wants, haves):
+    '''Commits reachable from wants but not from haves, newest first.
+
+    Both sides are walked at once in generation order, like in
+    get_merge_base, and the walk stops when only commits reachable from
+    haves are left in the queue.
+    '''
+    flags = {}
+    for oid in wants:
+        flags[oid] = 1
+    for oid in haves:
+        flags[oid] = flags.get(oid, 0) | 2
+    queue = [(-get_generation(oid), oid) for oid in flags]
+    heapq.heapify(queue)
+    interesting = {oid for oid, flag in flags.items() if flag == 1}
+    done = set()
+    while interesting:
+        _, oid = heapq.heappop(queue)
+        if oid in done:
+            continue
+        done.add(oid)
+        interesting.discard(oid)
+        flag = flags[oid]
+        if flag == 1:
+            yield oid
+        for parent in get_parents(oid):
+            old_flag = flags.get(parent, 0)
+            if old_flag | flag == old_flag:
+                continue
+            flags[parent] = old_flag | flag
+            if flags[parent] == 1:
+                interesting.add(parent)
+            else:
+                interesting.discard(parent)
+            heapq.heappush(queue, (-get_generation(parent), parent))
+
+
+def iter_objects_between(wants, haves, name_hints=None, blobs=True):
+    '''Objects reachable from wants but not from haves.
+
+    Every new commit's tree is compared with the trees of its parents, which
+    the other side either has or gets too, so only the objects that changed
+    in the new commits are visited. If name_hints is given, it gets the
+    names of the new objects and of the objects they replace at the same
+    path, which are good delta bases. Without blobs, only commits and trees
+    are returned, for partial clones.
+    '''
+    if blobs and _prefer_bitmaps(wants, haves):
+        objects = _objects_between_with_bitmaps(wants, haves, name_hints)
+        if objects is not None:
+            yield from objects
+            return
+
+    visited = set()
+    for oid in iter_commits_between(wants, haves):
+        yield oid
+        parent_trees = {get_commit(parent).tree
+                        for parent in get_parents(oid)}
+        yield from _iter_new_tree_objects(
+            get_commit(oid).tree, parent_trees, visited, name_hints, '',
+            blobs)
+
+
+def _prefer_bitmaps(wants, haves):
+    '''Bitmaps pay off for a long history between wants and haves, a
+    short one is walked faster than the walk down to the nearest bitmap.'''
+    if not haves:
+        return True
+    return (max(map(get_generation, wants), default=0) -
+            max(map(get_generation, haves)) > BITMAP_INTERVAL)
+
+
+def _objects_between_with_bitmaps(wants, haves, name_hints=None):
+    '''Objects reachable from wants but not from haves as a list, or None
+    if there are no bitmaps.
+
+    Bitmaps only have hashes of the names of objects. If name_hints is
+    given, it gets them as names, and the objects of the trees of haves
+    with the same name hashes as delta bases.
+    '''
+    bitmaps = data.get_bitmaps()
+    if not bitmaps:
+        return None
+    pack, bitmaps = bitmaps
+    want_bits, want_extra = _reachable_bits(wants, pack, bitmaps)
+    have_bits, have_extra = _reachable_bits(haves, pack, bitmaps)
+    bits = want_bits & ~have_bits
+    objects = []
+    for position in _iter_bits(bits):
+        oid = pack.oid_at(position)
+        objects.append(oid)
+        name = bitmaps.name_hash(position)
+        if name_hints is not None and name:
+            name_hints[oid] = f'{name:08x}'
+    objects.extend(want_extra - have_extra)
+    if name_hints and haves:
+        _hint_bases(haves, set(name_hints.values()), set(objects),
+                    name_hints)
+    return objects
+
+
+def _hint_bases(haves, names, objects, name_hints):
+    '''Add the objects of the trees of haves whose name hashes are in
+    names to name_hints, unless they are in objects. These are the delta
+    bases of a thin pack, one version of every path like the walk finds.'''
+    visited = set()
+    stack = [get_commit(oid).tree for oid in haves]
+    while stack:
+        tree = stack.pop()
+        if not tree or tree in visited:
+            continue
+        visited.add(tree)
+        for type_, oid, name in _iter_tree_entries(tree):
+            if type_ == 'tree':
+                stack.append(oid)
+            name = f'{bitmap.name_hash(name):08x}'
+            if name in names and oid not in objects:
+                name_hints.setdefault(oid, name)
+
+
+def _reachable_bits(tips, pack, bitmaps):
+    '''Objects reachable from tips as (bitmap over the positions in pack,
+    set of objects that aren't in pack).
+
+    The walk stops at commits with a bitmap, commits without one add
+    themselves and the objects their trees changed.
+    '''
+    bits = 0
+    # objects reachable from the bitmaps found so far
+    covered = 0
+    extra = set()
+    visited = set()
+    stack = list(tips)
+    while stack:
+        oid = stack.pop()
+        if not oid or oid in visited:
+            continue
+        visited.add(oid)
+        position = pack.position(oid)
+        if position is not None and covered >> position & 1:
+            continue
+        commit_bits = bitmaps.get(oid)
+        if commit_bits is not None:
+            covered |= commit_bits
+            continue
+
+        parents = get_parents(oid)
+        parent_trees = {get_commit(parent).tree for parent in parents}
+        for obj in itertools.chain([oid], _iter_new_tree_objects(
+                get_commit(oid).tree, parent_trees, set(), None, '')):
+            position = pack.position(obj)
+            if position is None:
+                extra.add(obj)
+            else:
+                bits |= 1 << position
+        stack.extend(parents)
+    return bits | covered, extra
+
+
+def _iter_bits(bits):
+    '''Positions of the set bits of an int.'''
+    raw = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for i, byte in enumerate(raw):
+        while byte:
+            low = byte & -byte
+            yield i * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+def _positions_to_bits(positions):
+    raw = bytearray()
+    for position in positions:
+        index = position >> 3
+        if index >= len(raw):
+            raw.extend(bytes(index + 1 - len(raw)))
+        raw[index] |= 1 << (position & 7)
+    return int.from_bytes(raw, 'little')
+
+
+@trace.traced('bitmap.write')
+def write_bitmaps(tips, pack_path, name_hints=None):
+    '''Write reachability bitmaps of tips and of the commits of every
+    BITMAP_INTERVAL-th generation for the pack at pack_path, with the names
+    of its objects in name_hints.
+
+    Commits are visited parents first, the bitmap of a commit is the union
+    of its parents' bitmaps and the objects its tree changed. Bitmaps are
+    only kept until all children of a commit were visited.
+    '''
+    pack = data.get_pack(pack_path)
+    tips = {oid for oid in tips if oid}
+    commits = sorted(iter_commits_and_parents(tips), key=get_generation)
+    children = Counter(
+        parent for oid in commits for parent in get_parents(oid))
+
+    pending = {}
+    selected = {}
+    for oid in commits:
+        parents = get_parents(oid)
+        parent_trees = {get_commit(parent).tree for parent in parents}
+        positions = []
+        for obj in itertools.chain([oid], _iter_new_tree_objects(
+                get_commit(oid).tree, parent_trees, set(), None, '')):
+            position = pack.position(obj)
+            # everything reachable must be in the pack, which isn't the
+            # case in a partial clone
+            if position is None:
+                return 0
+            positions.append(position)
+
+        bits = _positions_to_bits(positions)
+        for parent in parents:
+            bits |= pending[parent]
+            children[parent] -= 1
+            if not children[parent]:
+                del pending[parent]
+        if children[oid]:
+            pending[oid] = bits
+        if oid in tips or get_generation(oid) % BITMAP_INTERVAL == 0:
+            selected[oid] = bits
+
+    data.write_bitmaps(pack_path, selected, name_hints or {})
+    return len(selected)
+
+
+def _iter_new_tree_objects(oid, base_oids, visited, name_hints, name,
+                           blobs=True):
+    '''Objects of a tree that aren't in the trees at the same path in
+    base_oids. Subtrees that are in a base tree aren't read.'''
+    if not oid or oid in base_oids or oid in visited:
+        return
+    visited.add(oid)
+    if name_hints is not None:
+        name_hints[oid] = name
+        name_hints.update(dict.fromkeys(base_oids, name))
+    yield oid
+    base_entries = [{name: (type_, entry_oid)
+                     for type_, entry_oid, name in _iter_tree_entries(base)}
+                    for base in base_oids]
+    for type_, entry_oid, name in _iter_tree_entries(oid):
+        entry_bases = {entries[name][1] for entries in base_entries
+                       if entries.get(name, (None,))[0] == type_}
+        if type_ == 'tree':
+            yield from _iter_new_tree_objects(
+                entry_oid, entry_bases, visited, name_hints, name, blobs)
+        elif (blobs and entry_oid not in entry_bases and
+              entry_oid not in visited):
+            visited.add(entry_oid)
+            if name_hints is not None:
+                name_hints[entry_oid] = name
+                name_hints.update(dict.fromkeys(entry_bases, name))
+            yield entry_oid
+
+
+def repack(prune=False):
+    '''Pack all objects, using the paths of reachable objects as hints.
+
+    With prune, objects that aren't reachable from refs or the index are
+    dropped.
+    '''
+    name_hints = {}
+
+    def collect_hints(oid):
+        for type_, oid, name in _iter_tree_entries(oid):
+            if oid in name_hints:
+                continue
+            name_hints[oid] = name
+            if type_ == 'tree':
+                collect_hints(oid)
+
+    tips = {ref.value for _, ref in data.iter_refs()}
+    for oid in iter_commits_and_parents(tips):
+        collect_hints(get_commit(oid).tree)
+
+    keep = None
+    if prune:
+        keep = set(iter_objects_between(tips, ()))
+        with data.get_index() as index:
+            keep.update(index.values())
+            keep.update(index.trees.values())
+            # blobs of changed working files the fsmonitor state refers to
+            if index.fsmonitor:
+                keep.update(filter(None, index.fsmonitor.worktree.values()))
+
+    pack_path, count = data.repack(name_hints, keep)
+    write_commit_graph(tips, full=True)
+    write_bitmaps(tips, pack_path, name_hints)
+    return pack_path, count
+
+
 def get_oid(name):
     # alias @ as HEAD
     if name == '@':
@@ -305,27 +952,44 @@ def get_oid(name):
     raise Exception(f'Unknown name {name}')
 
 
-def add(filenames):
-    def add_file(filename):
-        filename = os.path.relpath(filename)
-        with open(filename, 'rb') as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
-
-    def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                path = os.path.relpath(os.path.join(root, filename))
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
-
-    with data.get_index() as index:
+@trace.traced('index.add')
+def add(filenames, jobs=None):
+    def iter_paths():
         for filename in filenames:
             if os.path.isfile(filename):
-                add_file(filename)
+                yield os.path.relpath(filename)
             elif os.path.isdir(filename):
-                add_directory(filename)
+                yield from _iter_files(filename)
+
+    with data.get_index() as index:
+        if _monitor:
+            _add_monitored(index, filenames, jobs)
+            return
+        for path, oid, st in _hash_files(iter_paths(), index, jobs):
+            index.update_stat(path, oid, st)
+
+
+def _add_monitored(index, filenames, jobs=None):
+    # only files that differ from the index are staged, the fsmonitor
+    # tells which ones may differ
+    stats = {}
+    worktree = _scan_working_tree(index, jobs, stats)
+    prefixes = tuple(f'{os.path.relpath(filename)}/'
+                     for filename in filenames)
+    files = {os.path.relpath(filename) for filename in filenames}
+    if '.' in files:
+        prefixes = ('',)
+    paths = [path for path, oid in worktree.items()
+             if index.get(path) != oid and
+             (path in files or path.startswith(prefixes))]
+    # the stat data has to be older than the content it vouches for, files
+    # the fsmonitor didn't report were not looked at and are hashed again
+    for path, oid, st in itertools.chain(
+            ((path, worktree[path], stats[path])
+             for path in paths if path in stats),
+            _hash_files([path for path in paths if path not in stats],
+                        index, jobs)):
+        index.update_stat(path, oid, st)
 
 
 def is_ignored(path):
@@ -0,0 +1,102 @@
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+
+BITMAP_SIGNATURE = b'UBMP'
+BITMAP_VERSION = 2
+
+# signature, version, checksum of the pack, number of bitmaps
+HEADER = struct.Struct('>4sI20sI')
+# commit, size of the compressed bitmap that follows
+ENTRY = struct.Struct('>20sI')
+# hash of the name of the object at a position of the pack index
+NAME_HASH = struct.Struct('>I')
+CHECKSUM_SIZE = 20
+
+
+def bitmap_path(pack_path):
+    return pack_path[:-len('.pack')] + '.bitmap'
+
+
+def name_hash(name):
+    '''Hash of the name an object was found under, 0 for no name.'''
+    return zlib.crc32(name.encode())
+
+
+class Bitmaps:
+    '''Reachability bitmaps of selected commits of a pack.
+
+    Bit i of the bitmap of a commit is set if the object at position i of
+    the pack index is reachable from the commit. A bitmap is only written
+    if everything reachable from its commit is in the pack.
+
+    The bitmaps are followed by the hash of the name of every object of the
+    pack, by position, so objects found with bitmaps still have a name to
+    look for delta bases with. Version 1 files have no names.
+    '''
+
+    def __init__(self, path, pack_checksum):
+        with open(path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, checksum, count = HEADER.unpack_from(
+            self._buffer, 0)
+        if signature != BITMAP_SIGNATURE or version not in (1, 2):
+            raise Exception(f'Unknown bitmap format {signature} {version}')
+        if checksum != pack_checksum:
+            raise Exception(f'Bitmap {path} belongs to another pack')
+
+        # commit -> (offset, size) of its compressed bitmap
+        self._entries = {}
+        offset = HEADER.size
+        for _ in range(count):
+            oid, size = ENTRY.unpack_from(self._buffer, offset)
+            offset += ENTRY.size
+            self._entries[oid.hex()] = (offset, size)
+            offset += size
+        # offset of the name hashes
+        self._names = offset if version >= 2 else None
+
+    def __contains__(self, oid):
+        return oid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, oid):
+        '''Bitmap of a commit as an int, or None if it has none.'''
+        entry = self._entries.get(oid)
+        if not entry:
+            return None
+        offset, size = entry
+        return int.from_bytes(
+            zlib.decompress(self._buffer[offset:offset + size]), 'little')
+
+    def name_hash(self, position):
+        '''Hash of the name of the object at position, 0 if unknown.'''
+        if self._names is None:
+            return 0
+        return NAME_HASH.unpack_from(
+            self._buffer, self._names + position * NAME_HASH.size)[0]
+
+
+def write_bitmaps(path, pack_checksum, bitmaps, name_hashes):
+    '''Write bitmaps, a dict of commit oid -> bitmap as an int, and the
+    name hashes of the objects of the pack by position.'''
+    parts = [HEADER.pack(BITMAP_SIGNATURE, BITMAP_VERSION, pack_checksum,
+                         len(bitmaps))]
+    for oid in sorted(bitmaps):
+        bits = bitmaps[oid]
+        compressed = zlib.compress(
+            bits.to_bytes((bits.bit_length() + 7) // 8, 'little'))
+        parts.append(ENTRY.pack(bytes.fromhex(oid), len(compressed)))
+        parts.append(compressed)
+    parts.append(struct.pack(f'>{len(name_hashes)}I', *name_hashes))
+    content = b''.join(parts)
+    content += hashlib.sha1(content).digest()
+
+    tmp_path = f'{path}.lock'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
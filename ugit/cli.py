@@ -3,110 +3,215 @@ from itertools import starmap
 import sys
 import os
 import textwrap
-from graphviz import Digraph
 
 from . import base  # pylint: disable=relative-beyond-top-level
+from . import client  # pylint: disable=relative-beyond-top-level
 from . import data  # pylint: disable=relative-beyond-top-level
 from . import diff  # pylint: disable=relative-beyond-top-level
+from . import linediff  # pylint: disable=relative-beyond-top-level
+from . import protocol  # pylint: disable=relative-beyond-top-level
 from . import remote  # pylint: disable=relative-beyond-top-level
+from . import trace  # pylint: disable=relative-beyond-top-level
+
+# Dependencies of a single command, like graphviz for k and asyncio for
+# serve, are imported by that command to keep the start up fast.
 
 
 def main():
     with data.change_git_dir('.'):
-        args = parse_args()
+        run(sys.argv[1:])
+
+
+def run(argv):
+    args = parse_args(argv)
+    if args.trace or args.trace_file:
+        trace.enable(args.trace_file)
+    with trace.span(f'command.{args.command}'):
         args.func(args)
 
 
-def parse_args():
+class _UnusedParser:
+    '''Stands in for the parser of a command that doesn't run.'''
+
+    def add_argument(self, *args, **kwargs):
+        pass
+
+    def set_defaults(self, **kwargs):
+        pass
+
+
+def parse_args(argv):
+    # only the parser of the command that runs is built, all of them for
+    # help and unknown commands
+    name = client.command_name(argv)
+    parser = _build_parser(name)
+    if name and not parser.known_command:
+        parser = _build_parser(None)
+    return parser.parse_args(argv)
+
+
+def _build_parser(name):
     parser = argparse.ArgumentParser()
+    parser.known_command = False
+    parser.add_argument('--trace', action='store_true',
+                        help='print where the command spent its time')
+    parser.add_argument('--trace-file', metavar='PATH',
+                        help='also write a Chrome trace of the command')
 
     commands = parser.add_subparsers(dest='command')
     commands.required = True
 
+    def add_command(command):
+        if name not in (None, command):
+            return _UnusedParser()
+        parser.known_command = True
+        return commands.add_parser(command)
+
     oid = base.get_oid
 
-    init_parser = commands.add_parser('init')
+    init_parser = add_command('init')
     init_parser.set_defaults(func=init)
 
-    hash_object_parser = commands.add_parser('hash-object')
+    hash_object_parser = add_command('hash-object')
     hash_object_parser.set_defaults(func=hash_object)
     hash_object_parser.add_argument('file')
 
-    cat_file_object_parser = commands.add_parser('cat-file')
+    cat_file_object_parser = add_command('cat-file')
     cat_file_object_parser.set_defaults(func=cat_file)
     cat_file_object_parser.add_argument('object', type=oid)
 
-    write_tree_object_parser = commands.add_parser('write-tree')
+    write_tree_object_parser = add_command('write-tree')
     write_tree_object_parser.set_defaults(func=write_tree)
 
-    read_tree_object_parser = commands.add_parser('read-tree')
+    read_tree_object_parser = add_command('read-tree')
     read_tree_object_parser.set_defaults(func=read_tree)
     read_tree_object_parser.add_argument('tree', type=oid)
 
-    commit_object_parser = commands.add_parser('commit')
+    commit_object_parser = add_command('commit')
     commit_object_parser.set_defaults(func=commit)
     commit_object_parser.add_argument('-m', '--message', required=True)
 
-    log_parser = commands.add_parser('log')
+    log_parser = add_command('log')
     log_parser.set_defaults(func=log)
     log_parser.add_argument('oid', default='@', type=oid, nargs='?')
 
-    show_parser = commands.add_parser('show')
+    show_parser = add_command('show')
     show_parser.set_defaults(func=show)
     show_parser.add_argument('oid', default='@', type=oid, nargs='?')
+    _add_diff_options(show_parser)
 
-    diff_parser = commands.add_parser('diff')
+    diff_parser = add_command('diff')
     diff_parser.set_defaults(func=_diff)
     diff_parser.add_argument('--cached', action='store_true')
     diff_parser.add_argument('commit', nargs='?')
+    diff_parser.add_argument('-j', '--jobs', type=int)
+    _add_diff_options(diff_parser)
 
-    checkout_parser = commands.add_parser('checkout')
+    checkout_parser = add_command('checkout')
     checkout_parser.set_defaults(func=checkout)
     checkout_parser.add_argument('commit')
+    checkout_parser.add_argument('-j', '--jobs', type=int)
 
-    tag_parser = commands.add_parser('tag')
+    tag_parser = add_command('tag')
     tag_parser.set_defaults(func=tag)
     tag_parser.add_argument('name')
     tag_parser.add_argument('oid', default='@', type=oid, nargs='?')
 
-    branch_parser = commands.add_parser('branch')
+    branch_parser = add_command('branch')
     branch_parser.set_defaults(func=branch)
     branch_parser.add_argument('name', nargs='?')
     branch_parser.add_argument('start_point', default='@', type=oid, nargs='?')
 
-    k_parser = commands.add_parser('k')
+    k_parser = add_command('k')
     k_parser.set_defaults(func=k)
 
-    status_parser = commands.add_parser('status')
+    status_parser = add_command('status')
     status_parser.set_defaults(func=status)
+    status_parser.add_argument('-j', '--jobs', type=int)
+    _add_rename_options(status_parser)
 
-    reset_parser = commands.add_parser('reset')
+    reset_parser = add_command('reset')
     reset_parser.set_defaults(func=reset)
     reset_parser.add_argument('commit', type=oid)
 
-    merge_parser = commands.add_parser('merge')
+    merge_parser = add_command('merge')
     merge_parser.set_defaults(func=merge)
     merge_parser.add_argument('commit', type=oid)
+    merge_parser.add_argument('-j', '--jobs', type=int)
 
-    merge_base_parser = commands.add_parser('merge_base')
+    merge_base_parser = add_command('merge_base')
     merge_base_parser.set_defaults(func=merge_base)
     merge_base_parser.add_argument('commit1', type=oid)
     merge_base_parser.add_argument('commit2', type=oid)
 
-    fetch_parser = commands.add_parser('fetch')
+    fetch_parser = add_command('fetch')
     fetch_parser.set_defaults(func=fetch)
     fetch_parser.add_argument('remote')
-
-    push_parser = commands.add_parser('push')
+    fetch_parser.add_argument('--filter', metavar='blob:none',
+                              help='leave out blobs, fetch them on demand')
+
+    clone_parser = add_command('clone')
+    clone_parser.set_defaults(func=clone)
+    clone_parser.add_argument('remote')
+    clone_parser.add_argument('directory', nargs='?')
+    clone_parser.add_argument('--filter', metavar='blob:none',
+                              help='leave out blobs, fetch them on demand')
+    clone_parser.add_argument('-j', '--jobs', type=int)
+
+    push_parser = add_command('push')
     push_parser.set_defaults(func=push)
     push_parser.add_argument('remote')
     push_parser.add_argument('branch')
 
-    add_parser = commands.add_parser('add')
+    serve_parser = add_command('serve')
+    serve_parser.set_defaults(func=serve)
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int,
+                              default=protocol.DEFAULT_PORT)
+    serve_parser.add_argument('--unix', metavar='PATH',
+                              help='listen on a unix socket instead')
+
+    daemon_parser = add_command('daemon')
+    daemon_parser.set_defaults(func=daemon)
+    daemon_parser.add_argument('--stop', action='store_true',
+                               help='stop the daemon of this repository')
+    daemon_parser.add_argument(
+        '--fsmonitor', choices=['auto', 'inotify', 'poll', 'off'],
+        default='auto', help='how to find changed files, auto uses inotify '
+        'where it is available')
+
+    pack_refs_parser = add_command('pack-refs')
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    repack_parser = add_command('repack')
+    repack_parser.set_defaults(func=repack)
+
+    gc_parser = add_command('gc')
+    gc_parser.set_defaults(func=gc)
+
+    add_parser = add_command('add')
     add_parser.set_defaults(func=add)
     add_parser.add_argument('files', nargs='+')
+    add_parser.add_argument('-j', '--jobs', type=int)
+
+    return parser
+
+
+def _add_diff_options(parser):
+    parser.add_argument('-U', '--unified', type=int, default=3,
+                        help='lines of context around changes')
+    parser.add_argument('--diff-algorithm', default='myers',
+                        choices=sorted(linediff.ALGORITHMS))
+    _add_rename_options(parser)
 
-    return parser.parse_args()
+
+def _add_rename_options(parser):
+    parser.add_argument('-M', '--find-renames', type=int, metavar='PERCENT',
+                        default=diff.RENAME_THRESHOLD,
+                        help='minimum similarity of renamed files')
+    parser.add_argument('--no-renames', dest='find_renames',
+                        action='store_const', const=0)
+    parser.add_argument('-C', '--find-copies', action='store_true')
 
 
 def init(args):
@@ -115,13 +220,13 @@ def init(args):
 
 
 def hash_object(args):
-    with open(args.file, 'rb') as f:
-        print(data.hash_object(f.read()))
+    print(data.hash_file(args.file))
 
 
 def cat_file(args):
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object))
+    for chunk in data.stream_object(args.object, expected=None):
+        sys.stdout.buffer.write(chunk)
 
 
 def write_tree(args):
@@ -164,8 +269,9 @@ def show(args):
 
     _print_commit(args.oid, commit)
 
-    result = diff.diff_trees(base.get_tree(
-        parent_tree), base.get_tree(commit.tree))
+    result = diff.diff_trees(parent_tree, commit.tree,
+                             args.unified, args.diff_algorithm,
+                             args.find_renames, args.find_copies)
     print(result)
 
 
@@ -173,24 +279,27 @@ def _diff(args):
     oid = args.commit and base.get_oid(args.commit)
 
     if args.commit:
-        tree_from = base.get_tree(oid and base.get_commit(oid).tree)
+        tree_from = oid and base.get_commit(oid).tree
 
     if args.cached:
+        # subtrees cached in the index that didn't change are skipped
         tree_to = base.get_index_tree()
         if not args.commit:
             oid = base.get_oid('@')
-            tree_from = base.get_tree(oid and base.get_commit(oid).tree)
+            tree_from = oid and base.get_commit(oid).tree
     else:
-        tree_to = base.get_working_tree()
+        tree_to = base.get_working_tree(jobs=args.jobs)
         if not args.commit:
             tree_from = base.get_index_tree()
 
-    result = diff.diff_trees(tree_from, tree_to)
+    result = diff.diff_trees(tree_from, tree_to,
+                             args.unified, args.diff_algorithm,
+                             args.find_renames, args.find_copies)
     print(result)
 
 
 def checkout(args):
-    base.checkout(args.commit)
+    base.checkout(args.commit, jobs=args.jobs)
 
 
 def tag(args):
@@ -210,6 +319,7 @@ def branch(args):
 
 
 def k(args):
+    from graphviz import Digraph  # pylint: disable=import-outside-toplevel
     dot = Digraph(comment='digraph commits')
     oids = set()
     for refname, ref in data.iter_refs():
@@ -241,20 +351,23 @@ def status(args):
         print(f'Merging with {MERGE_HEAD[:10]}')
 
     head_printed = False
-    # TODO: fix head_tree is none after add files
     HEAD_tree = HEAD and base.get_commit(HEAD).tree
-    print(HEAD, base.get_commit(HEAD).tree)
-    print(base.get_tree(HEAD_tree))
-    for path, action in diff.iter_changed_files(base.get_tree(HEAD_tree), base.get_index_tree()):
+    # subtrees cached in the index that didn't change are skipped
+    for path, action in diff.iter_changed_files(
+            HEAD_tree, base.get_index_tree(), args.find_renames,
+            args.find_copies):
         if not head_printed:
             print('\nChanges to be commited:\n')
             head_printed = True
         print(f'{action:>12}: {path}')
 
     no_change_head_printed = False
-    for path, action in diff.iter_changed_files(base.get_index_tree(), base.get_working_tree()):
+    for path, action in diff.iter_changed_files(
+            base.get_index_tree(), base.get_working_tree(jobs=args.jobs),
+            args.find_renames, args.find_copies):
         if not no_change_head_printed:
             print('\nChanges not staged for commit:\n')
+            no_change_head_printed = True
         print(f'{action:>12}: {path}')
 
     if not head_printed:
@@ -267,7 +380,7 @@ def reset(args):
 
 
 def merge(args):
-    base.merge(args.commit)
+    base.merge(args.commit, jobs=args.jobs)
 
 
 def merge_base(args):
@@ -275,12 +388,55 @@ def merge_base(args):
 
 
 def fetch(args):
-    remote.fetch(args.remote)
+    remote.fetch(args.remote, args.filter)
+
+
+def clone(args):
+    remote.clone(args.remote, args.directory, args.filter, args.jobs)
 
 
 def push(args):
     remote.push(args.remote, os.path.join('refs', 'heads', args.branch))
 
 
+def serve(args):
+    import asyncio  # pylint: disable=import-outside-toplevel
+    from . import server  # pylint: disable=import-outside-toplevel,relative-beyond-top-level
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix,
+                                 lambda address: print(f'Serving {address}',
+                                                       flush=True)))
+    except KeyboardInterrupt:
+        pass
+
+
+def daemon(args):
+    from . import daemon as _daemon  # pylint: disable=import-outside-toplevel,relative-beyond-top-level
+    if args.stop:
+        if not _daemon.stop():
+            print('No daemon is running')
+        return
+    try:
+        _daemon.serve(lambda path: print(f'Daemon listening on {path}',
+                                         flush=True), args.fsmonitor)
+    except KeyboardInterrupt:
+        pass
+
+
 def add(args):
-    base.add(args.files)
+    base.add(args.files, jobs=args.jobs)
+
+
+def repack(args):
+    pack_path, count = base.repack()
+    print(f'Packed {count} objects into {os.path.basename(pack_path)}')
+
+
+def gc(args):
+    pack_path, count = base.repack(prune=True)
+    print(f'Packed {count} reachable objects into '
+          f'{os.path.basename(pack_path)}')
+
+
+def pack_refs(args):
+    print(f'Packed {data.pack_refs()} refs')
@@ -0,0 +1,105 @@
+'''Entry point of ugit, forwards commands to the daemon when it is running.
+
+This module is imported for every command, so it only imports what the
+forwarding needs. The rest of ugit is imported if the command runs here.
+'''
+import os
+import sys
+import socket
+
+from . import protocol  # pylint: disable=relative-beyond-top-level
+
+SOCKET_NAME = 'daemon.sock'
+
+# bands of the frames the daemon answers with
+STDOUT = b'\x01'
+STDERR = b'\x02'
+EXIT = b'\x03'
+
+# global options that take a value, before the command
+OPTIONS_WITH_VALUE = {'--trace-file'}
+
+# commands that need the environment of the client, or start a process
+LOCAL_COMMANDS = {'init', 'clone', 'k', 'serve', 'daemon'}
+
+
+def socket_path():
+    return os.path.join('.ugit', SOCKET_NAME)
+
+
+def command_name(argv):
+    '''Name of the command in argv, or None before a help option.'''
+    args = iter(argv)
+    for arg in args:
+        if arg in ('-h', '--help'):
+            return None
+        if arg in OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
+def _should_forward(argv):
+    if not os.path.exists(socket_path()):
+        return False
+    if command_name(argv) in LOCAL_COMMANDS:
+        return False
+    # a trace is reported by the process that runs the command
+    if os.environ.get('UGIT_TRACE', '0') not in ('', '0') or \
+            os.environ.get('UGIT_TRACE_FILE'):
+        return False
+    return not any(arg == '--trace' or arg.startswith('--trace-file')
+                   for arg in argv)
+
+
+def connect():
+    '''Socket connected to the daemon of the repository, or None.'''
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(socket_path())
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def send_request(sock, request, argv=()):
+    sock.sendall(b''.join(protocol.encode_frame(message)
+                          for message in (request, *argv, b'')))
+
+
+def forward(argv):
+    '''Run argv in the daemon. Return its exit code, or None if no daemon
+    is running.'''
+    if not _should_forward(argv):
+        return None
+    sock = connect()
+    if not sock:
+        return None
+
+    with sock, sock.makefile('rb') as reader:
+        send_request(sock, 'run', argv)
+        outputs = {STDOUT: sys.stdout.buffer, STDERR: sys.stderr.buffer}
+        while True:
+            frame = protocol.read_frame_sync(reader)
+            if not frame:
+                raise Exception('Connection closed by the daemon')
+            band, payload = frame[:1], frame[1:]
+            if band == EXIT:
+                return int(payload)
+            try:
+                outputs[band].write(payload)
+                outputs[band].flush()
+            except BrokenPipeError:
+                # like ugit log | head, the daemon stops at its next write
+                return 1
+
+
+def main():
+    code = forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+    # only a command that runs here needs the rest of ugit
+    from . import cli  # pylint: disable=import-outside-toplevel,relative-beyond-top-level
+    cli.main()
@@ -0,0 +1,280 @@
+import os
+import mmap
+import struct
+import hashlib
+
+GRAPH_SIGNATURE = b'UCGR'
+GRAPH_VERSION = 1
+
+HEADER = struct.Struct('>4sII')
+FANOUT = struct.Struct('>256I')
+# root tree, first parent, second parent, generation
+COMMIT_DATA = struct.Struct('>20sIII')
+OID_SIZE = 20
+NO_PARENT = 0xffffffff
+
+
+# layers added on top of the commit-graph file are listed in this file
+CHAIN_NAME = 'commit-graph-chain'
+LAYERS_DIR = 'commit-graphs'
+# first line of the chain if there is no commit-graph file below the layers
+NO_BASE = '-'
+# a new layer is merged with the layer below it while it has more than
+# 1/SPLIT_FACTOR of the commits of that layer
+SPLIT_FACTOR = 2
+
+
+class CommitGraph:
+    '''Parents, root tree and generation number of commits without parsing
+    the commit objects.
+
+    The generation of a commit is one more than the largest generation of
+    its parents, so a commit can never be an ancestor of a commit with a
+    smaller generation.
+
+    A graph is a file with the commits of a repack and layers of the
+    commits added since, each layer on top of the graph below it. Positions
+    count the commits of all layers below, so parents in a lower layer are
+    referred to by their position there.
+    '''
+
+    def __init__(self, path, base=None):
+        self.path = path
+        self.base = base
+        with open(path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, self.count = HEADER.unpack_from(self._buffer, 0)
+        if signature != GRAPH_SIGNATURE or version != GRAPH_VERSION:
+            raise Exception(
+                f'Unknown commit-graph format {signature} {version}')
+        self._fanout = FANOUT.unpack_from(self._buffer, HEADER.size)
+        self._oids_start = HEADER.size + FANOUT.size
+        self._data_start = self._oids_start + self.count * OID_SIZE
+        # commits in the layers below, and in this one as well
+        self.offset = base.total if base else 0
+        self.total = self.offset + self.count
+        self.checksum = self._buffer[-OID_SIZE:]
+
+    def _oid_at(self, position):
+        if position < self.offset:
+            return self.base._oid_at(position)
+        start = self._oids_start + (position - self.offset) * OID_SIZE
+        return self._buffer[start:start + OID_SIZE]
+
+    def _find(self, raw):
+        '''Position of a raw oid in this layer, or None.'''
+        lo = self._fanout[raw[0] - 1] if raw[0] else 0
+        hi = self._fanout[raw[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._oid_at(self.offset + mid)
+            if current < raw:
+                lo = mid + 1
+            elif current > raw:
+                hi = mid
+            else:
+                return self.offset + mid
+        return None
+
+    def position(self, oid):
+        raw = bytes.fromhex(oid)
+        graph = self
+        while graph:
+            position = graph._find(raw)
+            if position is not None:
+                return position
+            graph = graph.base
+        return None
+
+    def __contains__(self, oid):
+        return self.position(oid) is not None
+
+    def _data_at(self, position):
+        if position < self.offset:
+            return self.base._data_at(position)
+        tree, *parents, generation = COMMIT_DATA.unpack_from(
+            self._buffer, self._data_start +
+            (position - self.offset) * COMMIT_DATA.size)
+        parents = tuple(self._oid_at(parent).hex()
+                        for parent in parents if parent != NO_PARENT)
+        # commits of old repositories have no tree, see base.get_commit
+        return tree.hex() if any(tree) else None, parents, generation
+
+    def get(self, oid):
+        '''Return (tree, parents, generation) of oid, or None.'''
+        position = self.position(oid)
+        if position is None:
+            return None
+        return self._data_at(position)
+
+    def items(self, layer_only=False):
+        start = self.offset if layer_only else 0
+        for position in range(start, self.total):
+            yield self._oid_at(position).hex(), self._data_at(position)
+
+
+def compute_generations(commits, base=None):
+    '''Generation numbers of commits, a dict of oid -> (tree, parents).
+    Parents that aren't in commits are looked up in the graph base.'''
+    generations = {}
+    for oid in commits:
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+            if current not in commits:
+                generations[current] = base.get(current)[2]
+                stack.pop()
+                continue
+            parents = commits[current][1]
+            missing = [p for p in parents if p not in generations]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            generations[current] = 1 + max(
+                (generations[p] for p in parents), default=0)
+    return generations
+
+
+def _encode_tree(tree):
+    # old repositories recorded 'None' as the tree of commits
+    if not tree or tree == 'None':
+        return bytes(OID_SIZE)
+    return bytes.fromhex(tree)
+
+
+def encode_commit_graph(commits, base=None):
+    '''Encode commits, a dict of oid -> (tree, parents), as a layer on top
+    of the graph base. The parents of commits are in commits or in base.
+
+    Only two parents fit in an entry, commits with more parents (and their
+    descendants) are left out and handled by parsing the commit objects.
+    '''
+    excluded = set()
+    for oid, (_, parents) in commits.items():
+        # a parent that isn't in base was left out of it
+        if len(parents) > 2 or any(
+                parent not in commits and (not base or parent not in base)
+                for parent in parents):
+            excluded.add(oid)
+    if excluded:
+        children = {}
+        for oid, (_, parents) in commits.items():
+            for parent in parents:
+                children.setdefault(parent, []).append(oid)
+        stack = list(excluded)
+        while stack:
+            for child in children.get(stack.pop(), ()):
+                if child not in excluded:
+                    excluded.add(child)
+                    stack.append(child)
+        commits = {oid: value for oid, value in commits.items()
+                   if oid not in excluded}
+
+    generations = compute_generations(commits, base)
+    oids = sorted(commits)
+    offset = base.total if base else 0
+    positions = {oid: offset + i for i, oid in enumerate(oids)}
+
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    parts = [HEADER.pack(GRAPH_SIGNATURE, GRAPH_VERSION, len(oids)),
+             FANOUT.pack(*fanout)]
+    parts.extend(bytes.fromhex(oid) for oid in oids)
+    for oid in oids:
+        tree, parents = commits[oid]
+        parents = [positions[parent] if parent in positions else
+                   base.position(parent) for parent in parents]
+        parents += [NO_PARENT] * (2 - len(parents))
+        parts.append(COMMIT_DATA.pack(
+            _encode_tree(tree), *parents, generations[oid]))
+    content = b''.join(parts)
+    return content + hashlib.sha1(content).digest()
+
+
+def _write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.lock'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def chain_path(path):
+    '''Path of the list of layers on top of the commit-graph at path.'''
+    return os.path.join(os.path.dirname(path), LAYERS_DIR, CHAIN_NAME)
+
+
+def load_commit_graph(path):
+    '''The commit-graph at path with the layers on top of it, or None.'''
+    graph = CommitGraph(path) if os.path.isfile(path) else None
+    try:
+        with open(chain_path(path)) as f:
+            names = f.read().split()
+    except FileNotFoundError:
+        return graph
+    # the layers were added to a commit-graph that was replaced since
+    if not names or names[0] != (graph.checksum.hex() if graph else NO_BASE):
+        return graph
+    for name in names[1:]:
+        try:
+            graph = CommitGraph(os.path.join(
+                os.path.dirname(chain_path(path)), name), graph)
+        except FileNotFoundError:
+            # merged by someone else since the chain was read
+            break
+    return graph
+
+
+def write_commit_graph(path, commits):
+    '''Write commits, a dict of oid -> (tree, parents) closed under parents,
+    as the whole commit-graph. Layers on top of the old one are removed.'''
+    _write_file(path, encode_commit_graph(commits))
+    # the layers don't match the new file anymore, readers ignore them
+    layers_dir = os.path.dirname(chain_path(path))
+    if os.path.isdir(layers_dir):
+        for name in os.listdir(layers_dir):
+            os.remove(os.path.join(layers_dir, name))
+
+
+def add_layer(path, commits, graph):
+    '''Add commits, a dict of oid -> (tree, parents), as a layer on top of
+    graph, the commit-graph at path with its layers.
+
+    The new layer is merged with the layers below while they have less
+    than SPLIT_FACTOR times its commits. So there are few layers, and a
+    commit is rewritten a logarithmic number of times until the next
+    repack writes the whole graph again.
+    '''
+    commits = dict(commits)
+    while graph and graph.path != path and (
+            len(commits) * SPLIT_FACTOR > graph.count):
+        commits.update((oid, entry[:2])
+                       for oid, entry in graph.items(layer_only=True))
+        graph = graph.base
+
+    content = encode_commit_graph(commits, graph)
+    layers_dir = os.path.dirname(chain_path(path))
+    name = f'graph-{content[-OID_SIZE:].hex()}.graph'
+    _write_file(os.path.join(layers_dir, name), content)
+
+    names = [name]
+    layer = graph
+    while layer and layer.path != path:
+        names.append(os.path.basename(layer.path))
+        layer = layer.base
+    names.append(layer.checksum.hex() if layer else NO_BASE)
+    _write_file(chain_path(path), ''.join(
+        f'{name}\n' for name in reversed(names)).encode())
+
+    # merged layers aren't in the chain anymore
+    for old_name in os.listdir(layers_dir):
+        if old_name.endswith('.graph') and old_name not in names:
+            os.remove(os.path.join(layers_dir, old_name))
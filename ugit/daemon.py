@@ -0,0 +1,162 @@
+'''ugit daemon: run commands of one repository in a long lived process.
+
+The object, parsed object and commit-graph caches stay warm between
+commands. Objects never change, the rest is checked against the files it
+was read from before it is used: packs, the commit-graph, bitmaps and the
+index by their stat data in data, refs here before every command.
+Commands run one at a time, like they would from a shell. The daemon
+also runs the fsmonitor, so status, diff and add only look at the files
+that changed.
+'''
+import io
+import os
+import socketserver
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+from . import base  # pylint: disable=relative-beyond-top-level
+from . import cli  # pylint: disable=relative-beyond-top-level
+from . import client  # pylint: disable=relative-beyond-top-level
+from . import data  # pylint: disable=relative-beyond-top-level
+from . import fsmonitor  # pylint: disable=relative-beyond-top-level
+from . import protocol  # pylint: disable=relative-beyond-top-level
+
+
+def serve(ready=None, monitor='auto'):
+    '''Serve the repository in the current directory until stopped. ready
+    is called with the socket path once the daemon listens. monitor is the
+    kind of fsmonitor to run, or 'off'.'''
+    path = client.socket_path()
+    if os.path.exists(path):
+        sock = client.connect()
+        if sock:
+            sock.close()
+            raise Exception(f'A daemon is already running on {path}')
+        # left behind by a daemon that was killed
+        os.remove(path)
+
+    with data.change_git_dir('.'):
+        if monitor != 'off':
+            monitor = fsmonitor.start(
+                monitor, git_dir=os.path.basename(data.GIT_DIR))
+            base.set_monitor(monitor)
+        server = _Server(path, _Handler)
+        try:
+            (ready or print)(path)
+            while not server.stopped:
+                server.handle_request()
+        finally:
+            server.server_close()
+            os.remove(path)
+            if monitor != 'off':
+                base.set_monitor(None)
+                monitor.close()
+
+
+def stop():
+    '''Stop the daemon of the repository, return whether one was running.'''
+    sock = client.connect()
+    if not sock:
+        return False
+    with sock, sock.makefile('rb') as reader:
+        client.send_request(sock, 'stop')
+        protocol.read_frame_sync(reader)
+    return True
+
+
+def _ref_files():
+    '''Stat data of all ref files, to notice refs changed by others.'''
+    paths = [os.path.join(data.GIT_DIR, name)
+             for name in ('HEAD', 'MERGE_HEAD', 'packed-refs')]
+    for root, _, filenames in os.walk(os.path.join(data.GIT_DIR, 'refs')):
+        paths.extend(os.path.join(root, name) for name in filenames)
+    versions = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        versions[path] = (st.st_ino, st.st_mtime_ns, st.st_size)
+    return versions
+
+
+class _Server(socketserver.UnixStreamServer):
+
+    def __init__(self, path, handler):
+        super().__init__(path, handler)
+        self.stopped = False
+        # stat data of the ref files when the ref cache was last valid
+        self.ref_files = None
+
+
+class _FrameWriter(io.RawIOBase):
+    '''File that sends what is written to it as frames of a band.'''
+
+    def __init__(self, sock, band):
+        super().__init__()
+        self._sock = sock
+        self._band = band
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        chunk_size = protocol.MAX_FRAME_SIZE - 1
+        b = bytes(b)
+        for i in range(0, len(b), chunk_size):
+            self._sock.sendall(
+                protocol.encode_frame(self._band + b[i:i + chunk_size]))
+        return len(b)
+
+
+def _text_output(sock, band):
+    return io.TextIOWrapper(io.BufferedWriter(_FrameWriter(sock, band)),
+                            line_buffering=True)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        messages = []
+        while True:
+            frame = protocol.read_frame_sync(self.rfile)
+            if frame is None:
+                return
+            if not frame:
+                break
+            messages.append(frame.decode())
+        request, *argv = messages
+
+        if request == 'stop':
+            self.server.stopped = True
+            self.request.sendall(protocol.encode_frame(b''))
+            return
+
+        try:
+            code = self._run(argv)
+            self.request.sendall(
+                protocol.encode_frame(client.EXIT + str(code).encode()))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, its command is abandoned
+            pass
+
+    def _run(self, argv):
+        ref_files = _ref_files()
+        if ref_files != self.server.ref_files:
+            data.invalidate_ref_cache()
+
+        out = _text_output(self.request, client.STDOUT)
+        err = _text_output(self.request, client.STDERR)
+        with out, err, redirect_stdout(out), redirect_stderr(err):
+            try:
+                cli.run(argv)
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else int(
+                    e.code is not None)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+                code = 1
+        # refs the command changed were updated in the cache as well
+        self.server.ref_files = _ref_files()
+        return code
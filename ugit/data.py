@@ -1,21 +1,88 @@
-from genericpath import exists
 import os
-import json
-import shutil
+import mmap
+import zlib
 import hashlib
-from collections import namedtuple
+import tempfile
+import itertools
+from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 
+from . import index as _index  # pylint: disable=relative-beyond-top-level
+from . import pack as _pack  # pylint: disable=relative-beyond-top-level
+from . import commit_graph as _commit_graph  # pylint: disable=relative-beyond-top-level
+from . import bitmap as _bitmap  # pylint: disable=relative-beyond-top-level
+from . import trace  # pylint: disable=relative-beyond-top-level
+
 GIT_DIR = None
 
+# read and write files in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+# pack dir -> (mtime of pack dir, loaded packs)
+_packs = {}
+# commit-graph path -> (stat data of the file and of its chain of layers,
+# loaded graph)
+_commit_graphs = {}
+# bitmap path -> (inode and mtime of the file, loaded bitmaps)
+_bitmaps = {}
+# index path -> (inode, mtime and size of the file, loaded index)
+_indexes = {}
+
+
+class ObjectCache:
+    '''LRU cache whose size is bounded by the total size of its values.'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, size):
+        # a single huge object would evict everything else
+        if size > self.limit // 4 or key in self._items:
+            return
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.limit:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._items), 'bytes': self.size}
+
+
+# objects are immutable, so they can be cached for the whole process, keyed
+# by git dir as well since the same oid may exist in one repository only
+object_cache = ObjectCache(
+    int(os.environ.get('UGIT_OBJECT_CACHE_SIZE', 64 * 2 ** 20)))
+
 
 @contextmanager
 def change_git_dir(new_dir):
     global GIT_DIR
     old_dir = GIT_DIR
     GIT_DIR = f'{new_dir}/.ugit'
+    # refs are cached by git dir, which is relative to the working directory
+    invalidate_ref_cache()
     yield
     GIT_DIR = old_dir
+    invalidate_ref_cache()
 
 
 def init():
@@ -25,7 +92,20 @@ def init():
 
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
 
+# (git dir, ref) -> raw value of the ref, so a command reads every ref once
+_ref_cache = {}
+# git dir -> names of loose refs under refs/
+_loose_ref_names = {}
+# packed-refs path -> (inode and mtime of the file, loaded packed refs)
+_packed_refs = {}
+
+
+def invalidate_ref_cache():
+    _ref_cache.clear()
+    _loose_ref_names.clear()
 
+
+@trace.traced('ref.update')
 def update_ref(ref, value: RefValue, deref=True):
     ref, _ = _get_ref_internal(ref, deref)
 
@@ -38,9 +118,45 @@ def update_ref(ref, value: RefValue, deref=True):
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
     with open(ref_path, 'w') as f:
         f.write(value)
+    _ref_cache[GIT_DIR, ref] = value
+    _loose_ref_names.pop(GIT_DIR, None)
     print('update ref: ', ref, value, ref_path)
 
 
+@trace.traced('ref.update')
+def update_refs(refs):
+    '''Update several refs to oids at once, refname -> oid.
+
+    All refs are locked before any of them is changed, so either all of
+    them are updated or none if one of them is locked by someone else.
+    '''
+    locked = []
+    try:
+        for ref, oid in refs.items():
+            assert oid
+            ref_path = f'{GIT_DIR}/{_get_ref_internal(ref)[0]}'
+            os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+            try:
+                fd = os.open(f'{ref_path}.lock',
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                raise Exception(f'Unable to lock {ref}, {ref_path}.lock exists')
+            locked.append(ref_path)
+            with os.fdopen(fd, 'w') as f:
+                f.write(oid)
+    except BaseException:
+        for ref_path in locked:
+            os.remove(f'{ref_path}.lock')
+        raise
+
+    for ref_path in locked:
+        os.replace(f'{ref_path}.lock', ref_path)
+    invalidate_ref_cache()
+    for ref, oid in refs.items():
+        print('update ref: ', ref, oid)
+
+
+@trace.traced('ref.lookup')
 def get_ref(ref, deref=True):
     _, ref_value = _get_ref_internal(ref, deref)
     return ref_value
@@ -48,15 +164,34 @@ def get_ref(ref, deref=True):
 
 def delete_ref(ref, deref=True):
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f'{GIT_DIR}/{ref}')
+    ref_path = f'{GIT_DIR}/{ref}'
+    if os.path.isfile(ref_path):
+        os.remove(ref_path)
+    packed = _get_packed_refs()
+    if packed and packed.get(ref):
+        refs = dict(packed.items())
+        del refs[ref]
+        _write_packed_refs(refs)
+    _ref_cache.pop((GIT_DIR, ref), None)
+    _loose_ref_names.pop(GIT_DIR, None)
+
+
+def _read_ref(ref):
+    '''Raw value of ref, loose refs override the packed ones.'''
+    key = (GIT_DIR, ref)
+    if key not in _ref_cache:
+        try:
+            with open(f'{GIT_DIR}/{ref}') as f:
+                value = f.read().strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            packed = _get_packed_refs()
+            value = packed and packed.get(ref)
+        _ref_cache[key] = value
+    return _ref_cache[key]
 
 
 def _get_ref_internal(ref, deref=True):
-    ref_path = f'{GIT_DIR}/{ref}'
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
+    value = _read_ref(ref)
 
     # support symbolic refs
     symbolic = bool(value) and value.startswith('ref:')
@@ -68,13 +203,25 @@ def _get_ref_internal(ref, deref=True):
     return ref, RefValue(symbolic=symbolic, value=value)
 
 
+def _iter_loose_ref_names():
+    names = _loose_ref_names.get(GIT_DIR)
+    if names is None:
+        names = []
+        for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
+            root = os.path.relpath(root, GIT_DIR)
+            names.extend(os.path.join(root, name) for name in filenames)
+        _loose_ref_names[GIT_DIR] = names
+    return names
+
+
 def iter_refs(prefix='', deref=True):
-    refs = ['HEAD', 'MERGED_HEAD']
-    for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(os.path.join(root, name) for name in filenames)
+    refs = {'HEAD', 'MERGE_HEAD'}
+    refs.update(_iter_loose_ref_names())
+    packed = _get_packed_refs()
+    if packed:
+        refs.update(name for name, _ in packed.items(prefix))
 
-    for refname in refs:
+    for refname in sorted(refs):
         if not refname.replace('\\', '/').startswith(prefix):
             continue
         ref = get_ref(refname, deref=deref)
@@ -82,34 +229,289 @@ def iter_refs(prefix='', deref=True):
             yield refname, ref
 
 
+class PackedRefs:
+    '''Sorted "oid refname" lines, searched in place with binary search.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # skip the header line
+        self._start = self._buffer.find(b'\n') + 1
+
+    def _line_at(self, start):
+        end = self._buffer.find(b'\n', start)
+        line = self._buffer[start:end].decode()
+        oid, refname = line.split(' ', 1)
+        return oid, refname, end + 1
+
+    def _lower_bound(self, name):
+        '''Offset of the first line whose refname is not less than name.'''
+        lo, hi = self._start, len(self._buffer)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start = self._buffer.rfind(b'\n', lo, mid) + 1 or lo
+            _, refname, line_end = self._line_at(line_start)
+            if refname < name:
+                lo = line_end
+            else:
+                hi = line_start
+        return lo
+
+    def get(self, name):
+        offset = self._lower_bound(name)
+        if offset >= len(self._buffer):
+            return None
+        oid, refname, _ = self._line_at(offset)
+        return oid if refname == name else None
+
+    def items(self, prefix=''):
+        offset = self._lower_bound(prefix)
+        while offset < len(self._buffer):
+            oid, refname, offset = self._line_at(offset)
+            if not refname.startswith(prefix):
+                break
+            yield refname, oid
+
+
+def _packed_refs_path():
+    return os.path.join(GIT_DIR, 'packed-refs')
+
+
+def _get_packed_refs():
+    path = _packed_refs_path()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    version = (st.st_ino, st.st_mtime_ns)
+    cached = _packed_refs.get(path)
+    if not cached or cached[0] != version:
+        cached = _packed_refs[path] = (version, PackedRefs(path))
+    return cached[1]
+
+
+def _write_packed_refs(refs):
+    content = '# ugit packed-refs, sorted\n' + ''.join(
+        f'{refs[name]} {name}\n' for name in sorted(refs))
+    path = _packed_refs_path()
+    tmp_path = f'{path}.lock'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def pack_refs():
+    '''Move all loose refs under refs/ into packed-refs.'''
+    packed = _get_packed_refs()
+    refs = dict(packed.items()) if packed else {}
+    loose = []
+    for refname in _iter_loose_ref_names():
+        ref = get_ref(refname, deref=False)
+        # symbolic refs stay loose
+        if ref.value and not ref.symbolic:
+            refs[refname] = ref.value
+            loose.append(refname)
+
+    _write_packed_refs(refs)
+    for refname in loose:
+        os.remove(f'{GIT_DIR}/{refname}')
+    invalidate_ref_cache()
+    return len(refs)
+
+
+def _file_version(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
 @contextmanager
 def get_index():
-    index = {}
     index_file = os.path.join(GIT_DIR, 'index')
-    if os.path.isfile(index_file):
-        with open(index_file) as f:
-            index = json.load(f)
+    # the index is taken out of the cache while it is changed, so it isn't
+    # reused if the change fails half way
+    version = _file_version(index_file)
+    cached = _indexes.pop(index_file, None)
+    if cached and cached[0] == version and version:
+        index = cached[1]
+    else:
+        with trace.span('index.load'):
+            index = _index.read_index(index_file)
 
     yield index
 
-    with open(index_file, 'w') as f:
-        json.dump(index, f)
+    if index.dirty:
+        with trace.span('index.save'):
+            _index.write_index(index_file, index)
+        version = _file_version(index_file)
+        # like a fresh read, for the racy check
+        index.timestamp = version[1]
+    _indexes[index_file] = (version, index)
+
 
+def _object_path(oid, git_dir=None):
+    # fan out objects by the first two hex digits of their oid
+    return os.path.join(git_dir or GIT_DIR, 'objects', oid[:2], oid[2:])
 
+
+def _flat_object_path(oid, git_dir=None):
+    # objects were stored flat and uncompressed in old repositories
+    return os.path.join(git_dir or GIT_DIR, 'objects', oid)
+
+
+def _write_file_atomic(path, content):
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='tmp_obj_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@trace.traced('object.write',
+              lambda _, oid, type_, content, *__: len(content))
+def _write_object(oid, type_, content, git_dir=None):
+    if object_exists(oid, git_dir):
+        return
+    compressor = zlib.compressobj()
+    compressed = (compressor.compress(type_.encode() + b'\x00') +
+                  compressor.compress(content) + compressor.flush())
+    _write_file_atomic(_object_path(oid, git_dir), compressed)
+
+
+def _read_loose_object(oid, git_dir=None):
+    try:
+        with open(_object_path(oid, git_dir), 'rb') as f:
+            return zlib.decompress(f.read())
+    except FileNotFoundError:
+        pass
+    try:
+        with open(_flat_object_path(oid, git_dir), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _read_object(oid, git_dir=None):
+    '''Read an object as (type, content), loose objects are checked first.'''
+    key = (git_dir or GIT_DIR, oid)
+    obj = object_cache.get(key)
+    if obj is None:
+        obj = _read_uncached_object(oid, git_dir)
+        object_cache.put(key, obj, len(obj[1]))
+    return obj
+
+
+@trace.traced('object.read', lambda obj, *_: len(obj[1]))
+def _read_uncached_object(oid, git_dir=None):
+    obj = _read_loose_object(oid, git_dir)
+    if obj is not None:
+        type_, _, content = obj.partition(b'\x00')
+        return type_.decode(), content
+
+    for pack in _get_packs(git_dir):
+        if oid in pack:
+            return pack.read(oid)
+
+    # a partial clone fetches the objects it left out on first use
+    if not git_dir and fetch_missing_objects([oid]):
+        for pack in _get_packs():
+            if oid in pack:
+                return pack.read(oid)
+
+    raise Exception(f'Object {oid} not found')
+
+
+def _pack_dir(git_dir=None):
+    return os.path.join(git_dir or GIT_DIR, 'objects', 'pack')
+
+
+def _get_packs(git_dir=None):
+    pack_dir = _pack_dir(git_dir)
+    try:
+        mtime = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    # reload only when packs were added or removed
+    cached = _packs.get(pack_dir)
+    if not cached or cached[0] != mtime:
+        packs = [_pack.Pack(path) for path in _pack.iter_pack_paths(pack_dir)]
+        cached = _packs[pack_dir] = (mtime, packs)
+    return cached[1]
+
+
+@trace.traced('object.hash', lambda _, data, *__: len(data))
 def hash_object(data, type_='blob'):
-    obj = type_.encode() + b'\x00' + data
-    oid = hashlib.sha1(obj).hexdigest()
-    with open(f'{GIT_DIR}/objects/{oid}', 'wb') as out:
-        out.write(obj)
+    sha = hashlib.sha1(type_.encode() + b'\x00')
+    sha.update(data)
+    oid = sha.hexdigest()
+    _write_object(oid, type_, data)
     return oid
 
 
-def get_object(oid, expected='blob'):
-    with open(f'{GIT_DIR}/objects/{oid}', 'rb') as f:
-        obj = f.read()
+@trace.traced('object.hash_file')
+def hash_file(path, type_='blob', write=True):
+    '''Hash and store a file chunk by chunk, with bounded memory. Content
+    that is stored already is only hashed, it isn't compressed again.
+    Without write, the file is only hashed.'''
+    header = type_.encode() + b'\x00'
+    sha = hashlib.sha1(header)
+    with open(path, 'rb') as f:
+        # a small file is kept, so it isn't read again to be stored
+        content = f.read(CHUNK_SIZE)
+        sha.update(content)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+            content = None
+    oid = sha.hexdigest()
+    if not write or object_exists(oid):
+        return oid
+    if content is not None:
+        _write_object(oid, type_, content)
+        return oid
+
+    # the file is read again, the oid is taken from what is stored in case
+    # it changed in between
+    sha = hashlib.sha1(header)
+    compressor = zlib.compressobj()
+    objects_dir = os.path.join(GIT_DIR, 'objects')
+    fd, tmp_path = tempfile.mkstemp(dir=objects_dir, prefix='tmp_obj_')
+    try:
+        with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f:
+            out.write(compressor.compress(header))
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+            out.flush()
+            os.fsync(out.fileno())
+
+        oid = sha.hexdigest()
+        if object_exists(oid):
+            os.remove(tmp_path)
+        else:
+            object_path = _object_path(oid)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(tmp_path, object_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return oid
 
-    type_, _, content = obj.partition(b'\x00')
-    type_ = type_.decode()
+
+def get_object(oid, expected='blob'):
+    type_, content = _read_object(oid)
 
     if expected is not None:
         assert type_ == expected, f'Expected {expected}, got {type_}'
@@ -117,20 +519,244 @@ def get_object(oid, expected='blob'):
     return content
 
 
-def object_exists(oid):
-    return os.path.isfile(os.path.join(GIT_DIR, 'objects', oid))
+def stream_object(oid, expected='blob'):
+    '''Yield the content of an object in chunks, loose objects are inflated
+    incrementally so big blobs never need to be in memory as a whole.'''
+    type_, chunks = _open_object(oid)
 
+    if expected is not None:
+        assert type_ == expected, f'Expected {expected}, got {type_}'
+
+    yield from chunks
 
-def fetch_object_if_missing(oid, remote_git_dir):
-    if object_exists(oid):
-        return
 
-    remote_git_dir = os.path.join(remote_git_dir, '.ugit')
-    shutil.copy(os.path.join(remote_git_dir, 'objects', oid),
-                os.path.join(GIT_DIR, 'objects', oid))
+@trace.traced('object.open')
+def _open_object(oid):
+    for path, compressed in ((_object_path(oid), True),
+                             (_flat_object_path(oid), False)):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        chunks = _iter_file_chunks(f, compressed)
+        type_ = rest = b''
+        for chunk in chunks:
+            type_, sep, rest = (type_ + chunk).partition(b'\x00')
+            if sep:
+                break
+        return type_.decode(), itertools.chain([rest], chunks)
+
+    for pack in _get_packs():
+        if oid in pack:
+            return pack.stream(oid, CHUNK_SIZE)
 
+    if fetch_missing_objects([oid]):
+        for pack in _get_packs():
+            if oid in pack:
+                return pack.stream(oid, CHUNK_SIZE)
+
+    raise Exception(f'Object {oid} not found')
 
-def push_object(oid, remote_git_dir):
-    remote_git_dir = os.path.join(remote_git_dir, '.ugit')
-    shutil.copy(os.path.join(GIT_DIR, 'objects', oid),
-                os.path.join(remote_git_dir, 'objects', oid))
+
+def _iter_file_chunks(f, compressed):
+    with f:
+        decompressor = zlib.decompressobj()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield decompressor.decompress(chunk) if compressed else chunk
+
+
+def object_exists(oid, git_dir=None):
+    return (os.path.isfile(_object_path(oid, git_dir)) or
+            os.path.isfile(_flat_object_path(oid, git_dir)) or
+            any(oid in pack for pack in _get_packs(git_dir)))
+
+
+def _promisor_path():
+    return os.path.join(GIT_DIR, 'promisor')
+
+
+def get_promisor():
+    '''(remote, filter) of the fetch that left objects out of this partial
+    clone, or None if the repository is complete.'''
+    try:
+        with open(_promisor_path()) as f:
+            remote, filter_spec = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    return remote, filter_spec
+
+
+def set_promisor(remote, filter_spec):
+    _write_file_atomic(_promisor_path(), f'{remote}\n{filter_spec}\n'.encode())
+
+
+def fetch_missing_objects(oids):
+    '''Fetch objects left out by a partial clone from its promisor remote,
+    all of them in one request. Returns whether anything was fetched.'''
+    promisor = get_promisor()
+    if not promisor:
+        return False
+    missing = sorted({oid for oid in oids if oid and not object_exists(oid)})
+    if not missing:
+        return False
+    # remote is built on top of this module
+    from . import remote  # pylint: disable=import-outside-toplevel,relative-beyond-top-level
+    remote.fetch_objects(promisor[0], missing)
+    return True
+
+
+@trace.traced('pack.build', lambda size, *_: size)
+def pack_objects(f, oids, name_hints=None):
+    '''Write objects to the file f as a thin pack for transfer, returns
+    its size.
+
+    name_hints maps oid to the name it was found under. Hinted objects that
+    aren't sent are ones the receiver already has, they are used as delta
+    bases without being sent.
+    '''
+    name_hints = name_hints or {}
+    oids = set(oids)
+
+    def iter_objects(oids):
+        for oid in oids:
+            type_, content = _read_object(oid)
+            yield oid, type_, content, name_hints.get(oid, '')
+
+    # a partial clone may not have the old versions, they aren't fetched
+    # just to be delta bases
+    bases = [oid for oid in name_hints
+             if oid not in oids and object_exists(oid)]
+    return _pack.write_thin_pack(
+        f, len(oids), iter_objects(oids), iter_objects(bases))
+
+
+def pack_spool(delete=True):
+    '''Temporary file in the pack dir to receive a pack into.'''
+    pack_dir = _pack_dir()
+    os.makedirs(pack_dir, exist_ok=True)
+    return tempfile.NamedTemporaryFile(
+        dir=pack_dir, prefix='tmp_pack_', delete=delete)
+
+
+@trace.traced('pack.receive', lambda _, f: os.fstat(f.fileno()).st_size)
+def receive_pack(f):
+    '''Verify a pack from pack_objects spooled to f, a file from
+    pack_spool(), and store it with its index.'''
+    return _pack.index_pack(_pack_dir(), f, _read_object)
+
+
+def _commit_graph_path():
+    return os.path.join(GIT_DIR, 'objects', 'info', 'commit-graph')
+
+
+def get_commit_graph():
+    '''The commit-graph with its layers, or None if there is none.'''
+    path = _commit_graph_path()
+    version = (_file_version(path),
+               _file_version(_commit_graph.chain_path(path)))
+    if version == (None, None):
+        return None
+
+    cached = _commit_graphs.get(path)
+    if not cached or cached[0] != version:
+        cached = _commit_graphs[path] = (
+            version, _commit_graph.load_commit_graph(path))
+    return cached[1]
+
+
+def write_commit_graph(commits):
+    '''Write commits as the whole commit-graph.'''
+    _commit_graph.write_commit_graph(_commit_graph_path(), commits)
+
+
+def add_commit_graph_layer(commits):
+    '''Add commits that aren't in the commit-graph yet on top of it.'''
+    _commit_graph.add_layer(_commit_graph_path(), commits, get_commit_graph())
+
+
+def get_bitmaps():
+    '''(pack, bitmaps) of the pack that has reachability bitmaps, or None.'''
+    for pack in _get_packs():
+        path = _bitmap.bitmap_path(pack.path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        version = (st.st_ino, st.st_mtime_ns)
+        cached = _bitmaps.get(path)
+        if not cached or cached[0] != version:
+            cached = _bitmaps[path] = (
+                version, _bitmap.Bitmaps(path, pack.checksum))
+        return pack, cached[1]
+    return None
+
+
+def get_pack(pack_path):
+    return next(pack for pack in _get_packs() if pack.path == pack_path)
+
+
+def write_bitmaps(pack_path, bitmaps, name_hints):
+    '''Write bitmaps for the pack at pack_path, with the hashes of the
+    names in name_hints of its objects.'''
+    pack = get_pack(pack_path)
+    name_hashes = [_bitmap.name_hash(name_hints.get(oid, ''))
+                   for oid in pack]
+    _bitmap.write_bitmaps(
+        _bitmap.bitmap_path(pack_path), pack.checksum, bitmaps, name_hashes)
+
+
+def iter_loose_objects():
+    objects_dir = os.path.join(GIT_DIR, 'objects')
+    for name in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, name)
+        if len(name) == 40 and os.path.isfile(path):
+            yield name
+        elif len(name) == 2 and os.path.isdir(path):
+            for rest in os.listdir(path):
+                if len(rest) == 38:
+                    yield name + rest
+
+
+@trace.traced('pack.repack')
+def repack(name_hints, keep=None):
+    '''Write all objects into one pack and remove loose objects and old packs.
+
+    name_hints maps oid to the name it was found under, objects with the
+    same name are likely similar and are tried as delta bases first. If
+    keep is given, only those objects are kept and the rest is dropped.
+    '''
+    old_packs = list(_get_packs())
+    loose = set(iter_loose_objects())
+    oids = set(loose)
+    for pack in old_packs:
+        oids.update(pack)
+    if keep is not None:
+        oids &= set(keep)
+
+    def iter_objects():
+        for oid in oids:
+            type_, content = _read_object(oid)
+            yield oid, type_, content, name_hints.get(oid, '')
+
+    pack_path = _pack.write_pack(_pack_dir(), iter_objects())
+
+    for pack in old_packs:
+        if pack.path != pack_path:
+            os.remove(_pack.idx_path(pack.path))
+            os.remove(pack.path)
+        # positions change with the pack, the bitmaps are written again
+        if os.path.isfile(_bitmap.bitmap_path(pack.path)):
+            os.remove(_bitmap.bitmap_path(pack.path))
+    fanout_dirs = set()
+    for oid in loose:
+        for path in (_object_path(oid), _flat_object_path(oid)):
+            if os.path.isfile(path):
+                os.remove(path)
+        fanout_dirs.add(os.path.dirname(_object_path(oid)))
+    for dirname in fanout_dirs:
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            # gone already, or not empty, objects were added meanwhile
+            pass
+    return pack_path, len(oids)
@@ -1,7 +1,28 @@
-from collections import defaultdict
-import difflib
+import os
+import bisect
+from collections import defaultdict, namedtuple, Counter
+from collections.abc import Mapping
 
+from . import base  # pylint: disable=relative-beyond-top-level
 from . import data  # pylint: disable=relative-beyond-top-level
+from . import index as _index  # pylint: disable=relative-beyond-top-level
+from . import linediff  # pylint: disable=relative-beyond-top-level
+from . import trace  # pylint: disable=relative-beyond-top-level
+
+# blobs bigger than this aren't diffed line by line
+BIG_FILE_THRESHOLD = int(
+    os.environ.get('UGIT_BIG_FILE_THRESHOLD', 32 * 2 ** 20))
+# a NUL byte in the first bytes of a blob marks it as binary
+BINARY_CHECK_SIZE = 8000
+# minimum similarity in percent for an inexact rename
+RENAME_THRESHOLD = 50
+# inexact renames are skipped if there are more sources or destinations
+RENAME_LIMIT = int(os.environ.get('UGIT_RENAME_LIMIT', 400))
+# binary blobs are compared in chunks of this size instead of lines
+SIGNATURE_CHUNK_SIZE = 64
+
+Rename = namedtuple(
+    'Rename', ['from_path', 'to_path', 'o_from', 'o_to', 'score', 'copy'])
 
 
 class Flags:
@@ -20,59 +41,425 @@ def compare_trees(*trees):
         yield (path, *oids)
 
 
-def iter_changed_files(t_from, t_to):
+def _tree_entries(oid):
+    return {name: (type_, oid)
+            for type_, oid, name in base._iter_tree_entries(oid)}
+
+
+def iter_tree_changes(t_from, t_to, base_path=''):
+    '''Yield (path, o_from, o_to) for every blob that differs between two
+    tree oids. Both trees are walked side by side and subtrees with the same
+    oid on both sides are skipped without being read.'''
+    if t_from == t_to:
+        return
+    entries_from, entries_to = _tree_entries(t_from), _tree_entries(t_to)
+    for name in sorted(entries_from.keys() | entries_to.keys()):
+        entry_from = entries_from.get(name, (None, None))
+        entry_to = entries_to.get(name, (None, None))
+        if entry_from == entry_to:
+            continue
+        path = base_path + name
+
+        trees = [oid if type_ == 'tree' else None
+                 for type_, oid in (entry_from, entry_to)]
+        if any(trees):
+            yield from iter_tree_changes(*trees, f'{path}/')
+
+        blobs = [oid if type_ == 'blob' else None
+                 for type_, oid in (entry_from, entry_to)]
+        if any(blobs):
+            yield (path, *blobs)
+
+
+def iter_index_changes(t_from, index):
+    '''Yield (path, o_from, o_to) for every blob that differs between a
+    tree oid and the index. Directories whose tree oid is cached in the
+    index are skipped without being read if it is the same as in t_from,
+    so the index doesn't have to be written as trees to be compared.'''
+    paths = sorted(index)
+    yield from _iter_index_changes(t_from, index, paths, '', 0, len(paths))
+
+
+def _iter_index_changes(t_from, index, paths, dirname, lo, hi):
+    '''Changes of the directory dirname, paths[lo:hi] are the paths of
+    the index under it.'''
+    if t_from and index.trees.get(dirname) == t_from:
+        return
+    entries_from = _tree_entries(t_from) if t_from else {}
+    prefix = f'{dirname}/' if dirname else ''
+    names = set()
+    i = lo
+    while i < hi:
+        name, is_dir, _ = paths[i][len(prefix):].partition('/')
+        names.add(name)
+        path = prefix + name
+        type_, o_from = entries_from.get(name, (None, None))
+        if not is_dir:
+            o_to = index[paths[i]]
+            if type_ == 'tree':
+                yield from _iter_removed(type_, o_from, path)
+                o_from = None
+            if o_from != o_to:
+                yield path, o_from, o_to
+            i += 1
+            continue
+        # paths of a directory are contiguous, '0' sorts right after '/'
+        end = bisect.bisect_left(paths, f'{path}0', i, hi)
+        yield from _iter_index_changes(o_from if type_ == 'tree' else None,
+                                       index, paths, path, i, end)
+        if type_ == 'blob':
+            yield path, o_from, None
+        i = end
+    for name in entries_from.keys() - names:
+        yield from _iter_removed(*entries_from[name], prefix + name)
+
+
+def _iter_removed(type_, oid, path):
+    if type_ == 'tree':
+        for blob_path, blob in base.get_tree(oid, f'{path}/').items():
+            yield blob_path, blob, None
+    else:
+        yield path, oid, None
+
+
+def _iter_changes(t_from, t_to):
+    '''Changed paths between two trees, given as tree oids or as flat
+    path -> oid mappings like the index and the working tree.'''
+    if not isinstance(t_from, Mapping) and not isinstance(t_to, Mapping):
+        yield from iter_tree_changes(t_from, t_to)
+        return
+    if not isinstance(t_from, Mapping) and isinstance(t_to, _index.Index):
+        yield from iter_index_changes(t_from, t_to)
+        return
+
+    if not isinstance(t_from, Mapping):
+        t_from = base.get_tree(t_from)
+    if not isinstance(t_to, Mapping):
+        t_to = base.get_tree(t_to)
     for path, o_from, o_to in compare_trees(t_from, t_to):
         if o_from != o_to:
-            action = ('new file' if not o_from else
-                      'delted' if not o_to else
-                      'modified')
-            yield path, action
+            yield path, o_from, o_to
+
+
+@trace.traced('diff.changes')
+def _iter_changes_and_renames(t_from, t_to, threshold, copies):
+    '''Changed paths as (path, o_from, o_to, rename), with the deletes and
+    adds that make up a rename or copy merged into one entry.'''
+    changes = list(_iter_changes(t_from, t_to))
+    renames = find_renames(changes, threshold, copies) if threshold else []
+    paired = {rename.to_path for rename in renames}
+    paired.update(rename.from_path for rename in renames if not rename.copy)
+
+    result = [(path, o_from, o_to, None)
+              for path, o_from, o_to in changes if path not in paired]
+    result.extend((rename.to_path, rename.o_from, rename.o_to, rename)
+                  for rename in renames)
+    return sorted(result, key=lambda change: change[0])
 
 
-def diff_trees(t_from, t_to):
+def iter_changed_files(t_from, t_to, threshold=RENAME_THRESHOLD,
+                       copies=False):
+    for path, o_from, o_to, rename in _iter_changes_and_renames(
+            t_from, t_to, threshold, copies):
+        if rename:
+            action = 'copied' if rename.copy else 'renamed'
+            yield f'{rename.from_path} -> {path}', action
+            continue
+        action = ('new file' if not o_from else
+                  'delted' if not o_to else
+                  'modified')
+        yield path, action
+
+
+@trace.traced('diff.trees')
+def diff_trees(t_from, t_to, context=3, algorithm='myers',
+               threshold=RENAME_THRESHOLD, copies=False):
     output = ''
-    for path, o_from, o_to in compare_trees(t_from, t_to):
-        if o_from != o_to:
+    changes = _iter_changes_and_renames(t_from, t_to, threshold, copies)
+    # a partial clone gets all missing blobs in one request, not one by one
+    data.fetch_missing_objects(
+        oid for _, o_from, o_to, _ in changes for oid in (o_from, o_to))
+    for path, o_from, o_to, rename in changes:
+        from_path = path
+        if rename:
+            from_path = rename.from_path
+            kind = 'copy' if rename.copy else 'rename'
+            output += (f'changed: {from_path} -> {path}\n'
+                       f'similarity index {rename.score}%\n'
+                       f'{kind} from {from_path}\n{kind} to {path}\n')
+            if o_from == o_to:
+                output += '\n'
+                continue
+        else:
             output += f'changed: {path}\n'
-            diff_result = diff_blobs(o_from, o_to)
-            output += f'{diff_result}\n\n' if diff_result else ''
+        diff_result = diff_blobs(o_from, o_to, path, context, algorithm,
+                                 from_path)
+        output += f'{diff_result}\n\n' if diff_result else ''
     return output
 
 
+@trace.traced('diff.renames')
+def find_renames(changes, threshold=RENAME_THRESHOLD, copies=False):
+    '''Pair added paths with deleted ones they were renamed from.
+
+    changes are (path, o_from, o_to) tuples. Identical blobs are paired by
+    oid first, the rest by the similarity of their contents. With copies,
+    the old blobs of modified paths are sources of copies as well.
+    '''
+    sources = {path: o_from for path, o_from, o_to in changes
+               if o_from and (copies or not o_to)}
+    added = {path: o_to for path, o_from, o_to in changes if not o_from}
+    deleted = {path for path, o_from, o_to in changes if not o_to}
+
+    renames = []
+    used = set()
+
+    def pair(from_path, to_path, score):
+        # a deleted path is renamed once, every other use of it is a copy
+        copy = from_path not in deleted or from_path in used
+        used.add(from_path)
+        renames.append(Rename(from_path, to_path, sources[from_path],
+                              added.pop(to_path), score, copy))
+
+    # exact renames, prefer a source with the same file name
+    by_oid = defaultdict(list)
+    for path, oid in sorted(sources.items()):
+        by_oid[oid].append(path)
+    for to_path, oid in sorted(added.items()):
+        candidates = by_oid.get(oid)
+        if not candidates:
+            continue
+        basename = os.path.basename(to_path)
+        from_path = next(
+            (path for path in candidates
+             if os.path.basename(path) == basename and path not in used),
+            next((path for path in candidates if path not in used),
+                 candidates[0]))
+        if from_path in used and not copies:
+            continue
+        pair(from_path, to_path, 100)
+
+    remaining = [path for path in sources if copies or path not in used]
+    if (not remaining or not added or
+            len(remaining) > RENAME_LIMIT or len(added) > RENAME_LIMIT):
+        return renames
+
+    data.fetch_missing_objects(
+        [sources[path] for path in remaining] + list(added.values()))
+    signatures = {}
+    scores = []
+    for to_path, o_to in added.items():
+        for from_path in remaining:
+            score = _similarity(
+                sources[from_path], o_to, threshold, signatures)
+            if score >= threshold:
+                scores.append((score, from_path, to_path))
+
+    # best matches first, every destination is paired once
+    for score, from_path, to_path in sorted(
+            scores, key=lambda s: (-s[0], s[1], s[2])):
+        if to_path not in added or (from_path in used and not copies):
+            continue
+        pair(from_path, to_path, score)
+    return renames
+
+
+def _signature(oid):
+    '''Size and bytes per chunk hash of a blob, lines for text blobs and
+    fixed size chunks for binary ones.'''
+    content = data.get_object(oid)
+    if is_binary(content):
+        chunks = (content[i:i + SIGNATURE_CHUNK_SIZE]
+                  for i in range(0, len(content), SIGNATURE_CHUNK_SIZE))
+    else:
+        chunks = content.splitlines(keepends=True)
+    signature = Counter()
+    for chunk in chunks:
+        signature[hash(chunk)] += len(chunk)
+    return len(content), signature
+
+
+def _similarity(o_from, o_to, threshold, signatures):
+    '''Percentage of content two blobs have in common.'''
+    for oid in (o_from, o_to):
+        if oid not in signatures:
+            signatures[oid] = _signature(oid)
+    (size_from, sig_from), (size_to, sig_to) = (
+        signatures[o_from], signatures[o_to])
+    if not size_from or not size_to:
+        return 0
+    # blobs of very different size can't be similar enough, don't compare
+    if min(size_from, size_to) * 100 < threshold * max(
+            size_from, size_to):
+        return 0
+    if len(sig_to) < len(sig_from):
+        sig_from, sig_to = sig_to, sig_from
+    common = sum(min(size, sig_to[chunk])
+                 for chunk, size in sig_from.items() if chunk in sig_to)
+    return common * 100 // max(size_from, size_to)
+
+
+def is_binary(content):
+    return b'\x00' in content[:BINARY_CHECK_SIZE]
+
+
 def _get_blob_lines(oid):
-    try:
-        blob = data.get_object(oid)
-        blob = blob.decode(errors='ignore')
-    except:
-        blob = Flags.BYTE_BLOB
-    return blob.splitlines()
+    '''Lines of a blob, or None if it is binary or too big to diff.'''
+    if not oid:
+        return []
+    chunks = []
+    size = 0
+    # stop reading once a blob turns out to be too big
+    for chunk in data.stream_object(oid):
+        size += len(chunk)
+        if size > BIG_FILE_THRESHOLD:
+            return None
+        chunks.append(chunk)
+    blob = b''.join(chunks)
+    if is_binary(blob):
+        return None
+    return blob.decode(errors='replace').splitlines()
 
 
-def diff_blobs(o_from, o_to, path='blob'):
+@trace.traced('diff.blob')
+def diff_blobs(o_from, o_to, path='blob', context=3, algorithm='myers',
+               from_path=None):
+    from_path = from_path or path
     b_from, b_to = _get_blob_lines(o_from), _get_blob_lines(o_to)
-    result = difflib.unified_diff(b_from, b_to)
+    if b_from is None or b_to is None:
+        return f'Binary files a/{from_path} and b/{path} differ'
+    result = linediff.unified_diff(
+        b_from, b_to, f'a/{from_path}', f'b/{path}', context, algorithm)
     return '\n'.join(result)
 
 
+@trace.traced('merge.trees')
 def merge_trees(t_base, t_HEAD, t_other):
+    '''Merge three tree oids into a flat path -> oid mapping.'''
     tree = {}
-    for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_HEAD, t_other):
-        tree[path] = data.hash_object(merge_blobs(o_base, o_HEAD, o_other))
+    _merge_trees_recursive(t_base, t_HEAD, t_other, '', tree)
+    _merge_renames(t_base, t_HEAD, t_other, tree)
     return tree
 
 
+def _merge_renames(t_base, t_HEAD, t_other, tree):
+    '''Follow files renamed on one side and modified on the other, so the
+    modification is merged into the renamed file.'''
+    changes_HEAD = {path: (o_from, o_to) for path, o_from, o_to
+                    in iter_tree_changes(t_base, t_HEAD)}
+    changes_other = {path: (o_from, o_to) for path, o_from, o_to
+                     in iter_tree_changes(t_base, t_other)}
+
+    for renamed, modified, HEAD_renamed in (
+            (changes_other, changes_HEAD, False),
+            (changes_HEAD, changes_other, True)):
+        # deleted on one side but modified on the other, maybe renamed
+        candidates = {path for path, (o_from, o_to) in renamed.items()
+                      if not o_to and modified.get(path, (None, None))[1]}
+        if not candidates:
+            continue
+        changes = [(path, o_from, o_to)
+                   for path, (o_from, o_to) in renamed.items()
+                   if path in candidates or not o_from]
+        for rename in find_renames(changes):
+            o_base, o_modified = modified[rename.from_path]
+            if HEAD_renamed:
+                blobs = o_base, rename.o_to, o_modified
+            else:
+                blobs = o_base, o_modified, rename.o_to
+            tree.pop(rename.from_path, None)
+            tree[rename.to_path] = data.hash_object(merge_blobs(*blobs))
+
+
+def _merge_trees_recursive(t_base, t_HEAD, t_other, base_path, tree):
+    entries = [_tree_entries(oid) for oid in (t_base, t_HEAD, t_other)]
+    names = set().union(*entries)
+    for name in sorted(names):
+        e_base, e_HEAD, e_other = (
+            e.get(name, (None, None)) for e in entries)
+        path = base_path + name
+
+        # only one side changed (or both the same way), take it as a whole
+        # without looking into the subtree or blob
+        if e_HEAD == e_other or e_base == e_other:
+            _take_entry(e_HEAD, path, tree)
+            continue
+        if e_base == e_HEAD:
+            _take_entry(e_other, path, tree)
+            continue
+
+        trees = [oid if type_ == 'tree' else None
+                 for type_, oid in (e_base, e_HEAD, e_other)]
+        if trees[1] or trees[2]:
+            _merge_trees_recursive(*trees, f'{path}/', tree)
+
+        blobs = [oid if type_ == 'blob' else None
+                 for type_, oid in (e_base, e_HEAD, e_other)]
+        if blobs[1] or blobs[2]:
+            tree[path] = data.hash_object(merge_blobs(*blobs))
+
+
+def _take_entry(entry, path, tree):
+    type_, oid = entry
+    if type_ == 'tree':
+        tree.update(base.get_tree(oid, f'{path}/'))
+    elif type_ == 'blob':
+        tree[path] = oid
+
+
+@trace.traced('merge.blob')
 def merge_blobs(o_base, o_HEAD, o_other):
-    # TODO: Implement three-way merge
     b_HEAD, b_other = _get_blob_lines(o_HEAD), _get_blob_lines(o_other)
-    # if both file is text file, diff and merge it
-    if b_HEAD != Flags.BYTE_BLOB and b_other != Flags.BYTE_BLOB:
-        result = difflib.ndiff(b_HEAD, b_other)
-        return '\n'.join(result).encode('utf-8')
+    # if both file is text file, merge them line by line
+    if b_HEAD is not None and b_other is not None:
+        b_base = _get_blob_lines(o_base) or []
+        result = merge3(b_base, b_HEAD, b_other)
+        return ''.join(f'{line}\n' for line in result).encode('utf-8')
     # else use Flags.BYTE_SPLIT line split them and place to one file
     result = []
-    if b_HEAD == Flags.BYTE_BLOB:
+    if b_HEAD is None:
         result.append(data.get_object(o_HEAD))
-    if b_other == Flags.BYTE_BLOB:
+    if b_other is None:
         result.append(data.get_object(o_other))
     # merged file start with Flas.UGIT_BYTES_TYPE
     return Flags.UGIT_BYTES_TYPE + Flags.BYTE_SPLIT.join(result)
+
+
+def merge3(base_lines, a, b, name_a='HEAD', name_b='MERGE_HEAD'):
+    '''diff3 merge of two line lists against their common base.
+
+    Base lines matched on both sides are stable, the chunks between them
+    are taken from the side that changed, or become conflicts if both
+    sides changed them differently.
+    '''
+    ids_base, ids_a, ids_b = linediff.intern_lines(base_lines, a, b)
+    match_a = dict(linediff.myers(ids_base, ids_a))
+    match_b = dict(linediff.myers(ids_base, ids_b))
+
+    result = []
+    i = j = k = 0
+    while True:
+        # next base line that is kept on both sides
+        o = i
+        while o < len(base_lines) and not (o in match_a and o in match_b):
+            o += 1
+        end_a = match_a[o] if o < len(base_lines) else len(a)
+        end_b = match_b[o] if o < len(base_lines) else len(b)
+
+        chunk_base = ids_base[i:o]
+        chunk_a, chunk_b = ids_a[j:end_a], ids_b[k:end_b]
+        if chunk_a == chunk_base or chunk_a == chunk_b:
+            result.extend(b[k:end_b])
+        elif chunk_b == chunk_base:
+            result.extend(a[j:end_a])
+        else:
+            result.append(f'<<<<<<< {name_a}')
+            result.extend(a[j:end_a])
+            result.append('=======')
+            result.extend(b[k:end_b])
+            result.append(f'>>>>>>> {name_b}')
+
+        if o == len(base_lines):
+            return result
+        result.append(base_lines[o])
+        i, j, k = o + 1, end_a + 1, end_b + 1
@@ -0,0 +1,278 @@
+'''Report which files of the working tree changed since a token.
+
+A monitor runs in a long lived process, the ugit daemon, which hands it
+to base.set_monitor. Only the daemon imports this module. query(token)
+returns a new token and the paths changed since token, or None for the
+paths if that isn't known, after an overflow or for a token of another
+monitor. Then the whole working tree has to be scanned.
+
+InotifyMonitor watches every directory with Linux inotify. PollingMonitor
+stats the whole tree on every query, it works everywhere and is used by
+the tests.
+'''
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# queries whose changes are kept, older tokens need a full scan
+MAX_QUERIES = 1000
+# how long to wait for the events of changes made before a query
+SYNC_TIMEOUT = 2
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_ONLYDIR)
+# wd, mask, cookie, length of the name that follows
+EVENT = struct.Struct('iIII')
+
+COOKIE_PREFIX = 'fsmonitor-cookie-'
+
+
+def start(kind='auto', root='.', git_dir='.ugit'):
+    '''Return a monitor of root. kind is 'inotify', 'poll' or 'auto' for
+    inotify where it is available.'''
+    if kind == 'auto':
+        kind = 'inotify' if inotify_available() else 'poll'
+    if kind == 'inotify':
+        return InotifyMonitor(root, git_dir)
+    if kind == 'poll':
+        return PollingMonitor(root, git_dir)
+    raise Exception(f'Unknown fsmonitor {kind}')
+
+
+def _is_ignored(path, git_dir):
+    return path == git_dir or path.startswith(git_dir + os.sep)
+
+
+class _Monitor:
+
+    def __init__(self, root, git_dir):
+        self.root = root
+        self.git_dir = git_dir
+        # tokens of another run of the daemon are never valid
+        self._id = f'{os.getpid()}.{time.time_ns()}'
+        self._seq = 0
+        # tokens before this need a full scan
+        self._valid_since = 0
+        # (seq, paths changed between the previous query and query seq)
+        self._log = []
+        self._pending = set()
+
+    def _changed(self, path):
+        path = os.path.relpath(path, self.root)
+        if not _is_ignored(path, self.git_dir):
+            self._pending.add(path)
+
+    def _overflow(self):
+        '''Changes were lost, every token given out so far is invalid.'''
+        self._pending.clear()
+        self._valid_since = self._seq + 1
+
+    def _collect(self):
+        raise NotImplementedError
+
+    def query(self, token):
+        '''Return (token, paths changed since token). Paths are None if a
+        full scan is needed. Directories are reported for changes of all
+        files under them.'''
+        self._collect()
+        self._seq += 1
+        self._log.append((self._seq, self._pending))
+        self._pending = set()
+        if len(self._log) > MAX_QUERIES:
+            self._valid_since = self._log.pop(0)[0]
+
+        new_token = f'{self._id}:{self._seq}'
+        monitor_id, _, seq = (token or '').rpartition(':')
+        if monitor_id != self._id or int(seq) < self._valid_since:
+            return new_token, None
+        seq = int(seq)
+        paths = set()
+        for query_seq, changed in reversed(self._log):
+            if query_seq <= seq:
+                break
+            paths |= changed
+        return new_token, paths
+
+    def close(self):
+        pass
+
+
+class PollingMonitor(_Monitor):
+    '''Finds changes by comparing the stat data of all files.'''
+
+    def __init__(self, root, git_dir):
+        super().__init__(root, git_dir)
+        self._files = self._scan()
+
+    def _scan(self):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root and self.git_dir in dirnames:
+                dirnames.remove(self.git_dir)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                files[path] = (st.st_mtime_ns, st.st_ctime_ns, st.st_size,
+                               st.st_ino, st.st_mode)
+        return files
+
+    def _collect(self):
+        files = self._scan()
+        for path in files.keys() | self._files.keys():
+            if files.get(path) != self._files.get(path):
+                self._changed(path)
+        self._files = files
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def inotify_available():
+    try:
+        return hasattr(_load_libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+
+class InotifyMonitor(_Monitor):
+    '''Watches every directory of the working tree with inotify.
+
+    Events are read when a query comes. Changes made before the query are
+    seen for sure once the event of a cookie file created by the query
+    arrives, inotify keeps the order of events.
+    '''
+
+    def __init__(self, root, git_dir):
+        super().__init__(root, git_dir)
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory
+        self._dirs = {}
+        self._cookies = 0
+        cookie_dir = os.path.join(root, git_dir)
+        self._cookie_wd = self._add_watch(cookie_dir)
+        self._watch_tree(root)
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                          WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # the directory is gone already, its removal is an event
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(error, f'Unable to watch {path}')
+        return wd
+
+    def _watch_tree(self, path):
+        for dirpath, dirnames, _ in os.walk(path):
+            if _is_ignored(os.path.relpath(dirpath, self.root), self.git_dir):
+                dirnames.clear()
+                continue
+            wd = self._add_watch(dirpath)
+            if wd is not None:
+                self._dirs[wd] = dirpath
+
+    def _unwatch_tree(self, path):
+        prefix = path + os.sep
+        for wd, dirpath in list(self._dirs.items()):
+            if dirpath == path or dirpath.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+
+    def _read_events(self, timeout):
+        '''Handle the events that are there, or wait up to timeout for
+        some. Return the names of the cookies seen.'''
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        cookies = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT.unpack_from(buffer, offset)
+            offset += EVENT.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self._overflow()
+            elif wd == self._cookie_wd:
+                if mask & IN_CREATE and name.startswith(COOKIE_PREFIX):
+                    cookies.append(name)
+            elif wd in self._dirs:
+                self._handle_event(wd, mask, name)
+        return cookies
+
+    def _handle_event(self, wd, mask, name):
+        dirpath = self._dirs[wd]
+        if mask & IN_IGNORED:
+            # the watch went away with its directory
+            del self._dirs[wd]
+            return
+        if not name:
+            return
+        path = os.path.join(dirpath, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # files may have been created before the watch was added,
+                # reporting the directory makes the reader scan it
+                self._watch_tree(path)
+            elif mask & IN_MOVED_FROM:
+                self._unwatch_tree(path)
+        self._changed(path)
+
+    def _collect(self):
+        self._cookies += 1
+        cookie = f'{COOKIE_PREFIX}{os.getpid()}-{self._cookies}'
+        cookie_path = os.path.join(self.root, self.git_dir, cookie)
+        with open(cookie_path, 'w'):
+            pass
+        os.remove(cookie_path)
+
+        deadline = time.monotonic() + SYNC_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # events are late, don't trust what we have
+                self._overflow()
+                return
+            if cookie in self._read_events(remaining):
+                return
+
+    def close(self):
+        os.close(self._fd)
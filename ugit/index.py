@@ -0,0 +1,321 @@
+import os
+import mmap
+import json
+import struct
+import hashlib
+from collections import namedtuple
+from collections.abc import MutableMapping
+
+IndexEntry = namedtuple(
+    'IndexEntry', ['oid', 'mtime_ns', 'ctime_ns', 'size', 'ino', 'mode'])
+
+# What the working tree had when the fsmonitor gave out token: the oid of
+# every path where it differs from the index, None for a missing file.
+# Files the fsmonitor didn't report since token still have that content.
+FsmonitorState = namedtuple('FsmonitorState', ['token', 'worktree'])
+
+INDEX_SIGNATURE = b'UIDX'
+INDEX_VERSION = 1
+
+# signature, version, number of entries
+HEADER = struct.Struct('>4sII')
+# mtime_ns, ctime_ns, size, ino, mode, raw oid, length of path
+ENTRY = struct.Struct('>QQQQI20sH')
+# signature and size of an extension after the entries
+EXTENSION = struct.Struct('>4sI')
+# length of directory path, followed by the path and the raw tree oid
+TREE_ENTRY = struct.Struct('>H')
+TREE_EXTENSION = b'TREE'
+# length of the token, followed by the token and the working tree entries:
+# length of path, the path and the raw oid, all zeros for a missing file
+FSMONITOR_ENTRY = struct.Struct('>H')
+FSMONITOR_EXTENSION = b'FSMN'
+MISSING_OID = bytes(20)
+CHECKSUM_SIZE = 20
+
+
+def stat_fields(st):
+    '''Stat fields we remember for every index entry.'''
+    return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode)
+
+
+class Index(MutableMapping):
+    '''Flat path -> oid mapping of the staging area.
+
+    Every entry also remembers the stat data of the working file it was
+    hashed from, so unchanged files don't need to be hashed again. Entries
+    read from disk stay undecoded in the mmap until they are looked up.
+    '''
+
+    def __init__(self, entries=None, timestamp=0, buffer=None, trees=None,
+                 fsmonitor=None):
+        # path -> IndexEntry, or offset into buffer if not decoded yet
+        self._entries = entries or {}
+        self._buffer = buffer
+        # directory -> oid of its tree, for directories that didn't change
+        # since the tree was written. The root directory is ''.
+        self.trees = trees or {}
+        # mtime of the index file when it was loaded, used by the racy check
+        self.timestamp = timestamp
+        self.fsmonitor = fsmonitor
+        self.dirty = False
+
+    def _decode(self, path):
+        entry = self._entries[path]
+        if type(entry) is int:
+            *stat, oid, _ = ENTRY.unpack_from(self._buffer, entry)
+            entry = IndexEntry(oid.hex(), *stat)
+            self._entries[path] = entry
+        return entry
+
+    def __getitem__(self, path):
+        return self._decode(path).oid
+
+    def __setitem__(self, path, oid):
+        entry = self.entry(path)
+        # same content, so the stat data is still valid
+        if entry and entry.oid == oid:
+            return
+        self._remember_worktree(path)
+        self._entries[path] = IndexEntry(oid, 0, 0, 0, 0, 0)
+        self._invalidate_trees(path)
+        self.dirty = True
+
+    def __delitem__(self, path):
+        self._remember_worktree(path)
+        del self._entries[path]
+        self._invalidate_trees(path)
+        self.dirty = True
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        if self._entries or self.trees:
+            self.dirty = True
+        for path in self._entries:
+            self._remember_worktree(path)
+        self._entries.clear()
+        self.trees.clear()
+
+    def _invalidate_trees(self, path):
+        dirname = path
+        while dirname:
+            dirname = dirname.rpartition('/')[0]
+            self.trees.pop(dirname, None)
+
+    def _remember_worktree(self, path):
+        # the working file of path keeps the content it had, if it wasn't
+        # in fsmonitor.worktree it was the same as the old entry
+        if self.fsmonitor and path not in self.fsmonitor.worktree:
+            entry = self.entry(path)
+            self.fsmonitor.worktree[path] = entry and entry.oid
+
+    def get_worktree(self):
+        '''The working tree as path -> oid, as of the fsmonitor token.'''
+        result = {path: self[path] for path in self._entries}
+        for path, oid in self.fsmonitor.worktree.items():
+            if oid:
+                result[path] = oid
+            else:
+                result.pop(path, None)
+        return result
+
+    def set_fsmonitor(self, token, worktree=None):
+        '''Record the working tree path -> oid as of token, or forget the
+        fsmonitor state if token is None.'''
+        if token is None:
+            state = None
+        else:
+            changed = {path: oid for path, oid in worktree.items()
+                       if path not in self or self[path] != oid}
+            changed.update((path, None) for path in self._entries
+                           if path not in worktree)
+            state = FsmonitorState(token, changed)
+        if state != self.fsmonitor:
+            self.fsmonitor = state
+            self.dirty = True
+
+    def set_tree(self, dirname, oid):
+        '''Remember the tree oid of an unchanged directory.'''
+        if self.trees.get(dirname) != oid:
+            self.trees[dirname] = oid
+            self.dirty = True
+
+    def entry(self, path):
+        if path not in self._entries:
+            return None
+        return self._decode(path)
+
+    def update_stat(self, path, oid, st):
+        '''Record oid of path together with the stat data of its file.'''
+        entry = IndexEntry(oid, *stat_fields(st))
+        old_entry = self.entry(path)
+        if old_entry != entry:
+            self._entries[path] = entry
+            self.dirty = True
+        if not old_entry or old_entry.oid != oid:
+            self._remember_worktree(path)
+            self._invalidate_trees(path)
+
+    def is_clean(self, path, st):
+        '''Check if the file of path is unchanged without reading it.'''
+        entry = self.entry(path)
+        if not entry or entry[1:] != stat_fields(st):
+            return False
+        # racy clean: the file may have been modified again in the same
+        # timestamp tick it was hashed, after that only a rehash can tell
+        return entry.mtime_ns < self.timestamp
+
+
+def read_index(path):
+    if not os.path.isfile(path) or not os.path.getsize(path):
+        return Index()
+
+    timestamp = os.stat(path).st_mtime_ns
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # migrate the old json index, it is rewritten as binary on save
+    if buffer[:1] == b'{':
+        index = _read_json_index(bytes(buffer), timestamp)
+        index.dirty = True
+        return index
+
+    signature, version, count = HEADER.unpack_from(buffer, 0)
+    if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+        raise Exception(f'Unknown index format {signature} {version}')
+    checksum = hashlib.sha1(buffer[:-CHECKSUM_SIZE]).digest()
+    if checksum != buffer[-CHECKSUM_SIZE:]:
+        raise Exception('Index checksum mismatch')
+
+    # only the paths are decoded here, the rest is decoded on lookup
+    entries = {}
+    offset = HEADER.size
+    for _ in range(count):
+        path_len, = struct.unpack_from('>H', buffer, offset + ENTRY.size - 2)
+        path_start = offset + ENTRY.size
+        entry_path = buffer[path_start:path_start + path_len].decode()
+        entries[entry_path] = offset
+        offset = path_start + path_len
+
+    trees = {}
+    fsmonitor = None
+    while offset < len(buffer) - CHECKSUM_SIZE:
+        signature, size = EXTENSION.unpack_from(buffer, offset)
+        offset += EXTENSION.size
+        # extensions we don't know are skipped
+        if signature == TREE_EXTENSION:
+            trees = _decode_trees(buffer[offset:offset + size])
+        elif signature == FSMONITOR_EXTENSION:
+            fsmonitor = _decode_fsmonitor(buffer[offset:offset + size])
+        offset += size
+
+    return Index(entries, timestamp, buffer, trees, fsmonitor)
+
+
+def _decode_trees(payload):
+    trees = {}
+    offset = 0
+    while offset < len(payload):
+        path_len, = TREE_ENTRY.unpack_from(payload, offset)
+        offset += TREE_ENTRY.size
+        dirname = payload[offset:offset + path_len].decode()
+        offset += path_len
+        trees[dirname] = payload[offset:offset + 20].hex()
+        offset += 20
+    return trees
+
+
+def _encode_trees(trees):
+    parts = []
+    for dirname in sorted(trees):
+        encoded = dirname.encode()
+        parts.append(TREE_ENTRY.pack(len(encoded)) + encoded +
+                     bytes.fromhex(trees[dirname]))
+    payload = b''.join(parts)
+    return EXTENSION.pack(TREE_EXTENSION, len(payload)) + payload
+
+
+def _decode_fsmonitor(payload):
+    token_len, = FSMONITOR_ENTRY.unpack_from(payload, 0)
+    offset = FSMONITOR_ENTRY.size
+    token = payload[offset:offset + token_len].decode()
+    offset += token_len
+    worktree = {}
+    while offset < len(payload):
+        path_len, = FSMONITOR_ENTRY.unpack_from(payload, offset)
+        offset += FSMONITOR_ENTRY.size
+        path = payload[offset:offset + path_len].decode()
+        offset += path_len
+        oid = payload[offset:offset + 20]
+        worktree[path] = None if oid == MISSING_OID else oid.hex()
+        offset += 20
+    return FsmonitorState(token, worktree)
+
+
+def _encode_fsmonitor(fsmonitor):
+    encoded = fsmonitor.token.encode()
+    parts = [FSMONITOR_ENTRY.pack(len(encoded)), encoded]
+    for path in sorted(fsmonitor.worktree):
+        oid = fsmonitor.worktree[path]
+        encoded = path.encode()
+        parts.append(FSMONITOR_ENTRY.pack(len(encoded)) + encoded +
+                     (bytes.fromhex(oid) if oid else MISSING_OID))
+    payload = b''.join(parts)
+    return EXTENSION.pack(FSMONITOR_EXTENSION, len(payload)) + payload
+
+
+def _read_json_index(raw, timestamp):
+    raw = json.loads(raw)
+    # the first index only mapped path to oid
+    if raw.get('version') != 2:
+        return Index({path: IndexEntry(oid, 0, 0, 0, 0, 0)
+                      for path, oid in raw.items()}, timestamp)
+
+    entries = {path: IndexEntry(*values)
+               for path, values in raw['entries'].items()}
+    return Index(entries, timestamp)
+
+
+def write_index(path, index: Index):
+    if not index.dirty:
+        return
+
+    parts = [HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(index))]
+    for entry_path in sorted(index):
+        entry = index.entry(entry_path)
+        encoded_path = entry_path.encode()
+        parts.append(ENTRY.pack(*entry[1:], bytes.fromhex(entry.oid),
+                                len(encoded_path)))
+        parts.append(encoded_path)
+    if index.trees:
+        parts.append(_encode_trees(index.trees))
+    if index.fsmonitor:
+        parts.append(_encode_fsmonitor(index.fsmonitor))
+    content = b''.join(parts)
+    content += hashlib.sha1(content).digest()
+
+    # write to a lock file first and then rename it over the index, so
+    # readers never see a half written index
+    lock_path = f'{path}.lock'
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        raise Exception(f'Unable to lock index, {lock_path} exists')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(lock_path, path)
+    except BaseException:
+        os.remove(lock_path)
+        raise
+    index.dirty = False
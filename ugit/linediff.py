@@ -0,0 +1,253 @@
+'''Line based diff engine.
+
+Lines are interned as integers first, so the algorithms only compare ints.
+Two algorithms are available: Myers' O(ND) algorithm in its linear space
+divide and conquer form, and histogram diff, which anchors on the rarest
+common lines and falls back to Myers where it finds none.
+'''
+from collections import defaultdict
+
+# histogram diff ignores lines that occur more often than this
+MAX_CHAIN = 64
+
+
+def intern_lines(*sequences):
+    '''Map each distinct line to an int, returns one int list per sequence.'''
+    ids = {}
+    return [[ids.setdefault(line, len(ids)) for line in lines]
+            for lines in sequences]
+
+
+def _trim(a, alo, ahi, b, blo, bhi, matches):
+    '''Match the common prefix and suffix of a region and shrink it.'''
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        matches.append((ahi, bhi))
+    return alo, ahi, blo, bhi
+
+
+def _middle_snake(a, alo, ahi, b, blo, bhi):
+    '''Find the snake in the middle of a shortest edit script between
+    a[alo:ahi] and b[blo:bhi], searching from both ends at once.
+
+    Returns its start and end as (x start, y start, x end, y end).
+    '''
+    n, m = ahi - alo, bhi - blo
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    # furthest x reached on each diagonal k = x - y, forwards and backwards
+    forward = [0] * (2 * max_d + 3)
+    backward = [0] * (2 * max_d + 3)
+
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            # the backward diagonal delta - k was searched in step d - 1
+            if odd and -(d - 1) <= delta - k <= d - 1:
+                if x + backward[offset + delta - k] >= n:
+                    return alo + x_start, blo + y_start, alo + x, blo + y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d:
+                if x + forward[offset + delta - k] >= n:
+                    # backwards coordinates count from the end
+                    return (alo + n - x, blo + m - y,
+                            alo + n - x_start, blo + m - y_start)
+
+    raise AssertionError('No middle snake found')
+
+
+def _myers(a, alo, ahi, b, blo, bhi, matches):
+    regions = [(alo, ahi, blo, bhi)]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+        alo, ahi, blo, bhi = _trim(a, alo, ahi, b, blo, bhi, matches)
+        if alo == ahi or blo == bhi:
+            continue
+        x_start, y_start, x_end, y_end = _middle_snake(
+            a, alo, ahi, b, blo, bhi)
+        matches.extend((x_start + i, y_start + i)
+                       for i in range(x_end - x_start))
+        regions.append((alo, x_start, blo, y_start))
+        regions.append((x_end, ahi, y_end, bhi))
+
+
+def myers(a, b):
+    '''Matching (i, j) index pairs of a shortest edit script from a to b.'''
+    matches = []
+    _myers(a, 0, len(a), b, 0, len(b), matches)
+    matches.sort()
+    return matches
+
+
+def _find_anchor(a, alo, ahi, b, blo, bhi):
+    '''Longest common run through the lines that occur least often in a.
+
+    Returns (i, j, length) or None if every common line is too frequent.
+    '''
+    occurrences = defaultdict(list)
+    for i in range(alo, ahi):
+        occurrences[a[i]].append(i)
+
+    best = None
+    j = blo
+    while j < bhi:
+        positions = occurrences.get(b[j])
+        if not positions or len(positions) > MAX_CHAIN or (
+                best and len(positions) > best[0][0]):
+            j += 1
+            continue
+        next_j = j + 1
+        for i in positions:
+            start_i, start_j = i, j
+            while (start_i > alo and start_j > blo and
+                   a[start_i - 1] == b[start_j - 1]):
+                start_i -= 1
+                start_j -= 1
+            end_i, end_j = i + 1, j + 1
+            while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                end_i += 1
+                end_j += 1
+            key = (len(positions), start_i - end_i)
+            if not best or key < best[0]:
+                best = (key, start_i, start_j, end_i - start_i)
+            next_j = max(next_j, end_j)
+        # lines inside the run just found can't start a longer one
+        j = next_j
+
+    return best and best[1:]
+
+
+def histogram(a, b):
+    '''Matching (i, j) index pairs, anchored on the rarest common lines.'''
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+        alo, ahi, blo, bhi = _trim(a, alo, ahi, b, blo, bhi, matches)
+        if alo == ahi or blo == bhi:
+            continue
+        anchor = _find_anchor(a, alo, ahi, b, blo, bhi)
+        if not anchor:
+            _myers(a, alo, ahi, b, blo, bhi, matches)
+            continue
+        i, j, length = anchor
+        matches.extend((i + t, j + t) for t in range(length))
+        regions.append((alo, i, blo, j))
+        regions.append((i + length, ahi, j + length, bhi))
+    matches.sort()
+    return matches
+
+
+ALGORITHMS = {'myers': myers, 'histogram': histogram}
+
+
+def get_opcodes(matches, n, m):
+    '''Turn sorted matches into difflib style (tag, i1, i2, j1, j2) ops.'''
+    opcodes = []
+    i = j = 0
+    k = 0
+    while True:
+        next_i, next_j = matches[k] if k < len(matches) else (n, m)
+        if i < next_i or j < next_j:
+            tag = ('replace' if i < next_i and j < next_j else
+                   'delete' if i < next_i else
+                   'insert')
+            opcodes.append((tag, i, next_i, j, next_j))
+        if k == len(matches):
+            return opcodes
+        run = 1
+        while (k + run < len(matches) and
+               matches[k + run] == (next_i + run, next_j + run)):
+            run += 1
+        opcodes.append(('equal', next_i, next_i + run, next_j, next_j + run))
+        i, j = next_i + run, next_j + run
+        k += run
+
+
+def _group_opcodes(opcodes, context):
+    '''Split opcodes into hunks with context lines of equal lines around.'''
+    if not opcodes:
+        return
+    opcodes = list(opcodes)
+    tag, i1, i2, j1, j2 = opcodes[0]
+    if tag == 'equal':
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    tag, i1, i2, j1, j2 = opcodes[-1]
+    if tag == 'equal':
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        # a long equal run ends the hunk
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context),
+                          j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _format_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f'{start + 1}'
+    if not length:
+        return f'{start},0'
+    return f'{start + 1},{length}'
+
+
+def unified_diff(a, b, fromfile='', tofile='', context=3, algorithm='myers'):
+    '''Yield the lines of a unified diff between two lists of lines.'''
+    a_ids, b_ids = intern_lines(a, b)
+    matches = ALGORITHMS[algorithm](a_ids, b_ids)
+    opcodes = get_opcodes(matches, len(a), len(b))
+
+    started = False
+    for group in _group_opcodes(opcodes, context):
+        if not started:
+            yield f'--- {fromfile}'
+            yield f'+++ {tofile}'
+            started = True
+        first, last = group[0], group[-1]
+        yield (f'@@ -{_format_range(first[1], last[2])} '
+               f'+{_format_range(first[3], last[4])} @@')
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                yield from (f' {line}' for line in a[i1:i2])
+                continue
+            if tag in ('replace', 'delete'):
+                yield from (f'-{line}' for line in a[i1:i2])
+            if tag in ('replace', 'insert'):
+                yield from (f'+{line}' for line in b[j1:j2])
@@ -0,0 +1,685 @@
+import io
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+from collections import OrderedDict
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NUMBERS = {'commit': OBJ_COMMIT, 'tree': OBJ_TREE, 'blob': OBJ_BLOB}
+TYPE_NAMES = {number: name for name, number in TYPE_NUMBERS.items()}
+
+PACK_SIGNATURE = b'PACK'
+PACK_VERSION = 2
+IDX_SIGNATURE = b'UPKI'
+IDX_VERSION = 1
+
+PACK_HEADER = struct.Struct('>4sII')
+IDX_HEADER = struct.Struct('>4sI')
+FANOUT = struct.Struct('>256I')
+OFFSET = struct.Struct('>Q')
+OID_SIZE = 20
+
+# objects are only deltified against the previous objects in this window
+DELTA_WINDOW = 10
+MAX_DELTA_DEPTH = 50
+# only objects whose sizes differ by less than this factor are delta pairs
+MAX_DELTA_SIZE_RATIO = 2
+# copies shorter than this cost about as much as inserting the bytes
+MIN_COPY = 16
+# offsets of a repeated line in the base that are tried as copy sources
+DELTA_CANDIDATES = 8
+MAX_COPY = 0xffffff
+MAX_INSERT = 0x7f
+# bytes of resolved objects kept around as delta bases when indexing a pack
+DELTA_BASE_CACHE_SIZE = 16 * 2 ** 20
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(buffer, offset):
+    value = shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def _encode_entry_header(type_num, size):
+    '''Type in bits 4-6 of the first byte, size in the rest as a varint.'''
+    byte = (type_num << 4) | (size & 0x0f)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(byte | 0x80)
+        byte = size & 0x7f
+        size >>= 7
+    out.append(byte)
+    return bytes(out)
+
+
+def _decode_entry_header(buffer, offset):
+    byte = buffer[offset]
+    offset += 1
+    type_num = (byte >> 4) & 0x07
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+        byte = buffer[offset]
+        offset += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    return type_num, size, offset
+
+
+def _match_length(base, base_offset, target, target_offset):
+    '''Length of the common run starting at both offsets.'''
+    limit = min(len(base) - base_offset, len(target) - target_offset, MAX_COPY)
+    length = 0
+    # compare slices of doubling and then halving size, slicing is much
+    # faster than a byte loop
+    step = 64
+    while length + step <= limit and (
+            base[base_offset + length:base_offset + length + step] ==
+            target[target_offset + length:target_offset + length + step]):
+        length += step
+        step *= 2
+    while step > 8:
+        step //= 2
+        if length + step <= limit and (
+                base[base_offset + length:base_offset + length + step] ==
+                target[target_offset + length:target_offset + length + step]):
+            length += step
+    while (length < limit and
+           base[base_offset + length] == target[target_offset + length]):
+        length += 1
+    return length
+
+
+def _encode_copy(offset, size):
+    command = 0x80
+    args = bytearray()
+    for i in range(4):
+        byte = (offset >> (8 * i)) & 0xff
+        if byte:
+            command |= 1 << i
+            args.append(byte)
+    for i in range(3):
+        byte = (size >> (8 * i)) & 0xff
+        if byte:
+            command |= 1 << (4 + i)
+            args.append(byte)
+    return bytes([command]) + bytes(args)
+
+
+def index_delta_base(base):
+    '''Offsets of the lines of base, to find copy sources for create_delta.
+    Built once for a base that is tried for several targets.'''
+    lines = {}
+    offset = 0
+    for line in base.split(b'\n'):
+        if line:
+            offsets = lines.setdefault(line, [])
+            if len(offsets) < DELTA_CANDIDATES:
+                offsets.append(offset)
+        offset += len(line) + 1
+    return lines
+
+
+def create_delta(base, target, max_size=None, index=None):
+    '''Encode target as copy and insert instructions against base.
+
+    The lines of target are looked up in index, the lines of base from
+    index_delta_base, and a match is extended as far as both agree. So the
+    target is searched line by line, not byte by byte. Returns None as
+    soon as the delta gets bigger than max_size.
+    '''
+    if index is None:
+        index = index_delta_base(base)
+    out = bytearray(_encode_varint(len(base)) + _encode_varint(len(target)))
+
+    def flush_insert(start, end):
+        for i in range(start, end, MAX_INSERT):
+            chunk = target[i:min(i + MAX_INSERT, end)]
+            out.append(len(chunk))
+            out.extend(chunk)
+
+    # target[insert_start:i] has no copy source and is inserted
+    insert_start = i = 0
+    while i < len(target):
+        end = target.find(b'\n', i)
+        if end < 0:
+            end = len(target)
+        candidates = index.get(target[i:end], ())
+        base_offset, length = max(
+            ((offset, _match_length(base, offset, target, i))
+             for offset in candidates),
+            key=lambda match: match[1], default=(None, 0))
+        if length < MIN_COPY:
+            i = end + 1
+        else:
+            flush_insert(insert_start, i)
+            out.extend(_encode_copy(base_offset, length))
+            i += length
+            insert_start = i
+        if max_size is not None and (
+                len(out) + min(i, len(target)) - insert_start > max_size):
+            return None
+    flush_insert(insert_start, len(target))
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+
+def apply_delta(base, delta):
+    base_size, offset = _decode_varint(delta, 0)
+    result_size, offset = _decode_varint(delta, offset)
+    assert base_size == len(base), 'Delta base size mismatch'
+
+    out = bytearray()
+    while offset < len(delta):
+        command = delta[offset]
+        offset += 1
+        if command & 0x80:
+            copy_offset = copy_size = 0
+            for i in range(4):
+                if command & (1 << i):
+                    copy_offset |= delta[offset] << (8 * i)
+                    offset += 1
+            for i in range(3):
+                if command & (1 << (4 + i)):
+                    copy_size |= delta[offset] << (8 * i)
+                    offset += 1
+            out += base[copy_offset:copy_offset + (copy_size or 0x10000)]
+        elif command:
+            out += delta[offset:offset + command]
+            offset += command
+        else:
+            raise Exception('Invalid delta instruction')
+
+    assert len(out) == result_size, 'Delta result size mismatch'
+    return bytes(out)
+
+
+def _is_delta_pair(content, base_content):
+    return (len(base_content) <= len(content) * MAX_DELTA_SIZE_RATIO and
+            len(content) <= len(base_content) * MAX_DELTA_SIZE_RATIO)
+
+
+def _best_delta(content, entries):
+    '''The smallest delta of content against one of entries, as (base oid,
+    delta), or None if none is much smaller than content. entries are
+    [oid, content, line index or None until needed] of the bases to try.'''
+    best = None
+    # only worth it if the delta is much smaller than the object
+    max_size = len(content) // 2 - 1
+    for entry in entries:
+        base_oid, base_content, index = entry
+        if index is None:
+            index = entry[2] = index_delta_base(base_content)
+        delta = create_delta(base_content, content, max_size, index)
+        if delta is not None:
+            best = (base_oid, delta)
+            max_size = len(delta) - 1
+    return best
+
+
+def _find_deltas(objects):
+    '''Pick a delta base for each object among similar objects.
+
+    Objects are sorted by type, name hint and descending size, so similar
+    objects end up next to each other and bases come before their deltas.
+    Only objects of the same type and name hint and of a similar size are
+    tried as bases. Returns {oid: (base_oid, delta)}.
+    '''
+    deltas = {}
+    depth = {}
+    # (type, name hint, [oid, content, line index])
+    window = []
+    for oid, type_, content, hint in objects:
+        if type_ == 'commit':
+            continue
+        best = _best_delta(content, [
+            entry for base_type, base_hint, entry in window
+            if base_type == type_ and base_hint == hint and
+            depth.get(entry[0], 0) < MAX_DELTA_DEPTH and
+            _is_delta_pair(content, entry[1])])
+        if best:
+            deltas[oid] = best
+            depth[oid] = depth.get(best[0], 0) + 1
+        window.append((type_, hint, [oid, content, None]))
+        del window[:-DELTA_WINDOW]
+    return deltas
+
+
+def _iter_thin_deltas(objects, bases):
+    '''Pick a delta base for each object among bases, the objects the
+    reader has, with the same type and name hint. Objects aren't deltas
+    against each other, so a transfer without bases isn't deltified at
+    all, and objects are only looked at one at a time. Yields (oid, type,
+    content, (base_oid, delta) or None).'''
+    by_hint = {}
+    for oid, type_, content, hint in bases:
+        by_hint.setdefault((type_, hint), []).append([oid, content, None])
+    for oid, type_, content, hint in objects:
+        candidates = [entry for entry in by_hint.get((type_, hint), ())
+                      if _is_delta_pair(content, entry[1])]
+        yield oid, type_, content, _best_delta(
+            content, candidates[:DELTA_WINDOW])
+
+
+def _sort_key(obj):
+    oid, type_, content, hint = obj
+    return TYPE_NUMBERS[type_], hint, -len(content), oid
+
+
+def _iter_pack(count, objects, offsets):
+    '''Encode count objects as a pack without its checksum, in parts.
+    objects is an iterable of (oid, type, content, (base_oid, delta) or
+    None), bases that aren't in objects are ones the reader already has,
+    which makes a thin pack. offsets gets the offset of every object.'''
+    yield PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, count)
+    position = PACK_HEADER.size
+    for oid, type_, content, delta in objects:
+        offsets[oid] = position
+        if delta and delta[0] not in offsets:
+            base_oid, payload = delta
+            entry = _encode_entry_header(OBJ_REF_DELTA, len(payload))
+            entry += bytes.fromhex(base_oid)
+        elif delta:
+            base_oid, payload = delta
+            entry = _encode_entry_header(OBJ_OFS_DELTA, len(payload))
+            entry += _encode_varint(position - offsets[base_oid])
+        else:
+            payload = content
+            entry = _encode_entry_header(TYPE_NUMBERS[type_], len(payload))
+        entry += zlib.compress(payload)
+        yield entry
+        position += len(entry)
+    assert len(offsets) == count, 'Pack object count mismatch'
+
+
+def write_thin_pack(f, count, objects, bases=()):
+    '''Write count objects to the file f as a pack for transfer,
+    deltified only against bases if given.
+
+    Both are iterables of (oid, type, content, name hint). Objects are
+    encoded and written one at a time, only the bases are held in memory.
+    Returns the size of the pack.
+    '''
+    sha = hashlib.sha1()
+    size = OID_SIZE
+    for part in _iter_pack(count, _iter_thin_deltas(objects, bases), {}):
+        sha.update(part)
+        f.write(part)
+        size += len(part)
+    f.write(sha.digest())
+    return size
+
+
+def encode_pack(objects, bases=()):
+    '''write_thin_pack() into memory, returns the pack.'''
+    objects = list(objects)
+    f = io.BytesIO()
+    write_thin_pack(f, len(objects), objects, bases)
+    return f.getvalue()
+
+
+def write_pack(pack_dir, objects):
+    '''Write objects into a pack and its index under pack_dir.
+
+    objects is an iterable of (oid, type, content, name hint). Returns the
+    path of the pack.
+    '''
+    objects = sorted(objects, key=_sort_key)
+    deltas = _find_deltas(objects)
+    offsets = {}
+    content = b''.join(_iter_pack(
+        len(objects),
+        ((oid, type_, content, deltas.get(oid))
+         for oid, type_, content, _ in objects),
+        offsets))
+    return _write_pack_files(pack_dir, content, offsets)
+
+
+def _write_pack_files(pack_dir, content, offsets):
+    checksum = hashlib.sha1(content).digest()
+    os.makedirs(pack_dir, exist_ok=True)
+    pack_path = os.path.join(pack_dir, f'pack-{checksum.hex()}.pack')
+    _write_file(pack_path, content + checksum)
+    # write the idx last, a pack is only visible to readers through it
+    _write_file(idx_path(pack_path), _encode_idx(offsets, checksum))
+    return pack_path
+
+
+def index_pack(pack_dir, f, read_object):
+    '''Verify a received pack spooled to the file f and move it with its
+    index under pack_dir.
+
+    read_object(oid) returns (type, content) of an object the receiver
+    already has. A thin pack is completed by appending the objects its
+    deltas are based on to f, so the stored pack is self contained. f is
+    read through mmap, and linked into pack_dir instead of copied. Returns
+    the path of the pack, or None if it is empty.
+    '''
+    f.flush()
+    size = os.fstat(f.fileno()).st_size
+    if size < PACK_HEADER.size + OID_SIZE:
+        raise Exception('Truncated pack')
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        count, offsets, external = _verify_pack(buffer, read_object)
+    finally:
+        try:
+            buffer.close()
+        except BufferError:
+            # views of a failed read still exist, it is closed once they
+            # are garbage collected
+            pass
+    if not count:
+        return None
+
+    if external:
+        checksum = _append_bases(f, count, size - OID_SIZE, external, offsets)
+    else:
+        f.seek(size - OID_SIZE)
+        checksum = f.read(OID_SIZE)
+    f.flush()
+    os.fsync(f.fileno())
+
+    os.makedirs(pack_dir, exist_ok=True)
+    pack_path = os.path.join(pack_dir, f'pack-{checksum.hex()}.pack')
+    # link the spool file, it is removed under its own name when closed
+    tmp_path = f'{pack_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    os.link(f.name, tmp_path)
+    os.replace(tmp_path, pack_path)
+    # write the idx last, a pack is only visible to readers through it
+    _write_file(idx_path(pack_path), _encode_idx(offsets, checksum))
+    return pack_path
+
+
+def _append_bases(f, count, end, external, offsets):
+    '''Complete a thin pack in f, whose entries end at end, with the
+    objects external. Returns the new checksum.'''
+    f.seek(0)
+    f.write(PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION,
+                             count + len(external)))
+    f.seek(end)
+    f.truncate()
+    for oid, (type_, base_content) in external.items():
+        entry = _encode_entry_header(TYPE_NUMBERS[type_], len(base_content))
+        entry += zlib.compress(base_content)
+        offsets[oid] = end
+        f.write(entry)
+        end += len(entry)
+
+    f.seek(0)
+    sha = hashlib.sha1()
+    for chunk in iter(lambda: f.read(2 ** 20), b''):
+        sha.update(chunk)
+    checksum = sha.digest()
+    f.write(checksum)
+    return checksum
+
+
+def _verify_pack(content, read_object):
+    '''Check the checksum and the objects of a pack. Returns (number of
+    objects, {oid: offset}, {oid: (type, content)} of the objects it has
+    deltas against but doesn't contain).'''
+    body = memoryview(content)[:-OID_SIZE]
+    if hashlib.sha1(body).digest() != content[-OID_SIZE:]:
+        raise Exception('Pack checksum mismatch')
+    signature, version, count = PACK_HEADER.unpack_from(body, 0)
+    if signature != PACK_SIGNATURE or version != PACK_VERSION:
+        raise Exception(f'Unknown pack format {signature} {version}')
+    if not count:
+        return 0, {}, {}
+
+    offsets = {}
+    external = {}
+    cache = OrderedDict()
+    cache_size = 0
+
+    def resolve(offset, entry=None):
+        '''(type, content) of the entry at offset, deltas applied.'''
+        nonlocal cache_size
+        if offset in cache:
+            cache.move_to_end(offset)
+            return cache[offset]
+        type_num, base, payload, _ = entry or _read_entry(body, offset)
+        if type_num == OBJ_OFS_DELTA:
+            type_, base_content = resolve(base)
+            obj = type_, apply_delta(base_content, payload)
+        elif type_num == OBJ_REF_DELTA:
+            if base in offsets:
+                type_, base_content = resolve(offsets[base])
+            else:
+                if base not in external:
+                    external[base] = read_object(base)
+                type_, base_content = external[base]
+            obj = type_, apply_delta(base_content, payload)
+        else:
+            obj = TYPE_NAMES[type_num], payload
+        cache[offset] = obj
+        cache_size += len(obj[1])
+        while cache_size > DELTA_BASE_CACHE_SIZE and len(cache) > 1:
+            _, (_, evicted) = cache.popitem(last=False)
+            cache_size -= len(evicted)
+        return obj
+
+    offset = PACK_HEADER.size
+    for _ in range(count):
+        entry = _read_entry(body, offset)
+        type_, obj = resolve(offset, entry)
+        sha = hashlib.sha1(type_.encode() + b'\x00')
+        sha.update(obj)
+        offsets[sha.hexdigest()] = offset
+        offset = entry[3]
+    if offset != len(body):
+        raise Exception('Garbage at the end of the pack')
+    return count, offsets, external
+
+
+def _read_entry(buffer, offset):
+    '''Decode the entry at offset. Returns (type number, delta base,
+    inflated payload, offset of the next entry), the base is an offset for
+    OFS deltas and an oid for REF deltas.'''
+    start = offset
+    type_num, _, offset = _decode_entry_header(buffer, offset)
+    base = None
+    if type_num == OBJ_OFS_DELTA:
+        distance, offset = _decode_varint(buffer, offset)
+        base = start - distance
+    elif type_num == OBJ_REF_DELTA:
+        base = bytes(buffer[offset:offset + OID_SIZE]).hex()
+        offset += OID_SIZE
+
+    decompressor = zlib.decompressobj()
+    chunks = []
+    while not decompressor.eof:
+        chunk = buffer[offset:offset + 65536]
+        if not chunk:
+            raise Exception('Truncated pack entry')
+        chunks.append(decompressor.decompress(chunk))
+        offset += len(chunk) - len(decompressor.unused_data)
+    return type_num, base, b''.join(chunks), offset
+
+
+def _encode_idx(offsets, pack_checksum):
+    oids = sorted(bytes.fromhex(oid) for oid in offsets)
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[oid[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    parts = [IDX_HEADER.pack(IDX_SIGNATURE, IDX_VERSION), FANOUT.pack(*fanout)]
+    parts.extend(oids)
+    parts.extend(OFFSET.pack(offsets[oid.hex()]) for oid in oids)
+    parts.append(pack_checksum)
+    content = b''.join(parts)
+    return content + hashlib.sha1(content).digest()
+
+
+def idx_path(pack_path):
+    return pack_path[:-len('.pack')] + '.idx'
+
+
+def _write_file(path, content):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _mmap_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Pack:
+    '''Read only access to a pack through its index.'''
+
+    def __init__(self, pack_path):
+        self.path = pack_path
+        self._idx = _mmap_file(idx_path(pack_path))
+        self._pack = _mmap_file(pack_path)
+
+        signature, version = IDX_HEADER.unpack_from(self._idx, 0)
+        if signature != IDX_SIGNATURE or version != IDX_VERSION:
+            raise Exception(f'Unknown pack index format {signature} {version}')
+        self._fanout = FANOUT.unpack_from(self._idx, IDX_HEADER.size)
+        self.count = self._fanout[-1]
+        self._oids_start = IDX_HEADER.size + FANOUT.size
+        self._offsets_start = self._oids_start + self.count * OID_SIZE
+        # the idx ends with the checksums of the pack and of itself
+        self.checksum = self._idx[-2 * OID_SIZE:-OID_SIZE]
+
+    def _oid_at(self, position):
+        start = self._oids_start + position * OID_SIZE
+        return self._idx[start:start + OID_SIZE]
+
+    def position(self, oid):
+        '''Position of oid in the sorted index, or None.'''
+        raw = bytes.fromhex(oid)
+        lo = self._fanout[raw[0] - 1] if raw[0] else 0
+        hi = self._fanout[raw[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._oid_at(mid)
+            if current < raw:
+                lo = mid + 1
+            elif current > raw:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def oid_at(self, position):
+        return self._oid_at(position).hex()
+
+    def find(self, oid):
+        '''Offset of oid in the pack, or None if it isn't packed here.'''
+        position = self.position(oid)
+        if position is None:
+            return None
+        return OFFSET.unpack_from(
+            self._idx, self._offsets_start + position * OFFSET.size)[0]
+
+    def __contains__(self, oid):
+        return self.find(oid) is not None
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self._oid_at(position).hex()
+
+    def read(self, oid):
+        '''Return (type, content) of a packed object.'''
+        offset = self.find(oid)
+        if offset is None:
+            raise KeyError(oid)
+        return self._read_at(offset)
+
+    def stream(self, oid, chunk_size):
+        '''Return (type, chunks) of a packed object.
+
+        Only whole objects can be inflated chunk by chunk, deltas need their
+        complete base to be applied.
+        '''
+        offset = self.find(oid)
+        if offset is None:
+            raise KeyError(oid)
+        type_num, _, data_start = _decode_entry_header(self._pack, offset)
+        if type_num in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+            type_, content = self._read_at(offset)
+            return type_, iter([content])
+        return TYPE_NAMES[type_num], self._iter_inflate(data_start, chunk_size)
+
+    def _read_at(self, offset):
+        # follow the delta chain down to its base, then apply the deltas
+        # back up in reverse order
+        deltas = []
+        while True:
+            type_num, _, data_start = _decode_entry_header(self._pack, offset)
+            if type_num == OBJ_OFS_DELTA:
+                distance, data_start = _decode_varint(self._pack, data_start)
+                deltas.append(self._inflate(data_start))
+                offset -= distance
+            elif type_num == OBJ_REF_DELTA:
+                base_oid = self._pack[data_start:data_start + OID_SIZE].hex()
+                deltas.append(self._inflate(data_start + OID_SIZE))
+                offset = self.find(base_oid)
+                if offset is None:
+                    raise Exception(f'Missing delta base {base_oid}')
+            else:
+                type_ = TYPE_NAMES[type_num]
+                content = self._inflate(data_start)
+                break
+
+        for delta in reversed(deltas):
+            content = apply_delta(content, delta)
+        return type_, content
+
+    def _inflate(self, offset):
+        return b''.join(self._iter_inflate(offset))
+
+    def _iter_inflate(self, offset, chunk_size=65536):
+        decompressor = zlib.decompressobj()
+        # the compressed size isn't stored, inflate until the stream ends
+        while not decompressor.eof:
+            chunk = self._pack[offset:offset + chunk_size]
+            if not chunk:
+                raise Exception('Truncated pack entry')
+            yield decompressor.decompress(chunk)
+            offset += len(chunk)
+
+
+def iter_pack_paths(pack_dir):
+    if not os.path.isdir(pack_dir):
+        return
+    for name in sorted(os.listdir(pack_dir)):
+        if name.startswith('pack-') and name.endswith('.idx'):
+            yield os.path.join(pack_dir, name[:-len('.idx')] + '.pack')
@@ -0,0 +1,72 @@
+'''Framing of the network protocol between ugit serve and its clients.
+
+Every message is a frame: a 4 byte big endian length and the payload. A
+frame of length 0 is a flush and ends a list of messages. Text messages
+are utf-8, pack data is sent in frames prefixed with a sideband byte.
+'''
+import struct
+
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 64 * 1024
+
+# sideband of frames that carry a pack
+SIDEBAND_DATA = b'\x01'
+SIDEBAND_ERROR = b'\x03'
+
+# old value of a ref that doesn't exist yet
+NULL_OID = '0' * 40
+
+DEFAULT_PORT = 9418
+
+
+def encode_frame(payload=b''):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    assert len(payload) <= MAX_FRAME_SIZE, 'Frame too big'
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def _check_size(size):
+    if size > MAX_FRAME_SIZE:
+        raise Exception(f'Frame of {size} bytes is too big')
+
+
+async def read_frame(reader):
+    '''Payload of the next frame, b'' for a flush and None at the end of
+    the stream.'''
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    # asyncio.IncompleteReadError, without importing asyncio for clients
+    except EOFError as e:
+        if e.partial:
+            raise
+        return None
+    size, = FRAME_HEADER.unpack(header)
+    _check_size(size)
+    return await reader.readexactly(size) if size else b''
+
+
+def read_frame_sync(f):
+    '''read_frame() for a blocking file like object.'''
+    header = f.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise Exception('Connection closed in the middle of a frame')
+    size, = FRAME_HEADER.unpack(header)
+    _check_size(size)
+    payload = f.read(size)
+    if len(payload) < size:
+        raise Exception('Connection closed in the middle of a frame')
+    return payload
+
+
+def parse_url(url):
+    '''Return ('tcp', (host, port)) or ('unix', path) for a remote url, or
+    None if it isn't a network url.'''
+    if url.startswith('unix://'):
+        return 'unix', url[len('unix://'):]
+    if url.startswith('ugit://'):
+        host, _, port = url[len('ugit://'):].rstrip('/').partition(':')
+        return 'tcp', (host or 'localhost', int(port or DEFAULT_PORT))
+    return None
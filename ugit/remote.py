@@ -1,54 +1,322 @@
 import os
+import shutil
+import socket
 
 from . import base  # pylint: disable=relative-beyond-top-level
 from . import data  # pylint: disable=relative-beyond-top-level
+from . import protocol  # pylint: disable=relative-beyond-top-level
+from . import trace  # pylint: disable=relative-beyond-top-level
 
 REMOTE_REFS_BASE = 'refs/heads'
 LOCAL_REFS_BASE = 'refs/remote'
 
+HEX_DIGITS = set('0123456789abcdef')
+
+
+@trace.traced('remote.fetch')
+def fetch(remote_path, filter_spec=None):
+    '''Fetch the branches of a remote. With filter_spec 'blob:none' only
+    commits and trees are fetched, blobs are fetched when they are needed.'''
+    url = _remote_url(remote_path)
+    promisor = data.get_promisor()
+    # a partial clone keeps fetching with the filter it was made with
+    if filter_spec is None and promisor and promisor[0] == url:
+        filter_spec = promisor[1]
+    _parse_filter(filter_spec)
 
-def fetch(remote_path):
     print('Will fetch the following refs:')
-    # get remote refs
-    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+    with _open_remote(remote_path) as remote:
+        # get remote refs
+        refs = remote.get_refs(REMOTE_REFS_BASE)
 
-    # fetch missing objects
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
+        # only walk remote history until commits we already have
+        wants = {oid for oid in refs.values() if not data.object_exists(oid)}
+        local_tips = {ref.value for _, ref in data.iter_refs()}
+        common = base.find_common(local_tips, remote.has_commits)
+        # the pack is verified and stored before any ref points into it
+        remote.fetch_pack(wants, common, filter_spec)
+    if filter_spec:
+        data.set_promisor(url, filter_spec)
+
+    # the commit-graph is updated before any ref points to the new commits
+    base.write_commit_graph(refs.values())
 
     # update local refs
+    local_refs = {}
     for remote_name, value in refs.items():
         refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
         # TODO: refactor all path with os.path.join
-        data.update_ref(f'{LOCAL_REFS_BASE}/{refname}',
-                        data.RefValue(symbolic=False, value=value))
+        local_refs[f'{LOCAL_REFS_BASE}/{refname}'] = value
+    data.update_refs(local_refs)
+
+
+@trace.traced('remote.fetch_objects')
+def fetch_objects(remote_path, oids):
+    '''Fetch objects by oid, for objects a partial clone left out.'''
+    with _open_remote(remote_path) as remote:
+        remote.fetch_objects(oids)
+
+
+def clone(remote_path, directory=None, filter_spec=None, jobs=None):
+    url = _remote_url(remote_path)
+    directory = directory or os.path.basename(url.rstrip('/'))
+    os.makedirs(directory)
+    cwd = os.getcwd()
+    # the working tree is relative to the current directory
+    os.chdir(directory)
+    try:
+        with data.change_git_dir('.'):
+            base.init()
+            fetch(url, filter_spec)
+            master = data.get_ref(f'{LOCAL_REFS_BASE}/master').value
+            if master:
+                base.create_branch('master', master)
+                base.checkout('master', jobs)
+    finally:
+        os.chdir(cwd)
 
 
-def _get_remote_refs(remote_path, prefix=''):
-    with data.change_git_dir(remote_path):
-        return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
+def _remote_url(remote_path):
+    # local paths are made absolute, to stay valid from other directories
+    if protocol.parse_url(remote_path):
+        return remote_path
+    return os.path.abspath(remote_path)
 
 
+def _parse_filter(filter_spec):
+    '''Whether blobs are sent for a fetch filter.'''
+    if not filter_spec:
+        return True
+    if filter_spec == 'blob:none':
+        return False
+    raise Exception(f'Unsupported filter {filter_spec}')
+
+
+@trace.traced('remote.push')
 def push(remote_path, refname):
-    remote_refs = _get_remote_refs(remote_path)
-    remote_ref = remote_refs.get(refname)
-    local_ref = data.get_ref(refname).value
-    assert local_ref
-
-    # disallow force push
-    could_push = base.is_ancestor_of(local_ref, remote_ref)
-    assert not remote_ref or could_push
-
-    # get diff of remote objects and local objects
-    known_remote_refs = filter(data.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({local_ref}))
-    objects_to_push = local_objects - remote_objects
-
-    # push all objects
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
-
-    # update remote ref
-    with data.change_git_dir(remote_path):
-        data.update_ref(refname, data.RefValue(False, local_ref))
+    with _open_remote(remote_path) as remote:
+        remote_refs = remote.get_refs()
+        remote_ref = remote_refs.get(refname)
+        local_ref = data.get_ref(refname).value
+        assert local_ref
+
+        # disallow force push
+        could_push = base.is_ancestor_of(local_ref, remote_ref)
+        assert not remote_ref or could_push
+
+        # only walk local history until commits the remote already has
+        common = base.find_common({local_ref}, remote.has_commits)
+        with data.pack_spool() as f:
+            upload_pack(f, {local_ref}, common)
+            # the remote moves the ref once it verified and stored the pack
+            remote.push_pack(refname, remote_ref, local_ref, f)
+
+
+# The serving side of fetch and push, run in the repository that is
+# fetched from or pushed to. Refnames and oids may come from the network,
+# they are checked before they are used as paths.
+
+def _check_oid(oid):
+    if len(oid) != 40 or not set(oid) <= HEX_DIGITS:
+        raise Exception(f'Invalid object name {oid!r}')
+
+
+def _check_refname(refname):
+    parts = refname.split('/')
+    if (parts[0] != 'refs' or len(parts) < 2 or
+            any(part in ('', '.', '..') or '\\' in part for part in parts)):
+        raise Exception(f'Invalid refname {refname!r}')
+
+
+def list_refs(prefix=''):
+    return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
+
+
+def common_commits(oids):
+    '''The commits of oids this repository has.'''
+    for oid in oids:
+        _check_oid(oid)
+    return {oid for oid in oids if data.object_exists(oid)}
+
+
+@trace.traced('remote.upload_pack')
+def upload_pack(f, wants, haves, filter_spec=None):
+    '''Write a thin pack of the objects reachable from wants but not from
+    haves to the file f.'''
+    for oid in wants:
+        _check_oid(oid)
+    haves = common_commits(haves)
+    name_hints = {}
+    objects = list(base.iter_objects_between(
+        wants, haves, name_hints, _parse_filter(filter_spec)))
+    return data.pack_objects(f, objects, name_hints)
+
+
+def upload_objects(f, oids):
+    '''Write a pack of the objects oids, without what they refer to, to
+    the file f.'''
+    for oid in oids:
+        _check_oid(oid)
+    return data.pack_objects(f, oids)
+
+
+def _check_connected(new):
+    '''Raise if an object reachable from new is missing. Only the objects
+    that aren't reachable from refs yet are looked at.'''
+    tips = {ref.value for _, ref in data.iter_refs()}
+    try:
+        for oid in base.iter_objects_between({new}, tips):
+            if not data.object_exists(oid):
+                raise Exception(f'Object {oid} not found')
+    except Exception as e:
+        raise Exception(f'Pushed objects are incomplete: {e}') from e
+
+
+@trace.traced('remote.receive_push')
+def receive_push(refname, old, new, f):
+    '''Store a pushed pack spooled to f and move refname from old to
+    new.'''
+    _check_refname(refname)
+    _check_oid(new)
+    if old:
+        _check_oid(old)
+    if data.get_ref(refname).value != old:
+        raise Exception(f'{refname} changed since it was read')
+    data.receive_pack(f)
+    _check_connected(new)
+    if old and not base.is_ancestor_of(new, old):
+        raise Exception(f'Push to {refname} is not a fast-forward')
+    data.update_refs({refname: new})
+
+
+def _open_remote(remote_path):
+    address = protocol.parse_url(remote_path)
+    if address:
+        return _NetworkRemote(*address)
+    return _LocalRemote(remote_path)
+
+
+class _LocalRemote:
+    '''A repository on the local file system, served in process.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def get_refs(self, prefix=''):
+        with data.change_git_dir(self.path):
+            return list_refs(prefix)
+
+    def has_commits(self, oids):
+        with data.change_git_dir(self.path):
+            return common_commits(oids)
+
+    def fetch_pack(self, wants, haves, filter_spec=None):
+        with data.pack_spool() as f:
+            with data.change_git_dir(self.path):
+                upload_pack(f, wants, haves, filter_spec)
+            data.receive_pack(f)
+
+    def fetch_objects(self, oids):
+        with data.pack_spool() as f:
+            with data.change_git_dir(self.path):
+                upload_objects(f, oids)
+            data.receive_pack(f)
+
+    def push_pack(self, refname, old, new, f):
+        with data.change_git_dir(self.path), data.pack_spool() as spool:
+            # the pack is stored by linking its spool, which has to be in
+            # the pack dir of the remote
+            f.seek(0)
+            shutil.copyfileobj(f, spool)
+            receive_push(refname, old, new, spool)
+
+
+class _NetworkRemote:
+    '''A repository served by ugit serve.'''
+
+    def __init__(self, family, address):
+        family = socket.AF_UNIX if family == 'unix' else socket.AF_INET
+        if family == socket.AF_INET:
+            self._socket = socket.create_connection(address)
+        else:
+            self._socket = socket.socket(family)
+            self._socket.connect(address)
+        self._reader = self._socket.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._reader.close()
+        self._socket.close()
+
+    def _send(self, *messages):
+        self._socket.sendall(b''.join(
+            protocol.encode_frame(message) for message in messages))
+
+    def _read_messages(self):
+        '''Text messages up to the next flush. An error is raised after the
+        flush is read, so the connection can be used further.'''
+        messages = []
+        while True:
+            frame = protocol.read_frame_sync(self._reader)
+            if frame is None:
+                raise Exception('Connection closed by remote')
+            if not frame:
+                break
+            messages.append(frame.decode())
+        for message in messages:
+            if message.startswith('error '):
+                raise Exception(f'Remote error: {message[len("error "):]}')
+        return messages
+
+    def get_refs(self, prefix=''):
+        self._send(f'ls-refs {prefix}', b'')
+        return {refname: oid for oid, refname in
+                (message.split(' ', 1) for message in self._read_messages())}
+
+    def has_commits(self, oids):
+        self._send('negotiate', *(f'have {oid}' for oid in oids), b'')
+        return {message.split(' ', 1)[1] for message in self._read_messages()}
+
+    def fetch_pack(self, wants, haves, filter_spec=None):
+        filters = [f'filter {filter_spec}'] if filter_spec else []
+        self._send('fetch', *(f'want {oid}' for oid in wants),
+                   *(f'have {oid}' for oid in haves), *filters, b'')
+        self._receive_pack()
+
+    def fetch_objects(self, oids):
+        self._send('fetch-objects', *(f'want {oid}' for oid in oids), b'')
+        self._receive_pack()
+
+    def _receive_pack(self):
+        # spool the pack to disk instead of holding it in memory
+        with data.pack_spool() as f:
+            error = None
+            while True:
+                frame = protocol.read_frame_sync(self._reader)
+                if frame is None:
+                    raise Exception('Connection closed by remote')
+                if not frame:
+                    break
+                if frame[:1] == protocol.SIDEBAND_ERROR:
+                    error = frame[1:].decode()
+                f.write(frame[1:])
+            if error:
+                raise Exception(f'Remote error: {error}')
+            data.receive_pack(f)
+
+    def push_pack(self, refname, old, new, f):
+        self._send(f'push {refname} {old or protocol.NULL_OID} {new}')
+        chunk_size = protocol.MAX_FRAME_SIZE - 1
+        f.seek(0)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            self._send(protocol.SIDEBAND_DATA + chunk)
+        self._send(b'')
+        self._read_messages()
@@ -0,0 +1,195 @@
+'''ugit serve: serve the repository to fetch and push over the network.
+
+Clients are handled concurrently by asyncio. The repository itself isn't
+thread safe, so all work on it runs on a single worker thread while the
+event loop keeps streaming to other clients. Packs are written object by
+object to spool files on disk in both directions and sent in bounded
+frames with drain(), and requests are limited in size, so memory doesn't
+grow with the number of clients or the size of their packs.
+'''
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from . import data  # pylint: disable=relative-beyond-top-level
+from . import protocol  # pylint: disable=relative-beyond-top-level
+from . import remote  # pylint: disable=relative-beyond-top-level
+
+# clients that don't send anything for this long are disconnected
+IDLE_TIMEOUT = 300
+# a request that isn't a push has at most this many bytes of messages
+MAX_REQUEST_SIZE = 4 * 2 ** 20
+
+
+async def serve(host='127.0.0.1', port=protocol.DEFAULT_PORT,
+                unix_path=None, ready=None):
+    '''Serve the current repository until cancelled. ready is called with
+    the address once the server listens.'''
+    worker = ThreadPoolExecutor(1)
+    handler = _Handler(worker)
+    if unix_path:
+        server = await asyncio.start_unix_server(handler, unix_path)
+        address = f'unix://{unix_path}'
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        address = f'ugit://{host}:{port}'
+    (ready or print)(address)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.shutdown()
+        if unix_path and os.path.exists(unix_path):
+            os.remove(unix_path)
+
+
+def _run_fresh(func, *args):
+    # refs may have changed since the last request, by a push or locally
+    data.invalidate_ref_cache()
+    return func(*args)
+
+
+class _Handler:
+
+    def __init__(self, worker):
+        self._worker = worker
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._worker, _run_fresh, func, *args)
+
+    async def __call__(self, reader, writer):
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except Exception as e:  # pylint: disable=broad-except
+            # broken connections and malformed requests end the session
+            peer = writer.get_extra_info('peername') or 'unix socket'
+            print(f'Session of {peer} ended: {e!r}', file=sys.stderr)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_frame(self, reader):
+        return await asyncio.wait_for(
+            protocol.read_frame(reader), IDLE_TIMEOUT)
+
+    async def _read_messages(self, reader):
+        '''Messages of a request up to the flush that ends it.'''
+        messages = []
+        size = 0
+        while True:
+            frame = await self._read_frame(reader)
+            if frame is None:
+                raise ConnectionError('Connection closed in a request')
+            if not frame:
+                return messages
+            size += len(frame)
+            if size > MAX_REQUEST_SIZE:
+                raise ConnectionError('Request too long')
+            messages.append(frame.decode())
+
+    async def _send(self, writer, *frames):
+        for frame in frames:
+            writer.write(protocol.encode_frame(frame))
+        # wait until a slow client read it, instead of buffering more
+        await writer.drain()
+
+    async def _handle_request(self, reader, writer):
+        frame = await self._read_frame(reader)
+        if frame is None:
+            return False
+        command, _, args = frame.decode().partition(' ')
+
+        if command == 'push':
+            await self._push(reader, writer, args)
+            return True
+
+        messages = await self._read_messages(reader)
+        if command in ('fetch', 'fetch-objects'):
+            await self._fetch(writer, command, messages)
+            return True
+
+        try:
+            if command == 'ls-refs':
+                refs = await self._run(remote.list_refs, args)
+                response = [f'{oid} {refname}'
+                            for refname, oid in refs.items()]
+            elif command == 'negotiate':
+                oids = [message.split(' ', 1)[1] for message in messages]
+                common = await self._run(remote.common_commits, oids)
+                response = [f'ack {oid}' for oid in sorted(common)]
+            else:
+                raise Exception(f'Unknown command {command}')
+        except Exception as e:  # pylint: disable=broad-except
+            response = [f'error {e}']
+        await self._send(writer, *response, b'')
+        return True
+
+    async def _fetch(self, writer, command, messages):
+        args = {'want': set(), 'have': set(), 'filter': set()}
+        for message in messages:
+            key, _, value = message.partition(' ')
+            if key not in args:
+                await self._send(
+                    writer, protocol.SIDEBAND_ERROR +
+                    f'Unknown fetch argument {key!r}'.encode(), b'')
+                return
+            args[key].add(value)
+        filter_spec = min(args['filter'], default=None)
+        if command == 'fetch':
+            build_pack = (remote.upload_pack, args['want'], args['have'],
+                          filter_spec)
+        else:
+            build_pack = (remote.upload_objects, args['want'])
+
+        chunk_size = protocol.MAX_FRAME_SIZE - 1
+        try:
+            path = await self._run(self._spool_pack, *build_pack)
+        except Exception as e:  # pylint: disable=broad-except
+            await self._send(writer, protocol.SIDEBAND_ERROR + str(e).encode(),
+                             b'')
+            return
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    await self._send(writer, protocol.SIDEBAND_DATA + chunk)
+        finally:
+            os.remove(path)
+        await self._send(writer, b'')
+
+    @staticmethod
+    def _spool_pack(build_pack, *args):
+        with data.pack_spool(delete=False) as f:
+            try:
+                build_pack(f, *args)
+            except BaseException:
+                os.remove(f.name)
+                raise
+            return f.name
+
+    async def _push(self, reader, writer, args):
+        with data.pack_spool() as f:
+            while True:
+                frame = await self._read_frame(reader)
+                if frame is None:
+                    raise ConnectionError('Connection closed in a push')
+                if not frame:
+                    break
+                f.write(frame[1:])
+            try:
+                # the pack is read first, so the connection stays usable
+                if len(args.split(' ')) != 3:
+                    raise Exception('Malformed push request')
+                refname, old, new = args.split(' ')
+                old = None if old == protocol.NULL_OID else old
+                await self._run(remote.receive_push, refname, old, new, f)
+                response = 'ok'
+            except Exception as e:  # pylint: disable=broad-except
+                response = f'error {e}'
+        await self._send(writer, response, b'')
@@ -0,0 +1,141 @@
+'''Count and time what a command spends its time on.
+
+Tracing is enabled with UGIT_TRACE=1 or ugit --trace, a summary of the
+traced operations is then printed to stderr when the command ends. With
+UGIT_TRACE_FILE=path or --trace-file path every traced call is also
+written to path as a Chrome trace, to view in chrome://tracing or
+Perfetto. Times are inclusive, a traced call within a traced call counts
+for both.
+
+When tracing is off a traced function only checks a global before it
+calls the real function.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import functools
+
+enabled = False
+
+# stop recording events after this many, the summary keeps counting
+MAX_EVENTS = 1000000
+
+# name -> [calls, seconds, bytes]
+_stats = {}
+# Chrome trace events, or None if they aren't recorded
+_events = None
+_trace_file = None
+_start = None
+_lock = threading.Lock()
+
+
+def enable(trace_file=None):
+    '''Start tracing, and report when the process exits.'''
+    global enabled, _events, _trace_file, _start
+    if trace_file:
+        _events = []
+        _trace_file = trace_file
+    if not enabled:
+        enabled = True
+        _start = time.perf_counter()
+        atexit.register(report)
+
+
+def _record(name, start, end, size):
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = [0, 0.0, 0]
+        stat[0] += 1
+        stat[1] += end - start
+        stat[2] += size or 0
+        if _events is not None and len(_events) < MAX_EVENTS:
+            event = {'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                     'ts': (start - _start) * 1e6,
+                     'dur': (end - start) * 1e6,
+                     'pid': os.getpid(), 'tid': threading.get_ident()}
+            if size is not None:
+                event['args'] = {'bytes': size}
+            _events.append(event)
+
+
+def traced(name, size=None):
+    '''Decorator that traces calls of a function as name. size, if given,
+    computes the bytes a call handled from its result and arguments.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            _record(name, start, time.perf_counter(),
+                    size and size(result, *args))
+            return result
+        return wrapper
+    return decorator
+
+
+class _Span:
+
+    def __init__(self, name):
+        self.name = name
+        self.size = None
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, self._start, time.perf_counter(), self.size)
+
+
+class _NoSpan:
+
+    size = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name):
+    '''Context manager that traces a block as name. Set size on the value
+    it returns to record bytes.'''
+    return _Span(name) if enabled else _NO_SPAN
+
+
+def report(out=None):
+    out = out or sys.stderr
+    total = time.perf_counter() - _start
+    with _lock:
+        stats = sorted(_stats.items(), key=lambda item: -item[1][1])
+        events = list(_events) if _events is not None else None
+
+    print(f'trace: {total:.3f}s total', file=out)
+    print(f'{"operation":<24} {"calls":>9} {"seconds":>10} {"bytes":>12}',
+          file=out)
+    for name, (calls, seconds, size) in stats:
+        print(f'{name:<24} {calls:9} {seconds:10.4f} {size or "":>12}',
+              file=out)
+
+    if events is not None:
+        with open(_trace_file, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        dropped = sum(stat[0] for _, stat in stats) - len(events)
+        note = f', {dropped} calls not recorded' if dropped > 0 else ''
+        print(f'trace: events written to {_trace_file}{note}', file=out)
+
+
+if os.environ.get('UGIT_TRACE', '0') not in ('', '0') or \
+        os.environ.get('UGIT_TRACE_FILE'):
+    enable(os.environ.get('UGIT_TRACE_FILE'))